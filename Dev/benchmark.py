@@ -0,0 +1,366 @@
+# ====================
+# Python chat program
+# ====================
+#
+# Author: Edren Dacaymat
+#
+# Description:
+# Load generator and latency benchmark for the chat server. Hosts a
+# chat session on localhost the same way /dbghost does, connects a
+# number of simulated clients that greet the host with usern_update
+# and then send chat messages at a fixed rate. Every message carries
+# the time it was sent, so each client that receives it can measure
+# the end-to-end fan-out latency.
+#
+# -----------------------------------
+# usage: python benchmark.py [options]
+#
+# options:
+# --clients [number] - simulated clients (default 20)
+# --rate [number] - messages per second sent by each client (default 5)
+# --duration [seconds] - how long the clients send messages (default 10)
+# --size [bytes] - size of each chat message (default 64)
+# --port [port] - port of the chat session (default 24000)
+# --lobbies [number] - lobbies the clients are spread over (default 1)
+# --engine [asyncio|thread] - server engine (default asyncio)
+# --workers [number] - worker processes that serve clients (default 0)
+# --tls [on|off|both] - run with ssl, without ssl or both (default both)
+# --compress [on|off|both] - clients ask for compression or not (default off)
+# --parse - only measure the cost of parsing text and binary commands
+# -----------------------------------
+#
+# Run it from the directory that has the srv and cli certificates,
+# same as main.py. The report has, for every run:
+# connect rate - clients that completed the greeting per second
+# messages/sec - chat messages sent and delivered per second
+# latency - p50 and p99 time from sending a message to another client
+#           receiving it, in milliseconds
+# traffic - bytes the clients received per delivered message and the
+#           cpu time of the whole run (host and clients), to compare
+#           runs with and without compression (try --size 1000)
+# With --parse it decodes the same mix of commands from text ('0')
+# and binary ('c') frames, without any sockets, and reports the time
+# and frame size per command of each form.
+
+# =======
+# Imports
+# =======
+import sys
+import argparse
+import collections
+import itertools
+import random
+import selectors
+import shutil
+import tempfile
+import threading
+import time
+
+import chatcore
+from chatcore import ConData, eventSink, frameDecoder, frameCompressor, encodeFrame, sendFrame, closeSocket, clientSocket, hostSession, endSession
+
+# ================
+# Simulated Client
+# ================
+
+# benchClient() : THREAD
+# threading.Thread
+# Desc: a simulated chat client. Sends chat messages at a fixed rate
+# and records the latency of every message it receives from the others.
+class benchClient(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state,name,sock,rate,size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # connection data shared by every simulated client
+        self.username = name # username of the client
+        self.sock = sock # socket connected to the host
+        self.decoder = frameDecoder() # frame decoder of the connection
+        self.interval = 1.0 / rate # seconds between messages
+        self.padding = [chatText(size) for i in range(64)] # message bodies, used in turn
+        self.sending = True # send messages until cleared
+        self.term = False # terminate status
+        self.sent = 0 # messages sent
+        self.received = 0 # messages received from the other clients
+        self.latencies = [] # seconds from send to receive of every message received
+        self.lobby = None # lobby the client joins (None is the host's own lobby)
+        self.compressor = None # frameCompressor once the host agreed to compress
+        self.error = None # why the client stopped before it was told to
+
+    # greet()
+    # Params: self, timeout - seconds the host has to welcome the client,
+    # lobby - lobby to join (None joins the host's own lobby)
+    # Desc: sends the username and waits for the host's welcome message.
+    # Returns True when the client was welcomed.
+    def greet(self,timeout:float,lobby:str = None) -> bool:
+        greeting = 'usern_update '+self.username+(' '+lobby if lobby != None else '')
+        if chatcore.compressEnable: # the host may compress what it sends
+            greeting += ' +zlib'
+            self.decoder.inflate()
+        sendFrame(self.sock,'0',greeting)
+        self.sock.settimeout(timeout)
+        frames = chatcore.recvFirstFrame(self.sock,self.decoder,timeout)
+        return frames != None and frames[0] == '1' and frames[1].startswith('Welcome')
+
+    # receive()
+    # Params: self
+    # Desc: reads every frame available and records the latencies.
+    # Returns False when the host closed the connection.
+    def receive(self) -> bool:
+        frames = self.decoder.recvFrom(self.sock)
+        if frames == None: # socket closed
+            return False
+        frames = self.decoder.backlog + frames # frames that came with the welcome message
+        self.decoder.backlog = []
+        now = time.perf_counter()
+        for mtype,data in frames:
+            if mtype == '0' and data == 'comp_on zlib': # compress what we send too
+                self.compressor = frameCompressor()
+            if mtype == '2': # numbered lobby broadcast
+                data = data.partition(' ')[2]
+                (mtype,data) = (data[:1],data[1:])
+            if mtype != '1' or not data.startswith('[bench'): # only chat messages from other clients
+                continue
+            fields = data.split(' ')
+            self.latencies.append(now - float(fields[2]))
+            self.received += 1
+        return True
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        selector = chatcore.waitSelector() # select() cannot take fds past 1024
+        try:
+            self.sock.setblocking(False)
+            selector.register(self.sock,selectors.EVENT_READ)
+            self.loop(selector)
+        except Exception as err: # the run is no good without this client
+            self.error = repr(err)
+        finally:
+            selector.close()
+
+    # loop()
+    # Params: self, selector - selector the socket is registered with
+    # Desc: sends and receives until the client is told to stop
+    def loop(self,selector):
+        nextsend = time.perf_counter()
+        while not self.term:
+            now = time.perf_counter()
+            if self.sending and now >= nextsend:
+                self.sock.setblocking(True)
+                frame = encodeFrame('1','['+self.username+']: '+str(self.sent)+' '+repr(time.perf_counter())+' '+self.padding[self.sent % 64]+'\n')
+                self.sock.sendall(self.compressor.pack(frame) if self.compressor != None else frame)
+                self.sock.setblocking(False)
+                self.sent += 1
+                nextsend += self.interval
+                continue
+            wait = max(0.0, nextsend - now) if self.sending else 0.1
+            pending = getattr(self.sock,'pending',lambda: 0)() > 0 # ssl may already have decrypted bytes
+            if not pending and len(selector.select(wait)) == 0:
+                continue
+            try:
+                if not self.receive(): # host closed the connection
+                    self.error = 'the host closed the connection'
+                    break
+            except (BlockingIOError, chatcore.ssl.SSLWantReadError, chatcore.ssl.SSLWantWriteError):
+                pass
+
+# =========
+# Functions
+# =========
+
+# words the simulated clients chat with
+chatWords = ['the','a','to','and','you','is','it','that','of','in','what','for','are','on','was','this',
+             'have','just','but','not','so','be','with','me','can','do','lol','ok','yes','no','see',
+             'game','tonight','server','later','anyone','here','thanks','going','think','know','good',
+             'time','really','now','build','deploy','meeting','lunch','weekend','working','fixed','bug']
+
+# chatText()
+# Params: size - length of the text
+# Desc: returns random words, so compression sees text that looks
+# more like chat than a run of one letter
+def chatText(size:int) -> str:
+    words = []
+    length = 0
+    while length < size:
+        words.append(random.choice(chatWords))
+        length += len(words[-1]) + 1
+    return ' '.join(words)[:size]
+
+# percentile()
+# Params: values - sorted list of numbers, pct - percentile (0-100)
+# Desc: returns the value at the given percentile
+def percentile(values:list, pct:float) -> float:
+    if len(values) == 0:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+# commandMix()
+# Params: none
+# Desc: returns the (name, fields) of the commands parsed by
+# parseBenchmark, the ones a busy lobby sends most
+def commandMix() -> list:
+    return [('ulist_join',[812,41,'bench41']), ('ulist_rename',[813,41,'bench41 away']), ('ulist_leave',[814,41]),
+            ('file_ack',['0123456789abcdef',1310720]), ('file_ack',['0123456789abcdef',1376256]),
+            ('seq_start',['1a2b3c4d',52311]), ('usern_update',['bench7']), ('hist_ask',['last',100]),
+            ('srch_ask',[1,'deploy','tonight'])]
+
+# parseBenchmark()
+# Params: count - commands parsed in each form
+# Desc: decodes the frames of the same commands in their text and
+# binary forms, the way a connection does it, and returns a dict of
+# results per form. The forms take turns so a busy machine slows both.
+def parseBenchmark(count:int) -> dict:
+    mix = commandMix()
+    rounds = max(1, count // len(mix))
+    data = {form:b''.join(chatcore.commandFrame(name,fields,proto) for name,fields in mix) for proto,form in [(1,'text'),(2,'binary')]}
+    best = {}
+    for attempt in range(7): # the fastest of a few tries, the others were disturbed
+        for form in data:
+            decoder = frameDecoder()
+            start = time.perf_counter()
+            for i in range(rounds):
+                for mtype,payload in decoder.feed(data[form]):
+                    chatcore.decodeCommand(mtype,payload)
+            elapsed = time.perf_counter() - start
+            best[form] = min(best.get(form, elapsed), elapsed)
+    results = {form:{'ns': best[form] / (rounds * len(mix)) * 1e9, 'bytes': len(data[form]) / len(mix)} for form in data}
+    results['count'] = rounds * len(mix)
+    return results
+
+# parseReport()
+# Params: result - dict from parseBenchmark
+# Desc: returns a text report of the parse benchmark
+def parseReport(result:dict) -> str:
+    return ('[command parsing, '+str(result['count'])+' commands per form]\n'
+            '  text: %.0f ns per command, %.1f bytes per frame\n' % (result['text']['ns'], result['text']['bytes']) +
+            '  binary: %.0f ns per command, %.1f bytes per frame\n' % (result['binary']['ns'], result['binary']['bytes']))
+
+# runBenchmark()
+# Params: settings - benchmark settings, tls - whether ssl is used
+# Desc: hosts a chat session, runs the simulated clients against it
+# and returns a dict of results
+def runBenchmark(settings:dict, tls:bool, compress:bool) -> dict:
+    chatcore.debugMode = False
+    chatcore.sslEnable = tls
+    chatcore.compressEnable = compress
+    chatcore.serverEngine = settings['engine']
+    chatcore.hostWorkers = settings['workers']
+    chatcore.userRate = 0 # measure the server, not its flood protection
+    chatcore.lobbyRate = 0
+    chatcore.historyDir = tempfile.mkdtemp(prefix='chatbench') # start every run with an empty chat history
+
+    host = ConData() # the chat server, shows nothing
+    host.username = 'BenchHost'
+    if not hostSession(host,'Benchmark',settings['port'],settings['clients'],'localhost'):
+        raise RuntimeError('could not host the chat session on port '+str(settings['port']))
+    cstate = ConData() # shared by the clients for the ssl context and sessions
+    cstate.sink = eventSink()
+    clients = []
+    try:
+        # connect and greet every client
+        cpustart = time.process_time()
+        start = time.perf_counter()
+        for i in range(settings['clients']):
+            sock = clientSocket(cstate,settings['port'],'localhost')
+            if sock == None:
+                raise RuntimeError('simulated client '+str(i)+' could not connect')
+            client = benchClient(cstate,'bench'+str(i),sock,settings['rate'],settings['size'])
+            clients.append(client)
+            client.lobby = 'room'+str(i % settings['lobbies']) if settings['lobbies'] > 1 else None
+            if not client.greet(10.0,client.lobby):
+                raise RuntimeError('simulated client '+str(i)+' was not welcomed')
+        connecttime = time.perf_counter() - start
+
+        # send messages for the duration, then let the last ones arrive
+        for client in clients:
+            client.start()
+        time.sleep(settings['duration'])
+        for client in clients:
+            client.sending = False
+        time.sleep(1.0)
+        for client in clients:
+            client.term = True
+        for client in clients:
+            client.join(2.0)
+        cputime = time.process_time() - cpustart
+        failed = [client for client in clients if client.error != None or client.is_alive()]
+        if len(failed) > 0: # the survivors' numbers would look better than they are
+            raise RuntimeError(str(len(failed))+' simulated clients stopped early, the first one ('+failed[0].username+'): '
+                               +(failed[0].error if failed[0].error != None else 'did not stop'))
+    finally:
+        for client in clients:
+            client.term = True
+        endSession(host,0) # the host closes first, like /end
+        for client in clients:
+            closeSocket(cstate,client.sock)
+        shutil.rmtree(chatcore.historyDir, ignore_errors=True)
+
+    latencies = sorted(l for client in clients for l in client.latencies)
+    sent = sum(client.sent for client in clients)
+    received = sum(client.received for client in clients)
+    members = collections.Counter(client.lobby for client in clients) # clients in every lobby
+    expected = sum(client.sent * (members[client.lobby] - 1) for client in clients) # every other member gets it
+    wire = sum(client.decoder.received for client in clients)
+    return {'tls': tls,
+            'compress': compress,
+            'wire': wire / max(received, 1),
+            'cpu': cputime,
+            'connect': settings['clients'] / connecttime,
+            'sent': sent / settings['duration'],
+            'delivered': received / settings['duration'],
+            'expected': expected,
+            'received': received,
+            'p50': percentile(latencies, 50) * 1000.0,
+            'p99': percentile(latencies, 99) * 1000.0}
+
+# report()
+# Params: settings - benchmark settings, result - dict from runBenchmark
+# Desc: returns a text report of a benchmark run
+def report(settings:dict, result:dict) -> str:
+    return ('['+('tls' if result['tls'] else 'plain')+(', zlib' if result['compress'] else '')+', '+settings['engine']+', '+str(settings['clients'])+' clients, '
+            +str(settings['lobbies'])+' lobbies, '+str(settings['workers'])+' workers]\n'
+            '  connect rate: %.1f clients/sec\n' % result['connect'] +
+            '  messages/sec: %.1f sent, %.1f delivered (%d of %d)\n' % (result['sent'], result['delivered'], result['received'], result['expected']) +
+            '  latency: p50 %.2f ms, p99 %.2f ms\n' % (result['p50'], result['p99']) +
+            '  traffic: %.1f bytes received per message, %.2f s cpu\n' % (result['wire'], result['cpu']))
+
+# main()
+# Params: argv - command line arguments
+# Desc: runs the benchmark and prints the report. Returns the process
+# exit code.
+def main(argv:list) -> int:
+    parser = argparse.ArgumentParser(prog='benchmark', description='Chat server load and latency benchmark.')
+    parser.add_argument('--clients', type=int, default=20, help='simulated clients')
+    parser.add_argument('--rate', type=float, default=5.0, help='messages per second sent by each client')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds the clients send messages')
+    parser.add_argument('--size', type=int, default=64, help='size of each chat message')
+    parser.add_argument('--port', type=int, default=24000, help='port of the chat session')
+    parser.add_argument('--lobbies', type=int, default=1, help='lobbies the clients are spread over')
+    parser.add_argument('--engine', choices=['asyncio','thread'], default=chatcore.serverEngine, help='server engine')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes that serve clients')
+    parser.add_argument('--tls', choices=['on','off','both'], default='both', help='run with ssl, without ssl or both')
+    parser.add_argument('--compress', choices=['on','off','both'], default='off', help='clients ask for compression or not')
+    parser.add_argument('--parse', action='store_true', help='only measure the cost of parsing text and binary commands')
+    settings = vars(parser.parse_args(argv))
+    if settings['parse']:
+        sys.stdout.write(parseReport(parseBenchmark(200000)))
+        return 0
+    if settings['lobbies'] < 1 or settings['clients'] < 2 * settings['lobbies']:
+        parser.error('at least 2 clients per lobby are needed to measure fan-out')
+
+    modes = {'on':[True], 'off':[False], 'both':[False,True]}
+    for tls,compress in itertools.product(modes[settings['tls']], modes[settings['compress']]):
+        try:
+            result = runBenchmark(settings, tls, compress)
+        except RuntimeError as err:
+            print('benchmark failed: '+str(err))
+            return 1
+        sys.stdout.write(report(settings, result))
+        sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,4980 @@
+# ====================
+# Python chat program
+# ====================
+# 
+# Author: Edren Dacaymat
+# 
+# Description:
+# Networking core of the chat program. Everything that talks to the
+# network lives here: the wire protocol, the ssl setup, the server
+# engines and the client handler. Nothing in this module imports the
+# GUI toolkit; whatever shows the chat to the user (the wxPython window
+# in main.py, the console in headless.py) registers an eventSink on
+# the ConData state and gets told about history lines, user list
+# changes and closed connections through it.
+
+# =======
+# Imports
+# =======
+import sys
+import array
+import asyncio
+import bisect
+import heapq
+import http.server
+import itertools
+import collections
+import concurrent.futures
+import json
+import mmap
+import multiprocessing.connection
+import os
+import queue
+import re
+import select
+import selectors
+import socket
+import struct
+import threading
+import time
+import random
+import string
+import subprocess
+import urllib.parse
+import zlib
+
+# Try import SSL
+try: import ssl
+except ImportError: # import failed, show error.
+    print('This application requires the SSL module to run.')
+    sys.exit(11)
+
+# ================
+# Global Variables
+# ================
+
+# Debugging
+# dbg() messages are shown when debugMode is on and their type is at
+# least as important as debugLevel: 'trace' (every frame sent and
+# received), 'Status'/'SSL' (connections and commands), 'warn', 'error'.
+debugMode:bool = True
+debugLevel:str = 'Status'
+debugLevels:dict = {'trace':0, 'Status':1, 'SSL':1, 'warn':2, 'warning':2, 'error':3, 'Error':3}
+sslEnable:bool = True
+printToHistory:bool = True
+
+# Server engine used when hosting
+# 'asyncio' - every client is served by a single event loop
+# 'thread' - every client gets its own handler thread
+serverEngine:str = 'asyncio'
+handshakeTimeout:float = 10.0 # seconds a new connection has to complete the ssl handshake
+greetingTimeout:float = 10.0 # seconds a new connection has to send its username
+acceptWorkers:int = 16 # threads admitting new connections (thread engine)
+# Selector the thread engine's handlers wait on. poll needs no fd of its
+# own and, unlike select, takes fds past 1024 (Windows has no poll, but
+# its select has no such limit).
+waitSelector = getattr(selectors,'PollSelector',selectors.DefaultSelector)
+
+# Heartbeats
+# A connection that sent nothing for heartbeatInterval seconds is sent
+# a ping, which the other side answers with a pong. A connection that
+# sent nothing for heartbeatTimeout seconds is closed as dead. 0 turns
+# heartbeats off and leaves it to SO_KEEPALIVE.
+heartbeatInterval:float = 15.0
+heartbeatTimeout:float = 45.0
+
+# Outbound queues
+# Every connection has a bounded queue of frames waiting to be written.
+# A client whose queue grows past outboxHighWater is slow until it drains
+# back under outboxLowWater. What happens to frames sent to a slow client
+# depends on slowClientPolicy:
+# 'drop' - new frames are dropped, the client is disconnected if it stays slow for slowClientGrace seconds
+# 'disconnect' - the client is disconnected right away
+outboxHighWater:int = 1048576 # bytes
+outboxLowWater:int = 262144 # bytes
+slowClientPolicy:str = 'drop'
+slowClientGrace:float = 10.0 # seconds
+
+# Rate limits
+# Every client connection and every lobby has a token bucket: chat
+# messages and username changes take a token each, tokens come back at
+# the rate per second, and at most burst of them are kept. What goes
+# over either limit is dropped before it is sent to anyone and the
+# sender gets a notice (at most once every rateNotice seconds). A rate
+# of 0 turns the limit off.
+userRate:float = 5.0
+userBurst:int = 10
+lobbyRate:float = 50.0
+lobbyBurst:int = 100
+rateNotice:float = 5.0
+
+# Chat history
+# The host keeps every chat message of a session in an append-only log
+# under historyDir/[server name]. Clients that join get the last
+# historyReplay messages.
+historyEnable:bool = True
+historyDir:str = './history'
+historySegmentSize:int = 4194304 # bytes per log file before a new one is started
+historyCache:int = 1000 # newest messages also kept in memory
+historyReplay:int = 100 # messages sent to a client that joins
+historyFlush:float = 1.0 # seconds between flushes of the log file
+searchPageSize:int = 10 # search results per page
+
+# Lobbies
+maxLobbies:int = 500 # lobbies a host serves at once
+
+# Worker processes
+# With hostWorkers above 0 the host starts that many worker processes
+# that accept and serve clients on the same port (needs SO_REUSEPORT),
+# so the socket and ssl work of the clients is spread over several
+# cores. The host process keeps the lobbies, rosters and chat history.
+hostWorkers:int = 0
+workerReport:float = 0.05 # seconds between a worker's reports of its clients' outbound queues
+
+# Federation
+relayMemory:int = 10000 # relayed message ids remembered to drop duplicates
+
+# Reconnecting
+# Every broadcast to a lobby carries a sequence number and the newest
+# resumeBuffer of them are kept, so a client that reconnects only gets
+# the broadcasts it missed. A client whose connection to the host is
+# lost tries again reconnectTries times, waiting reconnectDelay seconds
+# at first and twice as long after every failure (up to reconnectMaxDelay).
+resumeBuffer:int = 1000
+reconnectTries:int = 8
+reconnectDelay:float = 0.5
+reconnectMaxDelay:float = 30.0
+
+# File transfers
+# Files sent with /send are streamed in chunks of fileChunkSize bytes. A
+# sender keeps at most fileWindow bytes on the way to the host, so chat
+# messages never wait behind a whole file. Received files are saved
+# under downloadDir.
+downloadDir:str = './downloads'
+fileChunkSize:int = 65536 # bytes of a file in one frame
+fileWindow:int = 262144 # bytes sent but not yet acknowledged by the host
+maxDownloads:int = 16 # files being received at once
+transferTimeout:float = 600.0 # seconds an unfinished transfer is kept for its sender to come back
+
+# Direct messages
+# Messages sent with /msg to a user who disconnected less than
+# mailboxTimeout seconds ago wait for them on the host, at most
+# mailboxLimit of them per user.
+mailboxTimeout:float = 600.0
+mailboxLimit:int = 50
+
+# ===============
+# Connection Data
+# ===============
+
+connectionIds = itertools.count(1) # ids given to client handlers by clientRegistry
+
+# state() : Object
+# Desc: Connection data
+class ConData():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        # Receives history lines, user list updates and closed connections
+        self.sink:eventSink = eventSink()
+        # Stores user's username (default username is generated)
+        self.username:str = 'User_'+''.join(random.choice(string.digits) for i in range(5))
+        # Status variable that determines whether it is host or not
+        self.isHost:bool = False
+        # Members of the chat session (of the host's own lobby if this is host)
+        self.roster = rosterData()
+        # Lobbies by name, the host's own lobby and the lock guarding them (only if this is host)
+        self.lobbies:dict = {}
+        self.lobby = None
+        self.lobbylock = threading.Lock()
+        # Search index of the lobbies' chat history (only if this is host)
+        self.search = None
+        # Bus to the worker processes (only if this is host) or to the host (only in a worker process)
+        self.workers = None
+        self.bus = None
+        # Relay state and the links to other hosts (only if this is host)
+        self.relay = None
+        self.peers:list = []
+        # Client handlers of the connected clients and linked hosts, in the order they joined
+        # A client only has the handler of its connection to the host
+        self.serverclients = clientRegistry()
+        # Heartbeat thread watching the connections
+        self.heartbeat = None
+        # Counters and histograms of the chat session and the endpoint serving them
+        self.metrics = metricsData()
+        self.metricsServer = None
+        # Sampling profiler while /profile runs
+        self.profiler = None
+        # Where to reconnect to and the last broadcast seen (only if this is a client)
+        self.resume = None
+        # Files being sent (transfer id -> fileSenderThread), relayed (only if this is host) and received
+        self.uploads:dict = {}
+        self.transfers = transferTable()
+        self.downloads = downloadsData()
+        # Direct messages waiting for users who disconnected (only if this is host)
+        self.mailbox = mailboxData()
+        # Socket object of the chat session (server socket if host)
+        self.socket = None
+        # Connections handler thread (only if this is host)
+        self.conhandler = None
+        # Chat server name (only if this is host)
+        self.servername:str = 'Debug'
+        # Shared ssl contexts and client sessions
+        self.tls = tlsConfig()
+
+# eventSink() : Object
+# Desc: receives everything the networking core wants to show to the
+# user. This base class ignores all of it; the GUI and the headless
+# console provide their own sinks. Methods can be called from any
+# network thread.
+class eventSink():
+    # history()
+    # Params: self, text - text to add to the chat history
+    # Desc: shows text in the chat history
+    def history(self, text:str):
+        pass
+
+    # userlist()
+    # Params: self, roster - rosterData of the chat session
+    # Desc: the users list changed, roster.text() is the list to show
+    def userlist(self, roster):
+        pass
+
+    # closed()
+    # Params: self
+    # Desc: the host asked us to close the connection
+    def closed(self):
+        pass
+
+# clientRegistry() : Object
+# Desc: client handlers by connection id, and by username if asked to,
+# in the order they were added. Adding, removing, renaming and looking
+# up take the lock for O(1) work. Broadcasts iterate snapshot(), a
+# tuple that is only rebuilt after a change and never under the lock,
+# so sending to a thousand clients neither copies the list for every
+# message nor holds up clients that connect meanwhile.
+class clientRegistry():
+    # __init__()
+    # Params: names - keep the username index
+    # Desc: class init function
+    def __init__(self, names:bool = True):
+        self.lock = threading.Lock() # guards the indexes, held for O(1) work only
+        self.handlers = {} # connection id -> handler
+        self.names = {} if names else None # username -> {handler: None} of the clients with that username
+        self.version = 0 # bumped by every change
+        self.cached = () # handlers as of the last snapshot, None after a change
+
+    # add()
+    # Params: self, handler - client handler, gets a connection id if it has none
+    # Desc: adds a handler
+    def add(self, handler):
+        if handler.connid == None:
+            handler.connid = next(connectionIds)
+        with self.lock:
+            self.handlers[handler.connid] = handler
+            if self.names != None:
+                self.names.setdefault(handler.username,{})[handler] = None
+            self.changed()
+
+    # remove()
+    # Params: self, handler - client handler
+    # Desc: removes a handler. Returns False if it was not added.
+    def remove(self, handler) -> bool:
+        with self.lock:
+            if self.handlers.get(handler.connid) is not handler:
+                return False
+            del self.handlers[handler.connid]
+            if self.names != None:
+                self.unname(handler)
+            self.changed()
+            return True
+
+    # rename()
+    # Params: self, handler - client handler, username - its new username
+    # Desc: changes the username of a handler and moves it in the index
+    def rename(self, handler, username:str):
+        with self.lock:
+            indexed = self.names != None and self.handlers.get(handler.connid) is handler
+            if indexed:
+                self.unname(handler)
+            handler.username = username
+            if indexed:
+                self.names.setdefault(username,{})[handler] = None
+
+    # unname()
+    # Params: self, handler - client handler
+    # Desc: takes a handler out of the username index. Called with the lock held.
+    def unname(self, handler):
+        named = self.names.get(handler.username)
+        if named != None:
+            named.pop(handler,None)
+            if len(named) == 0:
+                del self.names[handler.username]
+
+    # changed()
+    # Params: self
+    # Desc: drops the snapshot after a change. Called with the lock held.
+    def changed(self):
+        self.version += 1
+        self.cached = None
+
+    # get()
+    # Params: self, connid - connection id
+    # Desc: returns the handler of a connection id, or None
+    def get(self, connid:int):
+        return self.handlers.get(connid)
+
+    # named()
+    # Params: self, username - username to look for
+    # Desc: returns the handlers of the clients with a username, oldest first
+    def named(self, username:str) -> list:
+        with self.lock:
+            return list(self.names.get(username,()))
+
+    # snapshot()
+    # Params: self
+    # Desc: returns the handlers as a tuple that later changes do not touch
+    def snapshot(self) -> tuple:
+        snap = self.cached
+        if snap == None:
+            version = self.version
+            snap = tuple(self.handlers.values()) # copied in one step while holding the GIL, no lock needed
+            with self.lock:
+                if self.version == version: # nothing changed meanwhile, keep it for the next broadcast
+                    self.cached = snap
+        return snap
+
+    # clear()
+    # Params: self
+    # Desc: removes every handler
+    def clear(self):
+        with self.lock:
+            self.handlers = {}
+            if self.names != None:
+                self.names = {}
+            self.changed()
+
+    # __iter__()
+    # Params: self
+    # Desc: iterates a snapshot of the handlers
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    # __len__()
+    # Params: self
+    # Desc: returns the number of handlers
+    def __len__(self) -> int:
+        return len(self.handlers)
+
+# =================
+# TLS Configuration
+# =================
+# The server and client ssl contexts are created once and shared by
+# every connection. The certificate files are checked for changes at
+# most every tlsReloadCheck seconds and loaded again into the same
+# context, so session tickets issued before a reload stay valid.
+
+serverCertFile:str = './srv/certificate.pem'
+serverKeyFile:str = './srv/key.pem'
+clientCertFile:str = './cli/certificate.pem'
+clientKeyFile:str = './cli/key.pem'
+tlsReloadCheck:float = 2.0 # seconds between checks for changed certificate files
+
+# tlsConfig() : Object
+# Desc: holds the shared ssl contexts and the sessions of past client connections
+class tlsConfig():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.lock = threading.Lock() # guards the contexts
+        self.contexts = {} # 'server'/'client' -> [ssl context, certificate file stamp, time of last check]
+        self.sessions = {} # (host ip, port) -> ssl session of the last connection to that host
+
+    # certFiles()
+    # Params: self, side - 'server' or 'client'
+    # Desc: returns the (peer certificate, certificate, key) files of a side
+    def certFiles(self, side:str) -> tuple:
+        if side == 'server':
+            return (clientCertFile, serverCertFile, serverKeyFile)
+        return (serverCertFile, clientCertFile, clientKeyFile)
+
+    # context()
+    # Params: self, side - 'server' or 'client'
+    # Desc: returns the shared ssl context of a side. Creates it on first
+    # use and reloads the certificates when the files have changed.
+    def context(self, state:ConData, side:str):
+        with self.lock:
+            entry = self.contexts.get(side)
+            now = time.monotonic()
+            if entry != None and now - entry[2] < tlsReloadCheck: # checked recently
+                return entry[0]
+            files = self.certFiles(side)
+            stamp = tuple((os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+            if entry == None: # first use, create the context
+                dbg(state, 'ssl setup...','SSL')
+                sslctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER if side == 'server' else ssl.PROTOCOL_TLS_CLIENT)
+                sslctx.check_hostname = False
+                sslctx.verify_mode = ssl.CERT_REQUIRED
+                dbg(state, 'load default certs', 'SSL')
+                sslctx.load_default_certs()
+                self.loadCerts(state, sslctx, files)
+                entry = [sslctx, stamp, now]
+                self.contexts[side] = entry
+            elif stamp != entry[1]: # certificate files changed
+                dbg(state, 'reloading '+side+' certificates','SSL')
+                try:
+                    self.loadCerts(state, entry[0], files)
+                    entry[1] = stamp
+                except (ssl.SSLError, OSError) as err: # files are probably still being written
+                    dbg(state, 'could not reload certificates: '+str(err),'error')
+            entry[2] = now
+            return entry[0]
+
+    # loadCerts()
+    # Params: self, sslctx - ssl context, files - (peer certificate, certificate, key)
+    # Desc: loads the certificate files into an ssl context
+    def loadCerts(self, state:ConData, sslctx, files:tuple):
+        sslctx.load_verify_locations(files[0])
+        dbg(state, 'load cert chain','SSL')
+        sslctx.load_cert_chain(certfile=files[1], keyfile=files[2])
+
+    # keepSession()
+    # Params: self, addr - (host ip, port), sock - connected ssl socket
+    # Desc: remembers the session of a client connection so the next
+    # connection to the same host can resume it
+    def keepSession(self, addr:tuple, sock):
+        session = getattr(sock, 'session', None)
+        if session != None:
+            self.sessions[addr] = session
+
+# =============
+# Wire Protocol
+# =============
+# Every message sent over a connection is framed as:
+#   [payload length: 4 bytes, big endian][message type: 1 byte][payload]
+# The message type is the same '0' (command) / '1' (regular message)
+# character that used to prefix the raw text. Payloads are utf-8.
+# Broadcasts to a lobby are wrapped in a '2' (sequenced) frame whose
+# payload is '[sequence number] [type][payload]' of the message, a
+# 'z' frame holds a compressed frame (see Compression below) and an 'f'
+# frame a chunk of a file (see File Transfers). 'c' (binary command)
+# and '3' (binary sequenced) frames are described under Commands.
+# Their payloads and those of 'f' frames are kept as bytes.
+
+frameHeader = struct.Struct('!IB') # frame header layout (payload length, message type)
+maxFrameSize:int = 1048576 # largest payload accepted from a peer (1 MiB)
+recvBufferSize:int = 65536 # size of the reusable receive buffer
+binaryFrames:tuple = ('c','3','f') # message types whose payload is not text
+
+# Compression
+# A client asks for compression with '+zlib' in its greeting and the
+# host agrees with '0comp_on zlib'. From then on every frame with a
+# payload of compressThreshold bytes or more goes through one zlib
+# stream per direction and is sent as a 'z' frame whose payload is the
+# compressed frame. The stream lives as long as the connection, so
+# usernames and commands seen before compress to a few bytes.
+compressEnable:bool = True # clients ask for compression
+compressThreshold:int = 128 # smaller payloads are not worth compressing
+compressLevel:int = 6 # zlib level, 1 is fastest, 9 is smallest
+compressDictionary:bytes = (b'ulist_snapshot ulist_join ulist_leave ulist_rename seq_start ping pong '
+                            b' has joined the chat.\n disconnected!\n Welcome ! You are in lobby ') # primes both streams
+
+# frameError() : Exception
+# Desc: raised when a peer sends data that is not a valid frame
+class frameError(Exception):
+    pass
+
+# encodeFrame()
+# Params: mtype - message type ('0', '1', '2', ...), data - message payload
+# Desc: builds a single wire frame out of a message type and payload
+def encodeFrame(mtype:str, data) -> bytes:
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return frameHeader.pack(len(data), ord(mtype)) + data
+
+# sendFrame()
+# Params: sock - socket object, mtype - message type, data - message payload
+# Desc: frames a message and writes all of it to the socket
+def sendFrame(sock, mtype:str, data):
+    sock.sendall(encodeFrame(mtype, data))
+
+# frameCompressor() : Object
+# Desc: compressing side of a connection's zlib stream
+class frameCompressor():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.deflater = zlib.compressobj(compressLevel, zdict=compressDictionary) # lives as long as the connection
+
+    # pack()
+    # Params: self, frame - encoded frame
+    # Desc: returns the frame to write to the socket, compressed if it is
+    # large enough. Frames have to be packed in the order they are sent.
+    def pack(self, frame) -> bytes:
+        if len(frame) - frameHeader.size < compressThreshold or frame[4] == ord('f'): # not worth it, files are often compressed already
+            return frame
+        data = self.deflater.compress(frame) + self.deflater.flush(zlib.Z_SYNC_FLUSH) # whole frame, decodable on its own
+        return frameHeader.pack(len(data), ord('z')) + data
+
+# frameDecoder() : Object
+# Desc: incremental frame decoder. Bytes read from the socket go into a
+# reusable receive buffer and every complete frame in it is returned,
+# so a burst of messages is handled with a single recv call. Partial
+# frames are kept until the rest of the bytes arrive.
+class frameDecoder():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.pending = bytearray() # bytes of frames that are not complete yet
+        self.rbuf = bytearray(recvBufferSize) # reusable receive buffer
+        self.rview = memoryview(self.rbuf) # view used to slice the receive buffer without copying
+        self.backlog = [] # frames already decoded but not handled yet
+        self.inflater = None # decompressing side of the zlib stream, once compression was agreed on
+        self.received = 0 # bytes received from the peer
+
+    # inflate()
+    # Params: self
+    # Desc: accepts compressed frames from now on
+    def inflate(self):
+        if self.inflater == None:
+            self.inflater = zlib.decompressobj(zdict=compressDictionary)
+
+    # unpack()
+    # Params: self, data - payload of a 'z' frame
+    # Desc: returns the (type, payload) of the frame inside a compressed frame
+    def unpack(self, data) -> tuple:
+        if self.inflater == None: # compression was not agreed on
+            raise frameError('unexpected compressed frame')
+        try:
+            inner = self.inflater.decompress(data, frameHeader.size + maxFrameSize)
+        except zlib.error as err:
+            raise frameError('invalid compressed frame: '+str(err))
+        if len(self.inflater.unconsumed_tail) > 0 or len(inner) < frameHeader.size: # too large or cut off
+            raise frameError('invalid compressed frame')
+        length, mtype = frameHeader.unpack_from(inner)
+        if chr(mtype) not in ('0','1','2','c','3') or len(inner) != frameHeader.size + length:
+            raise frameError('invalid compressed frame')
+        if chr(mtype) in binaryFrames:
+            return (chr(mtype), inner[frameHeader.size:])
+        return (chr(mtype), inner[frameHeader.size:].decode('utf-8', errors='replace'))
+    
+    # feed()
+    # Params: self, data - bytes received from the peer
+    # Desc: adds data to the decoder and returns a list of (type, payload)
+    # tuples. Complete frames are read straight from data through a
+    # memoryview; only the bytes of a frame that is not complete yet are
+    # copied into pending, and data is appended to them until it is.
+    def feed(self, data) -> list:
+        buffered = len(self.pending) > 0
+        if buffered: # finish the partial frame first
+            self.pending += data
+            view = memoryview(self.pending)
+        else:
+            view = memoryview(data)
+        frames = []
+        offset = 0
+        try:
+            size = len(view)
+            while size - offset >= frameHeader.size: # while a full header is available
+                length, mtype = frameHeader.unpack_from(view, offset) # read header
+                if length > maxFrameSize: # peer is sending garbage
+                    raise frameError('frame too large: '+str(length))
+                mtype = chr(mtype)
+                if mtype not in ('0','1','2','3','c','z','f'): # unknown message type
+                    raise frameError('unknown frame type: '+str(ord(mtype)))
+                start = offset + frameHeader.size
+                end = start + length
+                if end > size: # payload not fully received yet
+                    break
+                if mtype == 'z': # compressed frame
+                    frames.append(self.unpack(view[start:end]))
+                elif mtype in binaryFrames: # file chunk or binary command, not text
+                    frames.append((mtype, bytes(view[start:end]))) # the receive buffer is reused
+                else:
+                    frames.append((mtype, str(view[start:end], 'utf-8', 'replace')))
+                offset = end
+            rest = bytes(view[offset:]) if not buffered and offset < size else None
+        finally:
+            view.release() # pending can be resized again
+        if buffered:
+            del self.pending[:offset] # drop consumed bytes
+        elif rest != None: # keep the partial frame
+            self.pending += rest
+        return frames
+    
+    # recvFrom()
+    # Params: self, sock - socket to read from
+    # Desc: reads whatever is available on the socket and returns the
+    # complete frames. Returns None when the peer closed the connection.
+    def recvFrom(self, sock):
+        n = sock.recv_into(self.rbuf) # single read into the reusable buffer
+        if n == 0: # socket closed
+            return None
+        self.received += n
+        return self.feed(self.rview[:n])
+
+# recvFirstFrame()
+# Params: sock - blocking socket object, decoder - frameDecoder of the connection,
+# timeout - seconds the whole frame may take to arrive (None waits forever)
+# Desc: blocks until the first complete frame arrives and returns it.
+# Frames that arrived together with it stay queued in decoder.backlog.
+# Raises socket.timeout when the frame does not arrive in time.
+def recvFirstFrame(sock, decoder:frameDecoder, timeout:float = None):
+    deadline = time.monotonic() + timeout if timeout != None else None
+    frames = []
+    while len(frames) == 0:
+        if deadline != None: # a client trickling bytes can not extend the deadline
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('timed out waiting for the first frame')
+            sock.settimeout(remaining)
+        frames = decoder.recvFrom(sock)
+        if frames is None: # socket closed before a full frame arrived
+            return None
+    decoder.backlog = frames[1:] # keep the rest for the client handler
+    return frames[0]
+
+# outboxCounters() : Object
+# Desc: counters and slow consumer policy of a connection's outbound queue
+class outboxCounters():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.frames = 0 # frames waiting in the queue
+        self.depth = 0 # bytes waiting in the queue
+        self.peak = 0 # highest number of bytes that were waiting
+        self.sent = 0 # frames written to the socket
+        self.dropped = 0 # frames dropped because the client was slow
+        self.slowSince = None # time the client became slow or None
+
+    # admit()
+    # Params: self, depth - bytes currently waiting in the queue
+    # Desc: decides what to do with a new frame. Returns 'queue', 'drop'
+    # or 'disconnect'.
+    def admit(self, depth:int) -> str:
+        if depth > self.peak:
+            self.peak = depth
+        if self.slowSince != None and depth <= outboxLowWater: # drained, not slow anymore
+            self.slowSince = None
+        elif self.slowSince == None and depth >= outboxHighWater: # just became slow
+            self.slowSince = time.monotonic()
+        if self.slowSince == None:
+            return 'queue'
+        if slowClientPolicy == 'disconnect' or time.monotonic() - self.slowSince > slowClientGrace:
+            return 'disconnect'
+        self.dropped += 1
+        return 'drop'
+
+# acceptCounters() : Object
+# Desc: counts connections in each stage of being admitted to the chat
+# session and how the admissions ended
+class acceptCounters():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.lock = threading.Lock() # counters are updated from several threads
+        self.inflight = {'queued':0, 'handshake':0, 'greeting':0} # connections currently in each stage
+        self.totals = {'accepted':0, 'joined':0, 'declined':0, 'timedout':0, 'failed':0} # admissions so far
+
+    # move()
+    # Params: self, old - stage left (or None), new - stage entered (or None)
+    # Desc: moves a connection from one stage to the next
+    def move(self, old, new):
+        with self.lock:
+            if old != None:
+                self.inflight[old] -= 1
+            if new != None:
+                self.inflight[new] += 1
+
+    # count()
+    # Params: self, total - name of the total to increase
+    # Desc: counts a finished admission
+    def count(self, total:str):
+        with self.lock:
+            self.totals[total] += 1
+
+    # report()
+    # Params: self
+    # Desc: returns a text report of the counters
+    def report(self) -> str:
+        with self.lock:
+            return ('Connections being admitted: '+', '.join(k+' '+str(v) for k,v in self.inflight.items())+'\n'
+                    'Admissions so far: '+', '.join(k+' '+str(v) for k,v in self.totals.items())+'\n')
+
+# ========
+# Commands
+# ========
+# Commands go to a peer that speaks protocol version 1 as text in a '0'
+# frame:
+#   [command] [field] [field] ...
+# and to a peer that speaks version 2 as a binary 'c' frame:
+#   [opcode: 1 byte][fixed size fields and string lengths][strings]
+# A client asks for version 2 with '+v2' in its greeting and the host
+# agrees with '0proto_on 2' (like compression), so old clients and old
+# hosts go on speaking text. Greetings and the commands between linked
+# hosts stay text. commandSpecs has the opcode and field types of
+# every command:
+#   I - unsigned 32 bit, Q - unsigned 64 bit, q - signed 64 bit,
+#   d - double, x - 8 byte id (16 hex digits as text),
+#   n - username, u - username escaped in the text form,
+#   s - string (utf-8 after a 2 byte length)
+# Fields after a '*' repeat until the end of the command. In the text
+# form spaces in usernames become '_', 'u' usernames have '%' and spaces
+# escaped like in a '+v2' greeting, and a string that is the last
+# field takes the rest of the line. Received commands of either form
+# are decoded into the same list of fields and handled through
+# commandTable (see Functions), keyed by opcode.
+# Lobby broadcasts go to version 2 clients as '3' frames:
+#   [sequence number: 8 bytes][type: 1 byte][payload of the message]
+# instead of '2' frames, with the payload of a command in binary.
+
+commandProtocol:int = 2 # newest protocol version clients ask for and hosts agree to (1 keeps commands text)
+commandSpecs:list = [(1,'ping',''), (2,'pong',''), (3,'usern_update','n'), (4,'proto_on','I'), (5,'comp_on','s'),
+                     (6,'seq_start','sQ'), (7,'ulist_join','IIn'), (8,'ulist_leave','II'), (9,'ulist_rename','IIn'),
+                     (10,'ulist_snapshot','I*In'), (11,'ulist_asknew','*I'), (12,'hist_ask','sd'), (13,'srch_ask','I*s'),
+                     (14,'file_offer','xQns',(2,)), (15,'file_done','x'), (16,'file_ack','xq'), (17,'file_resume','x'),
+                     (18,'file_at','xq'), (19,'sock_shutreq',''), (20,'msg_send','us')] # (opcode, name, field types, fields a client leaves out of its text form)
+fieldCodes:dict = {'I':'I', 'Q':'Q', 'q':'q', 'd':'d', 'x':'8s', 'n':'H', 'u':'H', 's':'H'} # struct code of every field type, the length for strings
+sequenceHeader = struct.Struct('!QB') # '3' frame header layout (sequence number, message type)
+
+# textId()
+# Params: text - id field of a text command
+# Desc: returns the id if it is 16 hex digits, raises ValueError otherwise
+def textId(text:str) -> str:
+    if re.fullmatch('[0-9a-f]{16}', text) == None:
+        raise ValueError('invalid id '+text)
+    return text
+
+# escapeName()
+# Params: username - username to escape
+# Desc: returns the username with '%' and spaces escaped, so it is one
+# word that urllib.parse.unquote turns back into the username
+def escapeName(username:str) -> str:
+    return username.replace('%','%25').replace(' ','%20')
+
+fieldTexts:dict = {'I':int, 'Q':int, 'q':int, 'd':float, 'x':textId, 'n':str, 'u':urllib.parse.unquote, 's':str} # reads a field of a text command
+
+# commandLayout() : Object
+# Desc: binary layout of a run of command fields. The fixed size fields
+# and the string lengths are packed with one struct, the strings follow.
+class commandLayout():
+    # __init__()
+    # Params: fields - field types
+    # Desc: class init function
+    def __init__(self, fields:str):
+        self.fields = fields # field types
+        self.struct = struct.Struct('!'+''.join(fieldCodes[f] for f in fields)) # fixed size part
+        self.strings = [i for i,f in enumerate(fields) if f in 'nus'] # fields that are strings
+        self.ids = [i for i,f in enumerate(fields) if f == 'x'] # fields that are ids
+        self.reads = [(i,fieldTexts[f]) for i,f in enumerate(fields) if f not in 'ns'] # fields that are not strings in the text form
+
+    # pack()
+    # Params: self, values - field values
+    # Desc: returns the binary form of the fields
+    def pack(self, values) -> bytes:
+        fixed = list(values)
+        strings = []
+        for i in self.strings:
+            data = str(values[i]).encode('utf-8')
+            if len(data) > 65535:
+                raise frameError('command field too long')
+            fixed[i] = len(data)
+            strings.append(data)
+        for i in self.ids:
+            fixed[i] = bytes.fromhex(values[i])
+        return self.struct.pack(*fixed) + b''.join(strings)
+
+# commandSpec() : Object
+# Desc: a command and how its fields are encoded
+class commandSpec():
+    # __init__()
+    # Params: opcode - opcode of the binary form, name - name of the text
+    # form, fields - field types, omitted - fields a client leaves out of
+    # the text form it sends the host
+    # Desc: class init function
+    def __init__(self, opcode:int, name:str, fields:str, omitted:tuple = ()):
+        (head,star,repeat) = fields.partition('*')
+        self.opcode = opcode # first byte of the binary form
+        self.name = name # first word of the text form
+        self.prefix = bytes([opcode])
+        self.head = commandLayout(head) # fields sent once
+        self.repeat = commandLayout(repeat) if star != '' else None # fields repeated until the end
+        self.rest = head.endswith('s') and self.repeat == None # the last string takes the rest of the line
+        self.omitted = omitted
+        # decoding: one struct reads every fixed size field after the opcode
+        self.unpacker = struct.Struct('!x'+''.join(fieldCodes[f] for f in head))
+        self.plain = self.repeat == None and len(self.head.strings) == 0 and len(self.head.ids) == 0 # only fixed size fields
+        self.tail = self.repeat == None and self.head.strings == [len(head)-1] and len(self.head.ids) == 0 # one string, the last field
+
+    # fieldType()
+    # Params: self, index - field number
+    # Desc: returns the type of a field
+    def fieldType(self, index:int) -> str:
+        count = len(self.head.fields)
+        if index < count:
+            return self.head.fields[index]
+        return self.repeat.fields[(index - count) % len(self.repeat.fields)]
+
+    # binary()
+    # Params: self, fields - field values
+    # Desc: returns the payload of the 'c' frame of the command
+    def binary(self, fields) -> bytes:
+        count = len(self.head.fields)
+        parts = [self.prefix, self.head.pack(fields[:count])]
+        if self.repeat != None:
+            size = len(self.repeat.fields)
+            for i in range(count, len(fields), size):
+                parts.append(self.repeat.pack(fields[i:i+size]))
+        return b''.join(parts)
+
+    # text()
+    # Params: self, fields - field values, up - sent by a client to the host
+    # Desc: returns the payload of the '0' frame of the command
+    def text(self, fields, up:bool = False) -> str:
+        words = [self.name]
+        for i,value in enumerate(fields):
+            if up and i in self.omitted:
+                continue
+            kind = self.fieldType(i)
+            if kind == 'n':
+                words.append(str(value).replace(' ','_'))
+            elif kind == 'u':
+                words.append(escapeName(str(value)))
+            else:
+                words.append(str(value))
+        return ' '.join(words)
+
+    # decode()
+    # Params: self, data - payload of a 'c' frame
+    # Desc: returns the field values of a binary command
+    def decode(self, data:bytes) -> list:
+        try:
+            if self.plain: # the struct checks the length too
+                return list(self.unpacker.unpack(data))
+            fields = list(self.unpacker.unpack_from(data))
+            if self.tail: # the string is the rest of the command
+                start = self.unpacker.size
+                if start + fields[-1] != len(data):
+                    raise frameError('command has the wrong length')
+                fields[-1] = data[start:].decode('utf-8', 'replace')
+                return fields
+            offset = self.unpacker.size
+            for i in self.head.strings: # checked against the length at the end
+                end = offset + fields[i]
+                fields[i] = data[offset:end].decode('utf-8', 'replace')
+                offset = end
+            for i in self.head.ids:
+                fields[i] = fields[i].hex()
+            if self.repeat != None:
+                repeat = self.repeat
+                unpack = repeat.struct.unpack_from
+                size = repeat.struct.size
+                while offset < len(data):
+                    more = list(unpack(data, offset))
+                    offset += size
+                    for i in repeat.strings:
+                        end = offset + more[i]
+                        more[i] = data[offset:end].decode('utf-8', 'replace')
+                        offset = end
+                    for i in repeat.ids:
+                        more[i] = more[i].hex()
+                    fields += more
+        except struct.error: # fewer bytes than the fields take, or more for plain ones
+            raise frameError('command has the wrong length')
+        if offset != len(data): # a string ran past the end, or bytes are left over
+            raise frameError('command has the wrong length')
+        return fields
+
+    # parse()
+    # Params: self, params - words of a text command after its name, up -
+    # sent by a client to the host
+    # Desc: returns the field values of a text command
+    def parse(self, params:list, up:bool = False) -> list:
+        if up:
+            for i in self.omitted:
+                params.insert(i, '')
+        count = len(self.head.fields)
+        if self.rest and len(params) > count:
+            params[count-1:] = [' '.join(params[count-1:])]
+        if self.repeat == None:
+            if len(params) != count:
+                raise frameError('wrong number of fields')
+        elif len(params) < count or (len(params) - count) % len(self.repeat.fields) != 0:
+            raise frameError('wrong number of fields')
+        try: # the words become the fields
+            for i,read in self.head.reads:
+                params[i] = read(params[i])
+            if self.repeat != None:
+                for start in range(count, len(params), len(self.repeat.fields)):
+                    for i,read in self.repeat.reads:
+                        params[start+i] = read(params[start+i])
+        except ValueError as err:
+            raise frameError('invalid field: '+str(err))
+        return params
+
+commandNames:dict = {spec[1]:commandSpec(*spec) for spec in commandSpecs} # name -> commandSpec
+commandCodes:dict = {spec.opcode:spec for spec in commandNames.values()} # opcode -> commandSpec
+heartbeatPayloads:dict = {key:name for name in ('ping','pong') for key in (name,commandNames[name].prefix)} # text and binary heartbeats
+
+# commandFrame()
+# Params: name - command name, fields - field values, proto - protocol
+# version of the peer, up - sent by a client to the host
+# Desc: encodes a command as a 'c' frame, or as a '0' frame for a peer
+# that only speaks text
+def commandFrame(name:str, fields, proto:int = 1, up:bool = False) -> bytes:
+    spec = commandNames[name]
+    if proto >= 2:
+        data = spec.binary(fields)
+        return frameHeader.pack(len(data), ord('c')) + data
+    return encodeFrame('0', spec.text(fields, up))
+
+# decodeCommand()
+# Params: mtype - '0' or 'c', data - payload of the frame, up - sent by a client to the host
+# Desc: returns the (commandSpec, field values) of a received command.
+# Raises frameError when it is not a valid command.
+def decodeCommand(mtype:str, data, up:bool = False) -> tuple:
+    if mtype == 'c':
+        spec = commandCodes.get(data[0]) if len(data) > 0 else None
+        if spec == None:
+            raise frameError('unknown opcode')
+        return (spec, spec.decode(data))
+    params = data.split(' ')
+    spec = commandNames.get(params[0])
+    if spec == None:
+        raise frameError('unknown command '+params[0])
+    return (spec, spec.parse(params[1:], up))
+
+# greetingName()
+# Params: username - username to greet with
+# Desc: returns the username as it is written in a greeting, which is
+# split at spaces. A '+v2' greeting escapes spaces, one without has
+# them replaced like other text commands.
+def greetingName(username:str) -> str:
+    if commandProtocol >= 2:
+        return escapeName(username)
+    return username.replace(' ','_')
+
+# =======
+# Metrics
+# =======
+# Everything that goes through a connection is counted in the
+# metricsData of the ConData state. An update is an addition under a
+# lock on a fixed name; nothing is formatted until the metrics are read
+# with /stats or from the scrape endpoint (see startMetrics), which
+# serves them as plain text in the Prometheus exposition format.
+
+metricsBounds:tuple = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0) # histogram buckets, seconds
+metricsCommands:frozenset = frozenset(['usern_update','ulist_asknew','ulist_join','ulist_leave','ulist_rename','ulist_snapshot',
+                                       'seq_start','comp_on','proto_on','hist_ask','srch_ask','file_offer','file_done','file_ack',
+                                       'file_resume','file_at','sock_shutreq','msg_send','ping','pong']) # timed on their own, the rest as 'other'
+metricsHelp:dict = {'frames_received':('counter','Frames received from peers.'),
+                    'bytes_received':('counter','Bytes received from peers.'),
+                    'frames_sent':('counter','Frames queued to peers.'),
+                    'bytes_sent':('counter','Bytes of the frames queued to peers.'),
+                    'frames_dropped':('counter','Frames dropped because the client was slow.'),
+                    'rate_limited':('counter','Messages dropped by the rate limits.'),
+                    'direct_messages':('counter','Direct messages delivered to a user or kept until they are back.'),
+                    'handshake_seconds':('histogram','Time of the ssl handshake of accepted connections (thread engine).'),
+                    'greeting_seconds':('histogram','Time accepted connections took to send their greeting.'),
+                    'fanout_seconds':('histogram','Time to queue a broadcast on every member of a lobby.'),
+                    'command_seconds':('histogram','Time to handle a received frame, by command.')}
+
+# histogramData() : Object
+# Desc: counts of observations in the metricsBounds buckets
+class histogramData():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.counts = [0] * (len(metricsBounds) + 1) # per bucket, the last one is above every bound
+        self.total = 0.0 # sum of the observations
+        self.count = 0 # number of observations
+
+    # observe()
+    # Params: self, value - observed value
+    # Desc: adds a value to its bucket
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(metricsBounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+# metricsData() : Object
+# Desc: counters and histograms of a chat session
+class metricsData():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.lock = threading.Lock() # updated from every network thread
+        self.counters = collections.defaultdict(int) # name -> value
+        self.histograms = {} # (name, label) -> histogramData
+
+    # count()
+    # Params: self, name - counter name, amount - how much to add
+    # Desc: adds to a counter
+    def count(self, name:str, amount:int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    # observe()
+    # Params: self, name - histogram name, value - observed value, label - command name or None
+    # Desc: adds a value to a histogram
+    def observe(self, name:str, value:float, label:str = None):
+        with self.lock:
+            hist = self.histograms.get((name,label))
+            if hist == None:
+                hist = self.histograms[(name,label)] = histogramData()
+            hist.observe(value)
+
+    # received()
+    # Params: self, frames - frames received, nbytes - bytes they came in
+    # Desc: counts a read from a connection
+    def received(self, frames:int, nbytes:int):
+        with self.lock:
+            self.counters['frames_received'] += frames
+            self.counters['bytes_received'] += nbytes
+
+    # sent()
+    # Params: self, nbytes - size of the frame
+    # Desc: counts a frame queued to a connection
+    def sent(self, nbytes:int):
+        with self.lock:
+            self.counters['frames_sent'] += 1
+            self.counters['bytes_sent'] += nbytes
+
+    # snapshot()
+    # Params: self
+    # Desc: returns copies of the (counters, histograms)
+    def snapshot(self) -> tuple:
+        with self.lock:
+            return (dict(self.counters), {key:(list(h.counts),h.total,h.count) for key,h in self.histograms.items()})
+
+# commandName()
+# Params: mtype - message type, data - message payload
+# Desc: returns the name a received frame is timed under
+def commandName(mtype:str, data) -> str:
+    if mtype == '0':
+        name = data.partition(' ')[0]
+        return name if name in metricsCommands else 'other'
+    if mtype == 'c':
+        spec = commandCodes.get(data[0]) if len(data) > 0 else None
+        return spec.name if spec != None else 'other'
+    return {'1':'message', '2':'broadcast', '3':'broadcast', 'f':'file_chunk'}.get(mtype, 'other')
+
+# metricLines()
+# Params: name - metric name, kind - 'counter', 'gauge' or 'histogram',
+# helptext - description, samples - list of (labels, value)
+# Desc: returns the exposition lines of a metric
+def metricLines(name:str, kind:str, helptext:str, samples:list) -> list:
+    name = 'chat_'+name+('_total' if kind == 'counter' else '')
+    lines = ['# HELP '+name+' '+helptext, '# TYPE '+name+' '+kind]
+    for labels,value in samples:
+        lines.append(name+('{'+labels+'}' if labels != '' else '')+' '+str(value))
+    return lines
+
+# metricsText()
+# Params: none
+# Desc: returns the metrics of the chat session as plain text
+def metricsText(state:ConData) -> str:
+    (counters, histograms) = state.metrics.snapshot()
+    lines = []
+    for name,(kind,helptext) in metricsHelp.items():
+        if kind == 'counter':
+            lines += metricLines(name,kind,helptext,[('',counters.get(name,0))])
+            continue
+        keys = sorted([key for key in histograms if key[0] == name], key=lambda key: key[1] or '')
+        if len(keys) == 0: # nothing observed yet
+            continue
+        lines += metricLines(name,kind,helptext,[])
+        for key in keys:
+            (counts,total,count) = histograms[key]
+            labels = 'command="'+key[1]+'"' if key[1] != None else ''
+            cumulative = 0
+            for bound,n in zip(metricsBounds + ('+Inf',), counts): # buckets count everything up to their bound
+                cumulative += n
+                lines.append('chat_'+name+'_bucket{'+(labels+',' if labels != '' else '')+'le="'+str(bound)+'"} '+str(cumulative))
+            braces = '{'+labels+'}' if labels != '' else ''
+            lines.append('chat_'+name+'_sum'+braces+' '+repr(total))
+            lines.append('chat_'+name+'_count'+braces+' '+str(count))
+    # gauges read from the state when asked for
+    clients = [tc for tc in state.serverclients.snapshot() if tc.peer == None]
+    depths = [tc.counters.depth for tc in clients]
+    lines += metricLines('clients','gauge','Clients connected.',[('',len(clients))])
+    lines += metricLines('lobbies','gauge','Open lobbies.',[('',len(state.lobbies))])
+    lines += metricLines('queue_bytes','gauge','Bytes waiting in the outbound queues (worker clients as last reported).',[('',sum(depths))])
+    lines += metricLines('queue_bytes_max','gauge','Bytes waiting in the longest outbound queue (worker clients as last reported).',[('',max(depths, default=0))])
+    if state.conhandler != None: # the accept pipeline of the server engine
+        accepts = state.conhandler.counters
+        with accepts.lock:
+            lines += metricLines('accepts','counter','Connections accepted, by how their admission ended.',
+                                 [('result="'+k+'"',v) for k,v in accepts.totals.items()])
+            lines += metricLines('admitting','gauge','Connections being admitted, by stage.',
+                                 [('stage="'+k+'"',v) for k,v in accepts.inflight.items()])
+    return '\n'.join(lines)+'\n'
+
+# metricsRequest() : Object
+# http.server.BaseHTTPRequestHandler
+# Desc: answers a scrape of the metrics endpoint
+class metricsRequest(http.server.BaseHTTPRequestHandler):
+    # do_GET()
+    # Params: self
+    # Desc: sends the metrics as plain text
+    def do_GET(self):
+        if self.path not in ['/','/metrics']:
+            self.send_error(404)
+            return
+        body = metricsText(self.server.state).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # log_message()
+    # Params: self, format - message format, args - format arguments
+    # Desc: scrapes go to the debug output instead of stderr
+    def log_message(self, format, *args):
+        dbg(self.server.state, 'metrics scrape: '+format, 'trace', *args)
+
+# metricsServerThread() : THREAD
+# threading.Thread
+# Desc: serves the metrics endpoint of the host
+class metricsServerThread(threading.Thread):
+    # __init__()
+    # Params: port - port number, iph - ip address to bind to
+    # Desc: class init function
+    def __init__(self,state,port,iph):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = http.server.ThreadingHTTPServer((iph,port), metricsRequest) # raises if the port is taken
+        self.server.daemon_threads = True
+        self.server.state = state # read by metricsRequest
+
+    # stop()
+    # Params: self
+    # Desc: stops serving and closes the socket
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        self.server.serve_forever(0.5)
+
+# startMetrics()
+# Params: port - port number, iph - ip address to bind to (default: this machine only)
+# Desc: starts the metrics endpoint at http://[iph]:[port]/metrics.
+# Returns True on success.
+def startMetrics(state:ConData, port:int, iph:str = '127.0.0.1') -> bool:
+    try:
+        state.metricsServer = metricsServerThread(state,port,iph)
+    except OSError as err:
+        state.sink.history('Metrics endpoint could not be started on '+str(iph)+':'+str(port)+'!\n'+str(err)+'\n')
+        return False
+    state.metricsServer.start()
+    state.sink.history('Metrics are served on http://'+str(iph)+':'+str(port)+'/metrics\n')
+    return True
+
+# =========
+# Profiling
+# =========
+# /profile (and headless --profile) starts a sampling profiler over
+# every thread of the process: the network threads, the event loop and
+# the GUI. Every profileInterval seconds it looks at what each thread
+# is running and charges the cpu time the thread used since the last
+# look to the pipeline stage the thread is in, which is the innermost
+# function on its stack that belongs to one of profileStages ('self'
+# time). Every stage anywhere on the stack is charged too ('total'
+# time, e.g. dispatch includes the fan-out it started). A thread found
+# waiting (in select, on a lock or a queue) is not where its cpu time
+# went, so that time is charged at the next look that finds it busy.
+# When stopped, a report ranking the stages, the thread classes and
+# the hottest functions is written under profileDir. Worker processes
+# are not profiled, only the process the command was given in.
+
+profileDir:str = './profiles'
+profileInterval:float = 0.01 # seconds between samples
+profileStages:dict = {'tls':'ssl encryption, decryption and handshakes',
+                      'decode':'framing, compression and decoding of frames',
+                      'dispatch':'handling of received frames and commands',
+                      'fanout':'queueing broadcasts on the members of a lobby',
+                      'write':'writing queued frames to the sockets',
+                      'history':'chat history log and search index',
+                      'display':'showing the chat history (GUI or console)',
+                      'other':'everything else'}
+profileWaits:frozenset = frozenset([('selectors.py','select'),('threading.py','wait'),('threading.py','_wait_for_tstate_lock'),
+                                    ('queue.py','get'),('socket.py','accept'),('chatcore.py','wait')]) # a thread in one of these is idle
+profileCpuClock:bool = hasattr(time,'pthread_getcpuclockid') # per thread cpu time, else every busy look counts profileInterval
+
+# profileStage()
+# Params: code - code object of a stack frame
+# Desc: returns the pipeline stage a function belongs to, 'idle' for a
+# function that waits, or None
+def profileStage(code) -> str:
+    qualname = getattr(code,'co_qualname',code.co_name)
+    owner = qualname.partition('.')[0]
+    filename = os.path.basename(code.co_filename)
+    if (filename,code.co_name) in profileWaits:
+        return 'idle'
+    if filename in ['ssl.py','sslproto.py']:
+        return 'tls'
+    if owner in ['frameDecoder','frameCompressor'] or qualname in ['encodeFrame','recvFirstFrame']:
+        return 'decode'
+    if qualname in ['interpretFrame','handleFrame','interpretRelay','allowMessage']:
+        return 'dispatch'
+    if qualname in ['sendToAll','queueToAll','sendChatToAll','castChunk','relaySend']:
+        return 'fanout'
+    if qualname in ['clientHandlerThread.flush','asyncClientHandler.writeFrame','_SelectorSocketTransport.write','_SelectorSocketTransport._write_ready']:
+        return 'write'
+    if owner in ['historyLog','searchIndex','searchIndexThread']:
+        return 'history'
+    if owner.endswith('Sink'): # eventSink and the GUI's and console's sinks
+        return 'display'
+    return None
+
+# profilerThread() : THREAD
+# threading.Thread
+# Desc: samples the stacks of every thread until stopped or until
+# duration seconds have passed, then writes the report
+class profilerThread(threading.Thread):
+    # __init__()
+    # Params: duration - seconds to profile for (None until stopped)
+    # Desc: class init function
+    def __init__(self,state,duration):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # store connection data
+        self.duration = duration # seconds to profile for, or None
+        self.stopped = threading.Event() # set to stop profiling
+        self.stages = collections.defaultdict(float) # stage -> seconds as the innermost stage
+        self.within = collections.defaultdict(float) # stage -> seconds anywhere on the stack
+        self.threads = collections.defaultdict(float) # thread class -> seconds
+        self.functions = collections.defaultdict(float) # innermost function -> seconds
+        self.codes = {} # code object -> stage, classified once
+        self.clocks = {} # thread ident -> [cpu clock id, cpu time at the last sample]
+        self.pending = collections.defaultdict(float) # thread ident -> cpu time used while found waiting
+        self.names = {} # thread ident -> thread class
+        self.samples = 0 # stacks charged
+        self.cputime = 0.0 # cpu time the threads used while profiled
+        self.elapsed = 0.0 # seconds profiled
+        self.path = None # report file once written
+
+    # stop()
+    # Params: self
+    # Desc: stops profiling and waits for the report to be written.
+    # Returns the path of the report or None.
+    def stop(self) -> str:
+        self.stopped.set()
+        if self.is_alive() and self != threading.current_thread():
+            self.join()
+        return self.path
+
+    # cpu()
+    # Params: self, ident - thread ident
+    # Desc: returns the cpu time a thread used since the last sample
+    def cpu(self, ident:int) -> float:
+        if not profileCpuClock: # no way to tell, take it as busy
+            return profileInterval
+        clock = self.clocks.get(ident)
+        try:
+            if clock == None: # first sample of the thread is the starting point
+                clock = self.clocks[ident] = [time.pthread_getcpuclockid(ident), 0.0]
+                clock[1] = time.clock_gettime(clock[0])
+                return 0.0
+            now = time.clock_gettime(clock[0])
+        except OSError: # thread ended
+            self.clocks.pop(ident, None)
+            return 0.0
+        used = now - clock[1]
+        clock[1] = now
+        if used <= 0: # ident taken over by a new thread
+            return 0.0
+        self.cputime += used
+        return used
+
+    # sample()
+    # Params: self, ident - thread ident, frame - innermost frame of the thread, used - seconds to charge
+    # Desc: charges the time to the stage, thread class and function the
+    # thread is in, or keeps it for later if the thread is waiting
+    def sample(self, ident:int, frame, used:float):
+        leaf = frame.f_code
+        stages = [] # stages on the stack, innermost first
+        while frame != None:
+            stage = self.codes.get(frame.f_code, False)
+            if stage is False:
+                stage = self.codes[frame.f_code] = profileStage(frame.f_code)
+            if stage == 'idle' and frame.f_code is leaf: # waiting, the time went somewhere else
+                if profileCpuClock:
+                    self.pending[ident] += used
+                return
+            if stage != None and stage != 'idle' and stage not in stages:
+                stages.append(stage)
+            frame = frame.f_back
+        used += self.pending.pop(ident, 0.0)
+        name = self.names.get(ident)
+        if name == None: # new thread, look up what runs in it
+            self.names = {t.ident:type(t).__name__ for t in threading.enumerate()}
+            name = self.names.setdefault(ident, 'unknown')
+        self.stages[stages[0] if len(stages) > 0 else 'other'] += used
+        for stage in stages:
+            self.within[stage] += used
+        self.threads[name] += used
+        self.functions[(leaf.co_filename, leaf.co_firstlineno, getattr(leaf,'co_qualname',leaf.co_name))] += used
+        self.samples += 1
+
+    # report()
+    # Params: self
+    # Desc: returns the text of the report
+    def report(self) -> str:
+        total = sum(self.stages.values())
+        share = lambda seconds: 100.0 * seconds / total if total > 0 else 0.0
+        lines = ['Profile of chat session "'+self.state.servername+'" ('+('host' if self.state.isHost else 'client')+')',
+                 'profiled %.1f s, %d busy samples every %d ms, %s' % (self.elapsed, self.samples, round(profileInterval * 1000),
+                                                                       'charged %.3f s of %.3f s thread cpu time' % (total, self.cputime) if profileCpuClock else
+                                                                       'no per thread cpu clock, %.3f s of busy samples' % total),
+                 '', 'Time per pipeline stage:', '  %-9s %11s %7s %11s %7s' % ('stage','self','','total','')]
+        for stage in sorted(set(self.stages) | set(self.within), key=lambda stage: (-self.stages.get(stage,0.0), -self.within.get(stage,0.0))):
+            (seconds,within) = (self.stages.get(stage,0.0), self.within.get(stage,self.stages.get(stage,0.0)))
+            lines.append('  %-9s %9.3f s %6.1f%% %9.3f s %6.1f%%  %s' % (stage, seconds, share(seconds), within, share(within), profileStages[stage]))
+        lines += ['', 'Time per thread class:']
+        for name,seconds in sorted(self.threads.items(), key=lambda item: -item[1]):
+            lines.append('  %-24s %9.3f s %6.1f%%' % (name, seconds, share(seconds)))
+        lines += ['', 'Hottest functions (innermost Python frame):']
+        for (filename,line,name),seconds in sorted(self.functions.items(), key=lambda item: -item[1])[:30]:
+            lines.append('  %9.3f s %6.1f%%  %s (%s:%d)' % (seconds, share(seconds), name, os.path.basename(filename), line))
+        return '\n'.join(lines)+'\n'
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        dbg(self.state, 'profiler thread started!') # debug
+        start = time.monotonic()
+        while not self.stopped.wait(profileInterval):
+            for ident,frame in sys._current_frames().items():
+                if ident == self.ident: # not the profiler itself
+                    continue
+                used = self.cpu(ident)
+                if used > 0: # ran since the last look
+                    self.sample(ident,frame,used)
+            frame = None # do not keep the other threads' frames alive
+            if self.duration != None and time.monotonic() - start >= self.duration:
+                break
+        self.elapsed = time.monotonic() - start
+        try:
+            os.makedirs(profileDir, exist_ok=True)
+            path = os.path.join(profileDir, time.strftime('profile-%Y%m%d-%H%M%S.txt'))
+            with open(path, 'w') as out:
+                out.write(self.report())
+            self.path = path
+            self.state.sink.history('Profile written to '+path+'\n')
+        except OSError as err:
+            self.state.sink.history('[Error]: Could not write the profile: '+str(err)+'\n')
+        if self.state.profiler is self: # finished on its own
+            self.state.profiler = None
+        dbg(self.state, 'profiler thread terminated.') # debug
+
+# startProfile()
+# Params: duration - seconds to profile for (None until stopProfile)
+# Desc: starts profiling the process. Returns False if already profiling.
+def startProfile(state:ConData, duration:float = None) -> bool:
+    if state.profiler != None and state.profiler.is_alive():
+        return False
+    state.profiler = profilerThread(state,duration)
+    state.profiler.start()
+    state.sink.history('Profiling'+(' for '+str(duration)+' seconds' if duration != None else '')+'...\n')
+    return True
+
+# stopProfile()
+# Params: none
+# Desc: stops profiling and writes the report. Returns its path, or
+# None if not profiling or it could not be written.
+def stopProfile(state:ConData) -> str:
+    profiler = state.profiler
+    if profiler == None:
+        return None
+    state.profiler = None
+    return profiler.stop()
+
+# ======
+# Roster
+# ======
+# The host keeps the members of the chat session in a roster indexed by
+# member id. Every change bumps the roster version and is broadcast as
+# a delta carrying the new version (commands, see Commands):
+#   ulist_join [version] [id] [username]
+#   ulist_leave [version] [id]
+#   ulist_rename [version] [id] [username]
+# Clients keep a copy of the roster and apply the deltas in order. A
+# client that misses a version (or just joined) asks for the whole
+# roster with 'ulist_asknew [version]' and gets
+#   ulist_snapshot [version] [id] [username] [id] [username] ...
+# only when its version is stale. Member id 0 is the host.
+
+# rosterData() : Object
+# Desc: members of the chat session, by member id in join order
+class rosterData():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.lock = threading.RLock() # changes come from several threads
+        self.members = {} # member id -> username
+        self.version = 0 # bumped by every change
+        self.nextid = 0 # id of the next member
+        self.asked = False # a snapshot was asked for and has not arrived yet (client only)
+
+    # add()
+    # Params: self, username - username of the new member
+    # Desc: adds a member and returns its id
+    def add(self, username:str) -> int:
+        with self.lock:
+            mid = self.nextid
+            self.nextid += 1
+            self.members[mid] = username
+            self.version += 1
+            return mid
+
+    # remove()
+    # Params: self, mid - member id
+    # Desc: removes a member. Returns False if it was not a member.
+    def remove(self, mid) -> bool:
+        with self.lock:
+            if self.members.pop(mid, None) == None:
+                return False
+            self.version += 1
+            return True
+
+    # rename()
+    # Params: self, mid - member id, username - new username
+    # Desc: changes the username of a member. Returns False if it was
+    # not a member.
+    def rename(self, mid, username:str) -> bool:
+        with self.lock:
+            if mid not in self.members:
+                return False
+            self.members[mid] = username
+            self.version += 1
+            return True
+
+    # snapshot()
+    # Params: self
+    # Desc: returns the whole roster as the fields of ulist_snapshot
+    def snapshot(self) -> list:
+        with self.lock:
+            fields = [self.version]
+            for mid,name in self.members.items():
+                fields += [mid,name]
+            return fields
+
+    # apply()
+    # Params: self, op - roster command, params - its fields
+    # Desc: applies a delta or snapshot received from the host. Returns
+    # 'ok' when applied, 'old' when there is nothing to apply and
+    # 'stale' when versions were missed and a snapshot should be asked for.
+    def apply(self, op:str, params:list) -> str:
+        with self.lock:
+            version = int(params[0])
+            if op == 'ulist_snapshot':
+                if self.asked == False and version <= self.version: # nothing new
+                    return 'old'
+                self.members = {int(mid):name for mid,name in zip(params[1::2],params[2::2])}
+                self.version = version
+                self.asked = False
+                return 'ok'
+            if version <= self.version or self.asked: # already applied or waiting for a snapshot
+                return 'old'
+            if version != self.version + 1: # missed a change
+                self.asked = True
+                return 'stale'
+            mid = int(params[1])
+            if op == 'ulist_join' or op == 'ulist_rename':
+                self.members[mid] = params[2]
+            elif op == 'ulist_leave':
+                self.members.pop(mid, None)
+            self.version = version
+            return 'ok'
+
+    # text()
+    # Params: self
+    # Desc: returns the users list to show, one '#user' per line with
+    # the host in brackets
+    def text(self) -> str:
+        with self.lock:
+            return ''.join(('#['+name+']\n' if mid == 0 else '#'+name+'\n') for mid,name in self.members.items())
+
+# =======
+# History
+# =======
+# The history log is a directory of segment files named after the
+# sequence number of their first message. Every message is stored as
+#   [timestamp (double)][text length (uint32)][text (utf-8)]
+# and appended to the newest segment. The newest historyCache messages
+# are also kept in memory, so replaying recent history to a client
+# that joins usually does not touch the disk; older history is read
+# with one sequential read starting at the right segment.
+
+historyRecord = struct.Struct('!dI') # record header layout (timestamp, text length)
+
+# historyLog() : Object
+# Desc: append-only, segmented chat history of a chat session
+class historyLog():
+    # __init__()
+    # Params: directory - directory of the log (created if needed)
+    # Desc: class init function, opens the log and loads its tail
+    def __init__(self, directory:str):
+        self.lock = threading.RLock() # messages are appended from several threads
+        self.directory = directory # directory of the segment files
+        self.segments = [] # (first sequence number, first timestamp, path) of every segment
+        self.cache = collections.deque(maxlen=historyCache) # newest (timestamp, text) records
+        self.count = 0 # sequence number of the next message
+        self.file = None # newest segment, open for appending
+        self.size = 0 # bytes in the newest segment
+        self.flushed = time.monotonic() # last time the file was flushed
+        self.indexer = None # search index told about every new message
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log') and name[:-4].isdigit():
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    head = f.read(historyRecord.size) # header of the first record
+                if len(head) == historyRecord.size:
+                    self.segments.append((int(name[:-4]), historyRecord.unpack(head)[0], path))
+        if len(self.segments) > 0: # continue after the last message
+            (start,_,path) = self.segments[-1]
+            (records,self.size) = self.readSegment(path)
+            self.cache.extend((stamp,text) for stamp,text,_ in records)
+            self.count = start + len(records)
+            self.file = open(path, 'ab')
+            self.file.truncate(self.size) # drop a record cut short by a crash
+
+    # readSegment()
+    # Params: self, path - segment file
+    # Desc: reads a segment with one sequential read. Returns its
+    # (timestamp, text, offset) records and the number of bytes they
+    # take; a record cut short by a crash ends the segment.
+    def readSegment(self, path:str):
+        with open(path, 'rb') as f:
+            data = f.read()
+        records = []
+        offset = 0
+        while len(data) - offset >= historyRecord.size:
+            (stamp, length) = historyRecord.unpack_from(data, offset)
+            end = offset + historyRecord.size + length
+            if end > len(data): # incomplete record
+                break
+            records.append((stamp, data[offset+historyRecord.size:end].decode('utf-8', errors='replace'), offset))
+            offset = end
+        return (records, offset)
+
+    # append()
+    # Params: self, text - chat message
+    # Desc: stores a chat message
+    def append(self, text:str):
+        stamp = time.time()
+        data = text.encode('utf-8')
+        with self.lock:
+            if self.file == None or self.size >= historySegmentSize: # start a new segment
+                if self.file != None:
+                    self.file.close()
+                path = os.path.join(self.directory, '%016d.log' % self.count)
+                self.segments.append((self.count, stamp, path))
+                self.file = open(path, 'ab')
+                self.size = 0
+            self.file.write(historyRecord.pack(stamp, len(data)) + data)
+            if self.indexer != None: # index it off the receive path
+                self.indexer.add(self.count, self.size, text)
+            self.size += historyRecord.size + len(data)
+            self.cache.append((stamp, text))
+            self.count += 1
+            if time.monotonic() - self.flushed >= historyFlush:
+                self.file.flush()
+                self.flushed = time.monotonic()
+
+    # replay()
+    # Params: self, last - number of newest messages, since - timestamp
+    # Desc: returns the texts of the last messages or of every message
+    # since a timestamp, oldest first
+    def replay(self, last:int = None, since:float = None) -> list:
+        with self.lock:
+            if last != None:
+                last = max(0, min(last, self.count))
+                if last <= len(self.cache): # all in memory
+                    return [text for _,text in list(self.cache)[len(self.cache)-last:]]
+                start = self.count - last
+                index = max(i for i,seg in enumerate(self.segments) if seg[0] <= start)
+            else:
+                if self.count == len(self.cache) or self.cache[0][0] < since: # all in memory
+                    return [text for stamp,text in self.cache if stamp >= since]
+                index = max([i for i,seg in enumerate(self.segments) if seg[1] <= since] or [0])
+            if self.file != None:
+                self.file.flush() # the newest segment is read as well
+            records = []
+            for (_,_,path) in self.segments[index:]: # sequential read from the first segment needed
+                records.extend(self.readSegment(path)[0])
+            if last != None:
+                return [text for _,text,_ in records[len(records)-last:]]
+            return [text for stamp,text,_ in records if stamp >= since]
+
+    # scan()
+    # Params: self, upto - sequence number to stop at
+    # Desc: yields (sequence number, timestamp, text, offset) of every
+    # message before upto, reading each segment sequentially
+    def scan(self, upto:int):
+        with self.lock:
+            segments = list(self.segments)
+            if self.file != None:
+                self.file.flush()
+        for (start,_,path) in segments:
+            if start >= upto:
+                break
+            for seq,(stamp,text,offset) in enumerate(self.readSegment(path)[0], start):
+                if seq >= upto:
+                    break
+                yield (seq, stamp, text, offset)
+
+    # fetch()
+    # Params: self, locations - (sequence number, offset) of the messages
+    # Desc: reads single messages and returns their (timestamp, text)
+    def fetch(self, locations:list) -> list:
+        with self.lock:
+            starts = [seg[0] for seg in self.segments]
+            paths = [seg[2] for seg in self.segments]
+            if self.file != None:
+                self.file.flush()
+        found = []
+        for (seq,offset) in locations:
+            with open(paths[bisect.bisect_right(starts,seq)-1], 'rb') as f: # segment of the message
+                f.seek(offset)
+                (stamp, length) = historyRecord.unpack(f.read(historyRecord.size))
+                found.append((stamp, f.read(length).decode('utf-8', errors='replace')))
+        return found
+
+    # close()
+    # Params: self
+    # Desc: flushes and closes the log
+    def close(self):
+        with self.lock:
+            if self.file != None:
+                self.file.close()
+                self.file = None
+
+# historyFrames()
+# Params: texts - chat messages to replay
+# Desc: packs chat messages into as few regular message frames as
+# possible, so a replay is a handful of writes
+def historyFrames(texts:list) -> list:
+    frames = []
+    chunk = []
+    size = 0
+    for text in texts:
+        if size + len(text) > recvBufferSize and len(chunk) > 0: # frame is full
+            frames.append(encodeFrame('1', ''.join(chunk)))
+            chunk = []
+            size = 0
+        chunk.append(text)
+        size += len(text)
+    if len(chunk) > 0:
+        frames.append(encodeFrame('1', ''.join(chunk)))
+    return frames
+
+# ======
+# Search
+# ======
+# The host answers /search from an inverted index of the chat history:
+# every word maps to the sorted sequence numbers of the messages that
+# have it. One thread builds and updates the index of every lobby's
+# history log and also answers the searches, so neither indexing nor
+# searching holds up message delivery. Clients search with
+#   srch_ask [page] [term] [term] ...
+# and get the page of results as a regular message.
+
+# searchTerms()
+# Params: text - text to split
+# Desc: returns the lowercase words of a text
+def searchTerms(text:str) -> list:
+    return re.findall(r'\w+', text.lower())
+
+# searchIndex() : Object
+# Desc: inverted index of a single history log. Only used by the
+# searchIndexThread.
+class searchIndex():
+    # __init__()
+    # Params: worker - searchIndexThread that keeps the index, log - historyLog to index
+    # Desc: class init function
+    def __init__(self,worker,log):
+        self.worker = worker # thread that keeps the index
+        self.log = log # history log
+        self.postings = {} # word -> array of sequence numbers
+        self.offsets = array.array('I') # offset in its segment of every message, by sequence number - base
+        with log.lock: # messages before upto are indexed from disk, the rest as they come in
+            self.upto = log.count
+            self.base = log.segments[0][0] if len(log.segments) > 0 else log.count
+            worker.tasks.put(('scan',self))
+            log.indexer = self
+
+    # add()
+    # Params: self, seq - sequence number, offset - offset in its segment, text - chat message
+    # Desc: queues a new message for indexing. Safe to call from any thread.
+    def add(self,seq,offset,text):
+        self.worker.tasks.put(('add',self,seq,offset,text))
+
+    # index()
+    # Params: self, seq - sequence number, offset - offset in its segment, text - chat message
+    # Desc: adds a message to the index. Messages come in sequence order.
+    def index(self,seq,offset,text):
+        self.offsets.append(offset)
+        for word in set(searchTerms(text)):
+            postings = self.postings.get(word)
+            if postings == None:
+                postings = self.postings[word] = array.array('I')
+            postings.append(seq)
+
+    # scan()
+    # Params: self
+    # Desc: indexes the history that was already on disk
+    def scan(self):
+        for (seq,_,text,offset) in self.log.scan(self.upto):
+            if self.worker.term:
+                return
+            self.index(seq,offset,text)
+
+    # lookup()
+    # Params: self, terms - words to search for
+    # Desc: returns the sequence numbers of the messages that have all
+    # the words, oldest first
+    def lookup(self,terms):
+        lists = [self.postings.get(word) for word in set(terms)]
+        if len(lists) == 0 or None in lists:
+            return []
+        lists.sort(key=len) # walk the rarest word, look the others up
+        if len(lists) == 1:
+            return lists[0]
+        found = []
+        for seq in lists[0]:
+            for other in lists[1:]:
+                i = bisect.bisect_left(other,seq)
+                if i == len(other) or other[i] != seq:
+                    break
+            else:
+                found.append(seq)
+        return found
+
+    # answer()
+    # Params: self, terms - words to search for, page - page of results,
+    # reply - called with the text of the results
+    # Desc: runs a search and replies with a page of results, newest first
+    def answer(self,terms,page,reply):
+        found = self.lookup(searchTerms(' '.join(terms)))
+        first = (page - 1) * searchPageSize
+        shown = list(reversed(found[max(0,len(found)-first-searchPageSize):max(0,len(found)-first)])) # newest first
+        query = '"'+' '.join(terms)+'"'
+        if len(shown) == 0:
+            reply('[Search]: No '+('more ' if page > 1 and len(found) > 0 else '')+'results for '+query+'.\n')
+            return
+        try:
+            messages = self.log.fetch([(seq,self.offsets[seq-self.base]) for seq in shown])
+        except (OSError, struct.error) as err:
+            dbg(self.worker.state, 'could not read chat history: '+str(err),'warn') # debug
+            reply('[Search]: Chat history could not be read.\n')
+            return
+        text = ('[Search]: '+str(len(found))+' results for '+query+', showing '+str(first+1)+'-'+str(first+len(shown))+':\n')
+        for (stamp,message) in messages:
+            text += '  '+time.strftime('%Y-%m-%d %H:%M', time.localtime(stamp))+' '+message.rstrip('\n')+'\n'
+        if first + len(shown) < len(found):
+            text += '[Search]: Type /more for the next page.\n'
+        reply(text)
+
+# searchIndexThread() : THREAD
+# threading.Thread
+# Desc: keeps the search indexes of the host's history logs and answers searches
+class searchIndexThread(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # store connection data
+        self.tasks = queue.SimpleQueue() # logs to scan, messages to index and searches to answer
+        self.term = False # terminate status
+
+    # attach()
+    # Params: self, log - historyLog to index
+    # Desc: starts indexing a history log and returns its searchIndex
+    def attach(self,log) -> searchIndex:
+        return searchIndex(self,log)
+
+    # detach()
+    # Params: self, log - historyLog to stop indexing
+    # Desc: stops indexing a history log and drops its index
+    def detach(self,log):
+        with log.lock:
+            log.indexer = None
+
+    # search()
+    # Params: self, log - historyLog to search, terms - words to search for,
+    # page - page of results, reply - called with the text of the results
+    # Desc: queues a search. Safe to call from any thread.
+    def search(self,log,terms,page,reply):
+        with log.lock:
+            index = log.indexer
+        if index == None:
+            reply('[Search]: Chat history is not indexed.\n')
+            return
+        self.tasks.put(('search',index,terms,page,reply))
+
+    # stop()
+    # Params: self
+    # Desc: stops the thread
+    def stop(self):
+        self.term = True
+        self.tasks.put(None) # wake up the thread
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        dbg(self.state, 'search index thread started!') # debug
+        while not self.term:
+            task = self.tasks.get()
+            if task == None: # stop() was called
+                break
+            try:
+                if task[0] == 'add':
+                    task[1].index(task[2],task[3],task[4])
+                elif task[0] == 'scan': # history already on disk
+                    task[1].scan()
+                    dbg(self.state, 'search index ready: '+str(len(task[1].postings))+' words') # debug
+                else:
+                    task[1].answer(task[2],task[3],task[4])
+            except OSError as err:
+                dbg(self.state, 'search index error: '+str(err),'warn') # debug
+        dbg(self.state, 'search index thread terminated.') # debug
+
+# =======
+# Lobbies
+# =======
+# A host serves any number of lobbies. Every lobby has its own members,
+# roster and chat history, and chat messages only go to the members of
+# the lobby they were sent in. Clients pick a lobby in their greeting
+#   usern_update [username] [lobby]
+# and land in the host's own lobby, named after the chat session, when
+# they do not. Other lobbies are opened when the first client enters
+# them and closed when the last one leaves.
+
+# lobbyData() : Object
+# Desc: a lobby of the chat session
+class lobbyData():
+    # __init__()
+    # Params: name - lobby name
+    # Desc: class init function
+    def __init__(self, name:str):
+        self.name = name # lobby name
+        self.members = 0 # clients that entered the lobby, including ones still being added
+        self.clients = clientRegistry(False) # client handlers of the lobby members
+        self.roster = rosterData() # members of the lobby
+        self.roster.nextid = 1 # member id 0 is the host
+        self.history = None # chat history log of the lobby
+        self.remote = {} # workerLink -> lobby members served by that worker process
+        self.seqlock = threading.Lock() # broadcasts go out in sequence order
+        self.epoch = os.urandom(4).hex() # tells clients the sequence numbers started over
+        self.seq = 0 # sequence number of the last broadcast
+        self.recent = collections.deque(maxlen=resumeBuffer) # (sequence number, '2' frame, '3' frame) of the newest broadcasts
+        self.bucket = tokenBucket(lobbyRate,lobbyBurst) # messages all members together may send
+
+    # sequence()
+    # Params: self, msg - message with its type character in front,
+    # command - binary payload of a command (None if msg is not one)
+    # Desc: returns the ('2' frame, '3' frame) of a broadcast and keeps
+    # them for clients that reconnect. Called with seqlock held.
+    def sequence(self, msg:str, command:bytes = None) -> tuple:
+        self.seq += 1
+        frame = encodeFrame('2', str(self.seq)+' '+msg)
+        if command != None:
+            data = sequenceHeader.pack(self.seq, ord('c')) + command
+        else:
+            data = sequenceHeader.pack(self.seq, ord(msg[:1])) + msg[1:].encode('utf-8')
+        bframe = frameHeader.pack(len(data), ord('3')) + data
+        self.recent.append((self.seq,frame,bframe))
+        return (frame,bframe)
+
+    # gap()
+    # Params: self, epoch - epoch the client saw, seq - last sequence number
+    # it saw, proto - protocol version the client speaks
+    # Desc: returns the frames of the broadcasts a client missed, or None
+    # when they are no longer kept. Called with seqlock held.
+    def gap(self, epoch:str, seq:int, proto:int = 1):
+        if epoch != self.epoch or seq > self.seq: # the lobby started over
+            return None
+        oldest = self.recent[0][0] if len(self.recent) > 0 else self.seq + 1
+        if seq + 1 < oldest: # missed more than is kept
+            return None
+        return [(bframe if proto > 1 else frame) for (fseq,frame,bframe) in itertools.islice(self.recent, seq + 1 - oldest, None)]
+
+    # addMember()
+    # Params: self, handler - client handler of the new member
+    # Desc: adds a client to the members messages are sent to
+    def addMember(self, handler):
+        if isinstance(handler, remoteClient): # served by a worker process
+            self.remote[handler.link] = self.remote.get(handler.link,0) + 1
+            handler.link.post(('admit',handler.key)) # the worker sends it lobby messages from now on
+        else:
+            self.clients.add(handler)
+
+    # removeMember()
+    # Params: self, handler - client handler of the member
+    # Desc: removes a client from the members messages are sent to
+    def removeMember(self, handler):
+        if isinstance(handler, remoteClient): # served by a worker process
+            count = self.remote.get(handler.link,0) - 1
+            if count > 0:
+                self.remote[handler.link] = count
+            else:
+                self.remote.pop(handler.link,None)
+        else:
+            self.clients.remove(handler)
+
+# lobbyName()
+# Params: name - lobby name asked for
+# Desc: returns the lobby name made safe to use as a directory name
+def lobbyName(name:str) -> str:
+    return ''.join((c if c.isalnum() or c in '-_' else '_') for c in name)[:32]
+
+# openLobby()
+# Params: name - lobby name
+# Desc: opens a lobby and its chat history. Called with state.lobbylock held.
+def openLobby(state:ConData, name:str) -> lobbyData:
+    dbg(state, 'opening lobby '+name) # debug
+    lobby = lobbyData(name)
+    if historyEnable: # open the chat history log
+        try:
+            lobby.history = historyLog(os.path.join(historyDir,lobbyName(state.servername),name))
+            if state.search != None:
+                state.search.attach(lobby.history) # index it for /search
+        except OSError as err:
+            dbg(state, 'could not open chat history: '+str(err),'warn') # debug
+            state.sink.history('[Warning]: Chat history of lobby '+name+' is not kept: '+str(err)+'\n')
+    state.lobbies[name] = lobby
+    return lobby
+
+# closeLobby()
+# Params: lobby - lobby to close
+# Desc: closes a lobby and its chat history. Called with state.lobbylock held.
+def closeLobby(state:ConData, lobby:lobbyData):
+    dbg(state, 'closing lobby '+lobby.name) # debug
+    state.lobbies.pop(lobby.name, None)
+    if lobby.history != None:
+        if state.search != None:
+            state.search.detach(lobby.history)
+        lobby.history.close()
+
+# enterLobby()
+# Params: name - lobby name
+# Desc: reserves a place in a lobby for a client that is joining,
+# opening the lobby if needed. Returns the lobby or None when the host
+# serves too many lobbies already.
+def enterLobby(state:ConData, name:str):
+    with state.lobbylock:
+        lobby = state.lobbies.get(name)
+        if lobby == None:
+            if len(state.lobbies) >= maxLobbies:
+                dbg(state, 'too many lobbies, can not open '+name,'warn') # debug
+                return None
+            lobby = openLobby(state,name)
+        lobby.members += 1
+        return lobby
+
+# leaveLobby()
+# Params: lobby - lobby the client entered
+# Desc: gives up a client's place in a lobby, closing the lobby when
+# it was the last one
+def leaveLobby(state:ConData, lobby:lobbyData):
+    with state.lobbylock:
+        lobby.members -= 1
+        if lobby.members <= 0 and state.lobbies.get(lobby.name) is lobby:
+            closeLobby(state,lobby)
+
+# lobbyStats()
+# Params: none
+# Desc: returns a text report of the open lobbies
+def lobbyStats(state:ConData) -> str:
+    with state.lobbylock:
+        lobbies = sorted(state.lobbies.values(), key=lambda lobby: lobby.name)
+    report = 'Lobbies ('+str(len(lobbies))+' open):\n'
+    for lobby in lobbies:
+        report += '#'+lobby.name+': '+str(len(lobby.clients))+' clients'+(' (yours)' if lobby is state.lobby else '')+'\n'
+    return report
+
+# ===========
+# Rate Limits
+# ===========
+
+# tokenBucket() : Object
+# Desc: token bucket limiting how many messages are let through. Each
+# check only refills the tokens for the time since the last one, so it
+# costs the same however busy the sender is.
+class tokenBucket():
+    # __init__()
+    # Params: rate - tokens per second (0 is no limit), burst - most tokens kept
+    # Desc: class init function
+    def __init__(self, rate:float, burst:int):
+        self.rate = rate # store rate
+        self.burst = max(burst, 1) # store burst
+        self.tokens = float(self.burst) # start full
+        self.stamp = time.monotonic() # when the tokens were last refilled
+        self.limited = 0 # messages over the limit
+        self.notified = 0.0 # when the sender was last told about it
+        self.lock = threading.Lock() # a lobby's bucket is used from several threads
+
+    # take()
+    # Params: self
+    # Desc: takes a token. Returns False when the message is over the limit.
+    def take(self) -> bool:
+        if self.rate <= 0: # no limit
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            self.limited += 1
+            return False
+
+# allowMessage()
+# Params: handler - client handler the message came from
+# Desc: checks a message against the client's and its lobby's limits
+# before it is sent to anyone. Tells the client, now and then, about
+# the messages that were dropped. Returns False if it is over a limit.
+def allowMessage(state:ConData, handler) -> bool:
+    if handler.bucket.take():
+        if handler.lobby == None or handler.lobby.bucket.take():
+            return True
+        reason = 'Lobby '+handler.lobby.name+' is too busy'
+    else:
+        reason = 'You are sending messages too fast'
+    dbg(state, 'rate limited %s', 'warn', handler.username) # debug
+    state.metrics.count('rate_limited')
+    now = time.monotonic()
+    if now - handler.bucket.notified >= rateNotice: # do not flood the flooder
+        handler.bucket.notified = now
+        handler.send('1[Info]: '+reason+', some of your messages were not delivered.\n')
+    return False
+
+# rateStats()
+# Params: none
+# Desc: returns a text report of the rate limits and the messages they dropped
+def rateStats(state:ConData) -> str:
+    report = ('Rate limits: '+str(userRate)+'/s (burst '+str(userBurst)+') per client, '
+              +str(lobbyRate)+'/s (burst '+str(lobbyBurst)+') per lobby (0 is no limit)\n'
+              'Messages dropped by the client limit:\n')
+    for tc in state.serverclients.snapshot():
+        if tc.peer == None and tc.bucket.limited > 0:
+            report += '#'+str(tc.username)+': '+str(tc.bucket.limited)+'\n'
+    report += 'Messages dropped by the lobby limit:\n'
+    with state.lobbylock:
+        lobbies = sorted(state.lobbies.values(), key=lambda lobby: lobby.name)
+    for lobby in lobbies:
+        if lobby.bucket.limited > 0:
+            report += '#'+lobby.name+': '+str(lobby.bucket.limited)+'\n'
+    return report
+
+# ==========
+# Federation
+# ==========
+# Hosts can link to each other (/link) so that lobbies with the same
+# name, and the hosts' own lobbies, are shared by the clients of all of
+# them. A linked host greets with 'peer_hello [host id] [server name]'
+# instead of usern_update and is answered the same way. Over a link
+# every message is a command with a message id ('[host id].[number]'):
+#   fed_msg [id] [lobby] [text] - chat message
+#   fed_join [id] [lobby] [member] [username] - member joined
+#   fed_here [id] [lobby] [member] [username] - member that was already there
+#   fed_leave [id] [lobby] [member] - member left
+#   fed_rename [id] [lobby] [member] [username] - member changed its username
+# where lobby '*' is the host's own lobby and member is the
+# '[host id].[lobby].[member id]' of the member on its own host. A host
+# passes every message on to its other links once, so messages travel
+# a tree of linked hosts and ids already seen (links that form a loop)
+# are dropped.
+
+# relayData() : Object
+# Desc: message ids and remote members of the linked hosts
+class relayData():
+    # __init__()
+    # Params: hostid - id of this host
+    # Desc: class init function
+    def __init__(self, hostid:str):
+        self.hostid = hostid # id of this host in message ids
+        self.lock = threading.Lock() # messages come from several threads
+        self.seq = 0 # number of the last message id made
+        self.seen = set() # message ids already handled
+        self.order = collections.deque() # message ids in the order they were seen
+        self.members = {} # member key -> (link, lobby, member id) of every remote member
+        self.keys = {} # (lobby, member id) -> member key of every remote member
+
+    # newId()
+    # Params: self
+    # Desc: returns a new message id
+    def newId(self) -> str:
+        with self.lock:
+            self.seq += 1
+            msgid = self.hostid+'.'+str(self.seq)
+        self.fresh(msgid) # our own messages coming back are dropped
+        return msgid
+
+    # fresh()
+    # Params: self, msgid - message id
+    # Desc: returns True the first time a message id is seen
+    def fresh(self, msgid:str) -> bool:
+        with self.lock:
+            if msgid in self.seen:
+                return False
+            self.seen.add(msgid)
+            self.order.append(msgid)
+            if len(self.order) > relayMemory: # forget the oldest
+                self.seen.discard(self.order.popleft())
+            return True
+
+# peerHello()
+# Params: none
+# Desc: returns the greeting a host sends to a host it links with
+def peerHello(state:ConData) -> str:
+    return 'peer_hello '+state.relay.hostid+' '+lobbyName(state.servername)
+
+# relayLobbyName()
+# Params: lobby - a lobby of this host
+# Desc: returns the name of a lobby in relayed messages
+def relayLobbyName(state:ConData, lobby:lobbyData) -> str:
+    return '*' if lobby is state.lobby else lobby.name
+
+# memberKey()
+# Params: lobby - lobby of the member, mid - its member id
+# Desc: returns the key of a lobby member in relayed messages
+def memberKey(state:ConData, lobby:lobbyData, mid) -> str:
+    key = state.relay.keys.get((lobby,mid)) # member of a linked host
+    if key != None:
+        return key
+    return state.relay.hostid+'.'+lobby.name+'.'+str(mid)
+
+# relaySend()
+# Params: msg - command without its message id, notpeer - link not to send it to
+# Desc: encodes a command once and sends it over every link
+def relaySend(state:ConData, msg:str, notpeer = None):
+    if state.relay == None or len(state.peers) == 0:
+        return
+    params = msg.split(' ',1)
+    frame = encodeFrame('0',params[0]+' '+state.relay.newId()+' '+params[1])
+    for peer in list(state.peers):
+        if peer is not notpeer and not peer.term: # includes a link whose thread is about to start
+            peer.queueFrame(frame)
+
+# relayMember()
+# Params: op - fed_join, fed_here, fed_leave or fed_rename, lobby - lobby
+# of the member, mid - its member id, username - its username
+# (fed_leave has none), notpeer - link not to send it to
+# Desc: sends a roster change of a lobby over the links
+def relayMember(state:ConData, op:str, lobby:lobbyData, mid, username:str = None, notpeer = None):
+    if state.relay == None or len(state.peers) == 0:
+        return
+    params = op+' '+relayLobbyName(state,lobby)+' '+memberKey(state,lobby,mid)
+    relaySend(state, params+(' '+username if username != None else ''), notpeer)
+
+# peerLinked()
+# Params: handler - handler of the connection to the other host
+# Desc: adds a link to another host and tells it about every member
+# of the open lobbies
+def peerLinked(state:ConData, handler):
+    if handler.peer == state.relay.hostid or any(p.peer == handler.peer for p in state.peers): # loop or already linked
+        dbg(state, 'declined link to '+str(handler.username)+', already linked','warn') # debug
+        handler.stop()
+        return
+    dbg(state, 'linked with host '+str(handler.username)) # debug
+    state.sink.history('Linked with host '+str(handler.username)+'.\n')
+    with state.lobbylock:
+        lobbies = list(state.lobbies.values())
+    for lobby in lobbies: # the new link knows nobody on our side yet
+        with lobby.roster.lock:
+            members = list(lobby.roster.members.items())
+        frames = []
+        for mid,username in members:
+            msg = 'fed_here '+state.relay.newId()+' '+relayLobbyName(state,lobby)+' '+memberKey(state,lobby,mid)+' '+username
+            frames.append(encodeFrame('0',msg))
+        for frame in frames:
+            handler.queueFrame(frame)
+    state.peers.append(handler)
+
+# peerUnlinked()
+# Params: handler - handler of the closed link
+# Desc: removes a link and every remote member that came over it
+def peerUnlinked(state:ConData, handler):
+    if handler not in state.peers: # declined link
+        return
+    state.peers.remove(handler)
+    dbg(state, 'link to host '+str(handler.username)+' closed') # debug
+    state.sink.history('Link to host '+str(handler.username)+' closed.\n')
+    with state.relay.lock:
+        keys = [key for key,(link,lobby,mid) in state.relay.members.items() if link is handler]
+    for key in keys:
+        remoteLeft(state,key)
+
+# remoteLeft()
+# Params: key - member key of a remote member
+# Desc: removes a remote member from its lobby and tells the other links
+def remoteLeft(state:ConData, key:str, notpeer = None):
+    with state.relay.lock:
+        member = state.relay.members.get(key)
+    if member == None:
+        return
+    (link,lobby,mid) = member
+    username = lobby.roster.members.get(mid,'?')
+    if lobby is state.lobby: # the host is in this lobby
+        state.sink.history(''+username+' disconnected!\n') # show disconnect status
+    sendToAll(state,'1'+username+' disconnected!\n',[],lobby) # send status to the lobby members
+    relayMember(state,'fed_leave',lobby,mid,None,notpeer if notpeer != None else link) # before the key is forgotten
+    with state.relay.lock:
+        state.relay.members.pop(key,None)
+        state.relay.keys.pop((lobby,mid),None)
+    with lobby.roster.lock:
+        if lobby.roster.remove(mid): # remove from the roster
+            sendRosterDelta(state,lobby,'ulist_leave',mid)
+    leaveLobby(state,lobby)
+
+# interpretRelay()
+# Params: handler - handler of the link, mtype - message type, data - message payload
+# Desc: interprets a frame received from a linked host and passes it
+# on to the other links. Returns False when the link should end.
+def interpretRelay(state:ConData, handler, mtype:str, data:str):
+    dbg(state, 'received data from linked host: %s%s', 'trace', mtype, data) # debug
+    if mtype != '0': # only commands go over links
+        return True
+    params = data.split(' ',3)
+    if params[0] == 'peer_hello': # answer to our greeting
+        if len(params) < 3:
+            return False
+        handler.peer = params[1]
+        state.serverclients.rename(handler,params[2])
+        peerLinked(state,handler)
+        return True
+    if params[0] not in ['fed_msg','fed_join','fed_here','fed_leave','fed_rename'] or len(params) < 4:
+        dbg(state, 'unknown relay command','warn') # debug
+        return True
+    if not state.relay.fresh(params[1]): # seen it over another link
+        return True
+    frame = encodeFrame(mtype,data)
+    for peer in list(state.peers): # pass it on
+        if peer is not handler and not peer.term:
+            peer.queueFrame(frame)
+    name = state.lobby.name if params[2] == '*' else lobbyName(params[2])
+    if params[0] == 'fed_msg': # chat message
+        lobby = state.lobbies.get(name)
+        if lobby != None: # nobody here is in the lobby otherwise
+            if lobby is state.lobby: # the host is in this lobby
+                state.sink.history(params[3]) # show msg to chat history
+            sendChatToAll(state,lobby,params[3]) # send to the lobby members
+        return True
+    fields = params[3].split(' ',1) # usernames may have spaces
+    key = fields[0]
+    if params[0] == 'fed_leave': # member left
+        remoteLeft(state,key,handler)
+        return True
+    if len(fields) < 2:
+        return True
+    username = fields[1]
+    with state.relay.lock:
+        member = state.relay.members.get(key)
+    if params[0] == 'fed_rename': # member changed its username
+        if member != None:
+            (link,lobby,mid) = member
+            with lobby.roster.lock:
+                if lobby.roster.rename(mid,username): # update the roster
+                    sendRosterDelta(state,lobby,'ulist_rename',mid,username)
+        return True
+    if member != None or key.startswith(state.relay.hostid+'.'): # already known or our own member back over a loop
+        return True
+    lobby = enterLobby(state,name)
+    if lobby == None: # no room for another lobby
+        return True
+    with lobby.roster.lock:
+        mid = lobby.roster.add(username) # add to the roster
+        with state.relay.lock:
+            state.relay.members[key] = (handler,lobby,mid)
+            state.relay.keys[(lobby,mid)] = key
+        sendRosterDelta(state,lobby,'ulist_join',mid,username)
+    if params[0] == 'fed_join': # a new member, not one that was already there
+        if lobby is state.lobby: # the host is in this lobby
+            state.sink.history(''+username+' has joined the chat.\n') # print status
+        sendToAll(state,'1'+username+' has joined the chat.\n',[],lobby)
+    return True
+
+# ==========
+# Heartbeats
+# ==========
+
+# heartbeatThread() : THREAD
+# threading.Thread
+# Desc: pings idle connections and closes dead ones. Every watched
+# connection has one deadline in a heap, so the thread only wakes up
+# when a connection is due and each check costs O(log n).
+class heartbeatThread(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # store connection data
+        self.heap = [] # (deadline, number, handler) of every watched connection
+        self.count = 0 # keeps heap entries with the same deadline in order
+        self.cond = threading.Condition() # guards the heap, signaled when it changes
+        self.term = False # terminate status
+
+    # watch()
+    # Params: self, handler - client handler of the connection
+    # Desc: starts watching a connection. Safe to call from any thread.
+    def watch(self,handler):
+        handler.lastseen = time.monotonic()
+        self.schedule(handler, handler.lastseen + heartbeatInterval)
+
+    # schedule()
+    # Params: self, handler - client handler, deadline - when to check it next
+    # Desc: adds a deadline to the heap
+    def schedule(self,handler,deadline:float):
+        with self.cond:
+            self.count += 1
+            heapq.heappush(self.heap, (deadline, self.count, handler))
+            if self.heap[0][2] is handler: # earlier than what the thread waits for
+                self.cond.notify()
+
+    # check()
+    # Params: self, handler - client handler, now - current time
+    # Desc: pings or closes a connection that is due. Returns when to
+    # check it next, or None when it is no longer watched.
+    def check(self,handler,now:float):
+        if handler.term or not handler.is_alive(): # closed in the meantime
+            return None
+        idle = now - handler.lastseen
+        if idle >= heartbeatTimeout: # nothing for too long
+            dbg(self.state, 'no heartbeat from '+str(handler.username)+' for '+str(round(idle,1))+' seconds','warn') # debug
+            handler.stop()
+            return None
+        if idle >= heartbeatInterval: # quiet, see if it is still there
+            sendCommand(self.state,handler,'ping')
+            return min(handler.lastseen + heartbeatTimeout, now + heartbeatInterval)
+        return handler.lastseen + heartbeatInterval # heard from it since the last check
+
+    # stop()
+    # Params: self
+    # Desc: terminates the thread
+    def stop(self):
+        with self.cond:
+            self.term = True
+            self.cond.notify()
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        dbg(self.state, 'heartbeat thread started!') # debug
+        while True:
+            with self.cond:
+                while not self.term and (len(self.heap) == 0 or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(None if len(self.heap) == 0 else self.heap[0][0] - time.monotonic())
+                if self.term:
+                    break
+                now = time.monotonic()
+                due = []
+                while len(self.heap) > 0 and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+            for handler in due: # outside the lock, sending may take a moment
+                deadline = self.check(handler,now)
+                if deadline != None:
+                    self.schedule(handler,deadline)
+        self.heap = []
+        dbg(self.state, 'heartbeat thread terminated.') # debug
+
+# startHeartbeat()
+# Params: none
+# Desc: starts the heartbeat thread unless heartbeats are turned off
+def startHeartbeat(state:ConData):
+    if heartbeatInterval > 0 and heartbeatTimeout > 0:
+        state.heartbeat = heartbeatThread(state)
+        state.heartbeat.start()
+
+# ==============
+# File Transfers
+# ==============
+# A member offers a file to its lobby with the command
+#   file_offer [transfer id] [size] [file name]
+# and streams it in 'f' frames whose payload is
+#   [transfer id: 8 bytes][offset: 8 bytes, big endian][file bytes]
+# between its chat messages. The host relays every chunk to the lobby
+# as it arrives and only remembers how far the transfer got, answering
+# each chunk with 'file_ack [transfer id] [offset]', once no member of
+# the lobby has fileWindow bytes or more waiting to be written to it.
+# The sender reads the file through mmap and stops when fileWindow
+# bytes are not yet acknowledged. 'file_done [transfer id]' ends the transfer. A sender
+# that reconnected asks 'file_resume [transfer id]' and the host
+# answers 'file_at [transfer id] [offset]' with where to go on from
+# (-1 if it does not know the transfer anymore). The lobby gets the
+# offer as 'file_offer [transfer id] [size] [sender] [file name]'.
+
+fileChunkHeader = struct.Struct('!8sQ') # chunk header layout (transfer id, offset)
+
+# fileChunk()
+# Params: tid - transfer id, offset - where the bytes go in the file,
+# data - file bytes (a slice of the mapped file)
+# Desc: builds the 'f' frame of a chunk of a file
+def fileChunk(tid:str, offset:int, data) -> bytes:
+    return frameHeader.pack(fileChunkHeader.size + len(data), ord('f')) + fileChunkHeader.pack(bytes.fromhex(tid), offset) + data
+
+# readChunk()
+# Params: data - payload of an 'f' frame
+# Desc: returns the (transfer id, offset, file bytes) of a chunk
+def readChunk(data:bytes) -> tuple:
+    if len(data) < fileChunkHeader.size:
+        raise frameError('file chunk too short')
+    (tid, offset) = fileChunkHeader.unpack_from(data)
+    return (tid.hex(), offset, memoryview(data)[fileChunkHeader.size:])
+
+# transferId()
+# Params: tid - transfer id sent by a peer
+# Desc: returns whether tid looks like a transfer id
+def transferId(tid:str) -> bool:
+    return re.fullmatch('[0-9a-f]{16}', tid) != None
+
+# fileName()
+# Params: name - file name sent by a peer
+# Desc: returns a file name that is safe to save under downloadDir
+def fileName(name:str) -> str:
+    name = os.path.basename(name.replace('\\','/')).strip().lstrip('.') # no directories, no hidden files
+    name = ''.join(c for c in name if c.isprintable())[:100]
+    return name if name != '' else 'file'
+
+# transferData() : Object
+# Desc: a file transfer the host is relaying
+class transferData():
+    # __init__()
+    # Params: lobby - lobby the file is sent to, handler - client handler of the sender,
+    # size - file size, name - file name
+    # Desc: class init function
+    def __init__(self, lobby, handler, size:int, name:str):
+        self.lobby = lobby # store lobby
+        self.handler = handler # only chunks from the sender's connection are relayed
+        self.size = size # store file size
+        self.name = name # store file name
+        self.offset = 0 # bytes relayed so far
+        self.touched = time.monotonic() # when the sender was last heard from
+        self.held = False # whether the acknowledgement waits for the lobby members to catch up
+
+# transferTable() : Object
+# Desc: the file transfers the host is relaying, by transfer id
+class transferTable():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.lock = threading.Lock() # transfers are added from several threads
+        self.entries = {} # transfer id -> transferData
+        self.pacer = None # filePacerThread while an acknowledgement is held
+
+    # add()
+    # Params: self, tid - transfer id, transfer - transferData
+    # Desc: adds a transfer and forgets the ones whose sender never came
+    # back. Returns False if the id is already used.
+    def add(self, tid:str, transfer:transferData) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            for old in [k for k,t in self.entries.items() if now - t.touched > transferTimeout]:
+                del self.entries[old]
+            if tid in self.entries:
+                return False
+            self.entries[tid] = transfer
+            return True
+
+    # get()
+    # Params: self, tid - transfer id
+    # Desc: returns the transfer with the id or None
+    def get(self, tid:str):
+        return self.entries.get(tid)
+
+    # pop()
+    # Params: self, tid - transfer id
+    # Desc: removes a finished transfer
+    def pop(self, tid:str):
+        with self.lock:
+            return self.entries.pop(tid, None)
+
+    # hold()
+    # Params: self, transfer - transferData
+    # Desc: holds back the acknowledgement of a transfer until its lobby
+    # members caught up, starting the thread that sends it
+    def hold(self, state, transfer:transferData):
+        with self.lock:
+            transfer.held = True
+            if self.pacer == None:
+                self.pacer = filePacerThread(state,self)
+                self.pacer.start()
+
+    # held()
+    # Params: self
+    # Desc: returns the (transfer id, transferData) of the transfers whose
+    # acknowledgement is held. Clears the pacer when there are none, so
+    # the next hold() starts it again.
+    def held(self) -> list:
+        with self.lock:
+            held = [(tid,t) for tid,t in self.entries.items() if t.held]
+            if len(held) == 0:
+                self.pacer = None
+            return held
+
+# filePacerThread() : THREAD
+# threading.Thread
+# Desc: sends the held acknowledgements of relayed transfers once the
+# lobby members caught up. Ends when none is held anymore.
+class filePacerThread(threading.Thread):
+    # __init__()
+    # Params: table - transferTable of the held transfers
+    # Desc: class init function
+    def __init__(self,state,table):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # store connection data
+        self.table = table # store transfer table
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        while True:
+            held = self.table.held()
+            if len(held) == 0:
+                return
+            for tid,transfer in held:
+                if transfer.handler.term: # the sender resumes from transfer.offset if it comes back
+                    transfer.held = False
+                elif lobbyBacklog(transfer.lobby,transfer.handler) < fileWindow:
+                    transfer.held = False
+                    sendCommand(self.state,transfer.handler,'file_ack',tid,transfer.offset)
+            time.sleep(0.05)
+
+# incomingFile() : Object
+# Desc: a file being received
+class incomingFile():
+    # __init__()
+    # Params: part - file the bytes are written to until the transfer is done,
+    # name - file name, sender - username of the sender, size - file size
+    # Desc: class init function
+    def __init__(self, part:str, name:str, sender:str, size:int):
+        self.part = part # store partial file path
+        self.name = name # store file name
+        self.sender = sender # store sender
+        self.size = size # store file size
+        self.received = 0 # bytes written so far
+        self.touched = time.monotonic() # when the last chunk arrived
+        self.file = open(part, 'wb')
+
+    # discard()
+    # Params: self
+    # Desc: closes and removes the partial file
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.part)
+        except OSError as err:
+            pass
+
+# downloadsData() : Object
+# Desc: the files being received, written straight to disk chunk by chunk
+class downloadsData():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.lock = threading.Lock() # chunks and commands come from different threads
+        self.files = {} # transfer id -> incomingFile
+
+    # offer()
+    # Params: self, tid - transfer id, size - file size, sender - username of the sender, name - file name
+    # Desc: starts receiving a file offered to the lobby
+    def offer(self, state:ConData, tid:str, size:int, sender:str, name:str):
+        name = fileName(name)
+        with self.lock:
+            now = time.monotonic()
+            for old in [k for k,f in self.files.items() if now - f.touched > transferTimeout]: # sender never came back
+                self.files.pop(old).discard()
+            if tid in self.files or not transferId(tid): # offered again by a resume replay
+                return
+            if len(self.files) >= maxDownloads:
+                state.sink.history('[Info]: '+sender+' is sending '+name+' but '+str(maxDownloads)+' files are already being received.\n')
+                return
+            try:
+                os.makedirs(downloadDir, exist_ok=True)
+                self.files[tid] = incomingFile(os.path.join(downloadDir, '.'+tid+'-'+os.urandom(4).hex()+'.part'), name, sender, size)
+            except OSError as err:
+                state.sink.history('[Error]: Could not save '+name+' from '+sender+': '+str(err)+'\n')
+                return
+        state.sink.history(sender+' is sending '+name+' ('+str(size)+' bytes).\n')
+
+    # chunk()
+    # Params: self, tid - transfer id, offset - where the bytes go, data - file bytes
+    # Desc: writes a chunk of a file being received. Chunks that do not
+    # follow the bytes already written are ignored; the file is then
+    # reported incomplete when the transfer ends.
+    def chunk(self, state:ConData, tid:str, offset:int, data):
+        with self.lock:
+            incoming = self.files.get(tid)
+            if incoming == None or offset != incoming.received: # not receiving it or missed a chunk
+                return
+            try:
+                incoming.file.write(data)
+            except OSError as err:
+                state.sink.history('[Error]: Could not save '+incoming.name+' from '+incoming.sender+': '+str(err)+'\n')
+                self.files.pop(tid).discard()
+                return
+            incoming.received += len(data)
+            incoming.touched = time.monotonic()
+
+    # done()
+    # Params: self, tid - transfer id
+    # Desc: finishes a file and moves it to its name under downloadDir
+    def done(self, state:ConData, tid:str):
+        with self.lock:
+            incoming = self.files.pop(tid, None)
+        if incoming == None:
+            return
+        if incoming.received != incoming.size:
+            incoming.discard()
+            state.sink.history('[Info]: '+incoming.name+' from '+incoming.sender+' did not arrive complete ('
+                               +str(incoming.received)+' of '+str(incoming.size)+' bytes).\n')
+            return
+        incoming.file.close()
+        (base, ext) = os.path.splitext(incoming.name)
+        path = os.path.join(downloadDir, incoming.name)
+        count = 1
+        while os.path.exists(path): # never overwrite an earlier file
+            path = os.path.join(downloadDir, base+' ('+str(count)+')'+ext)
+            count += 1
+        try:
+            os.replace(incoming.part, path)
+        except OSError as err:
+            state.sink.history('[Error]: Could not save '+incoming.name+' from '+incoming.sender+': '+str(err)+'\n')
+            return
+        state.sink.history(incoming.sender+' sent '+incoming.name+', saved as '+path+'\n')
+
+    # cancel()
+    # Params: self
+    # Desc: drops every file still being received
+    def cancel(self):
+        with self.lock:
+            for incoming in self.files.values():
+                incoming.discard()
+            self.files = {}
+
+# fileSenderThread() : THREAD
+# threading.Thread
+# Desc: streams a file to the lobby. The file is mapped into memory and
+# sent a chunk at a time, at most fileWindow bytes ahead of what the
+# host acknowledged (the host itself waits for its lobby members'
+# queues instead), so chat messages queued meanwhile go out between
+# the chunks. A client that reconnects goes on where the host got to.
+class fileSenderThread(threading.Thread):
+    # __init__()
+    # Params: path - file to send
+    # Desc: class init function
+    def __init__(self,state,path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # store connection data
+        self.path = path # store file path
+        self.filename = fileName(path) # name the others see
+        self.tid = os.urandom(8).hex() # transfer id
+        self.size = 0 # file size, known once the file is mapped
+        self.offset = 0 # bytes queued so far
+        self.acked = 0 # bytes the host relayed
+        self.ackedAt = time.monotonic() # when the host last acknowledged something
+        self.resumeat = None # where the host wants a reconnected sender to go on from
+        self.cond = threading.Condition() # signaled when the host answers
+        self.term = False # terminate status
+
+    # stop()
+    # Params: self
+    # Desc: stops sending the file
+    def stop(self):
+        with self.cond:
+            self.term = True
+            self.cond.notify()
+
+    # answered()
+    # Params: self, command - 'file_ack' or 'file_at', offset - offset the host sent
+    # Desc: takes an answer from the host. Called from the client handler thread.
+    def answered(self, command:str, offset:int):
+        with self.cond:
+            if command == 'file_ack' and offset > self.acked:
+                self.acked = offset
+                self.ackedAt = time.monotonic()
+            elif command == 'file_at':
+                self.resumeat = offset
+            self.cond.notify()
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        state = self.state
+        try:
+            with open(self.path,'rb') as f:
+                self.size = os.fstat(f.fileno()).st_size
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b'' # empty files can not be mapped
+                try:
+                    with memoryview(mapped) as view: # chunks are sliced out of the mapping without reading the file
+                        self.size = len(view)
+                        error = self.toLobby(view) if state.isHost else self.toHost(view)
+                finally:
+                    if self.size > 0:
+                        mapped.close()
+        except (OSError, ValueError) as err:
+            error = str(err)
+        state.uploads.pop(self.tid, None)
+        if error == None:
+            state.sink.history('Sent '+self.filename+' ('+str(self.size)+' bytes).\n')
+        else:
+            state.sink.history('[Error]: Sending '+self.filename+' stopped: '+error+'\n')
+
+    # toLobby()
+    # Params: self, view - the mapped file
+    # Desc: sends the file to the host's own lobby. Returns None when it
+    # was sent or why it was not.
+    def toLobby(self, view) -> str:
+        state = self.state
+        lobby = state.lobby
+        castCommand(state,lobby,'file_offer',[self.tid,self.size,state.username,self.filename])
+        while self.offset < self.size:
+            if self.term or state.lobby is not lobby:
+                return 'the session ended'
+            if lobbyBacklog(lobby) >= fileWindow: # let the members catch up
+                with self.cond:
+                    self.cond.wait(0.05)
+                continue
+            count = min(fileChunkSize, self.size - self.offset)
+            castChunk(state,lobby,fileChunk(self.tid,self.offset,view[self.offset:self.offset+count]),[])
+            self.offset += count
+        castCommand(state,lobby,'file_done',[self.tid])
+        return None
+
+    # toHost()
+    # Params: self, view - the mapped file
+    # Desc: sends the file to the host, which relays it to our lobby.
+    # Returns None when it was sent or why it was not.
+    def toHost(self, view) -> str:
+        state = self.state
+        handler = liveHostConnection(state)
+        if handler == None:
+            return 'not connected to the host'
+        sendCommand(state,handler,'file_offer',self.tid,self.size,state.username,self.filename)
+        while self.acked < self.size:
+            if self.term or state.resume == None or state.resume.stopped:
+                return 'the session ended'
+            current = liveHostConnection(state)
+            if current is not handler: # the connection to the host was lost
+                if current == None: # still reconnecting
+                    with self.cond:
+                        self.cond.wait(0.5)
+                    continue
+                handler = current
+                with self.cond:
+                    self.resumeat = None
+                sendCommand(state,handler,'file_resume',self.tid)
+                with self.cond:
+                    self.cond.wait_for(lambda: self.resumeat != None or self.term, greetingTimeout)
+                    if self.resumeat == None or self.resumeat < 0:
+                        return 'the host could not resume the transfer'
+                    self.offset = self.acked = self.resumeat
+                    self.ackedAt = time.monotonic()
+                continue
+            with self.cond:
+                if self.offset >= self.size or self.offset - self.acked >= fileWindow: # wait for the host to catch up
+                    if time.monotonic() - self.ackedAt > transferTimeout:
+                        return 'the host stopped answering'
+                    self.cond.wait(0.5)
+                    continue
+            count = min(fileChunkSize, self.size - self.offset)
+            handler.queueFrame(fileChunk(self.tid,self.offset,view[self.offset:self.offset+count]))
+            self.offset += count
+        sendCommand(state,handler,'file_done',self.tid)
+        return None
+
+# lobbyBacklog()
+# Params: lobby - lobby a file is sent to, notclient - client handler
+# not to count (the sender)
+# Desc: returns the most bytes waiting to be written to a member of a
+# lobby, for members served by a worker process what it last reported
+# plus the chunks sent since. Has the asyncio connections at or over
+# fileWindow read their depth again, it is only updated when they write.
+def lobbyBacklog(lobby:lobbyData, notclient = None) -> int:
+    backlog = 0
+    for tc in lobby.clients.snapshot():
+        if tc is notclient:
+            continue
+        depth = tc.counters.depth
+        if depth >= fileWindow and isinstance(tc, asyncClientHandler):
+            tc.pollDepth()
+        backlog = max(backlog, depth)
+    for link in list(lobby.remote):
+        for tc in list(link.clients.values()):
+            if tc.lobby is lobby and tc is not notclient:
+                backlog = max(backlog, tc.counters.depth)
+    return backlog
+
+# castChunk()
+# Params: lobby - lobby the file is sent to, frame - encoded 'f' frame,
+# notclients - usernames not to send it to
+# Desc: queues a file chunk on every member of a lobby. Chunks are not
+# numbered or kept for reconnecting clients like other broadcasts.
+def castChunk(state:ConData, lobby:lobbyData, frame:bytes, notclients:list):
+    queueToAll(lobby.clients.snapshot(),frame,notclients)
+    for link in list(lobby.remote): # one message per worker process, it sends to its members
+        link.cast(lobby.name,frame,notclients)
+        for tc in list(link.clients.values()): # counted as waiting until the worker reports its queues again
+            if tc.lobby is lobby and tc.username not in notclients:
+                tc.counters.depth += len(frame)
+
+# relayFile()
+# Params: handler - client handler the command came from, name - command
+# name, fields - its fields
+# Desc: handles a file transfer command a client sent to the host
+def relayFile(state:ConData, handler, name:str, fields:list):
+    tid = fields[0]
+    if name == 'file_offer': # a member sends a file to its lobby
+        transfer = transferData(handler.lobby,handler,fields[1],fileName(fields[3]))
+        if not state.transfers.add(tid,transfer): # id already in use
+            return
+        castCommand(state,transfer.lobby,'file_offer',[tid,transfer.size,handler.username,transfer.name],[handler.username])
+        if transfer.lobby is state.lobby: # the host is in this lobby
+            state.downloads.offer(state,tid,transfer.size,handler.username,transfer.name)
+    elif name == 'file_resume': # the sender reconnected
+        transfer = state.transfers.get(tid)
+        if transfer == None or transfer.lobby.name != handler.lobby.name:
+            sendCommand(state,handler,'file_at',tid,-1)
+            return
+        transfer.lobby = handler.lobby # the lobby may have been opened again meanwhile
+        transfer.handler = handler
+        transfer.touched = time.monotonic()
+        sendCommand(state,handler,'file_at',tid,transfer.offset)
+    elif name == 'file_done': # the whole file was relayed
+        transfer = state.transfers.get(tid)
+        if transfer == None or transfer.handler is not handler:
+            return
+        state.transfers.pop(tid)
+        castCommand(state,transfer.lobby,'file_done',[tid],[handler.username])
+        if transfer.lobby is state.lobby:
+            state.downloads.done(state,tid)
+
+# relayChunk()
+# Params: handler - client handler the chunk came from, data - payload of the 'f' frame
+# Desc: passes a file chunk on to the lobby it is sent to and
+# acknowledges it, or has the acknowledgement wait while a member is
+# behind, so the sender goes no faster than the lobby takes the file.
+# Nothing of the file is kept but its offset.
+def relayChunk(state:ConData, handler, data:bytes):
+    try:
+        (tid,offset,body) = readChunk(data)
+    except frameError as err:
+        dbg(state, 'invalid file chunk: '+str(err),'warn') # debug
+        return
+    transfer = state.transfers.get(tid)
+    if transfer == None or transfer.handler is not handler or offset != transfer.offset or offset + len(body) > transfer.size:
+        return # not the sender, or sent again around a reconnect
+    castChunk(state,transfer.lobby,encodeFrame('f',data),[handler.username])
+    if transfer.lobby is state.lobby: # the host is in this lobby
+        state.downloads.chunk(state,tid,offset,body)
+    transfer.offset += len(body)
+    transfer.touched = time.monotonic()
+    if transfer.held or lobbyBacklog(transfer.lobby,handler) >= fileWindow: # acknowledged once the members caught up
+        state.transfers.hold(state,transfer)
+        return
+    sendCommand(state,handler,'file_ack',tid,transfer.offset)
+
+# receiveFile()
+# Params: name - command name, fields - its fields
+# Desc: handles a file transfer command the host sent to a client
+def receiveFile(state:ConData, name:str, fields:list):
+    if name == 'file_offer':
+        if fields[0] in state.uploads: # our own offer, replayed after a reconnect
+            return
+        state.downloads.offer(state,fields[0],fields[1],fields[2],fields[3])
+    elif name == 'file_done':
+        state.downloads.done(state,fields[0])
+    elif name in ['file_ack','file_at']:
+        upload = state.uploads.get(fields[0])
+        if upload != None:
+            upload.answered(name,fields[1])
+
+# ===============
+# Direct Messages
+# ===============
+# A member sends a message to one user, whatever lobby they are in,
+# with the command
+#   msg_send [username] [text]
+# The host finds the user's connections in the username index of
+# serverclients and queues the message on them as a '1' frame,
+#   [sender -> username]: text
+# which is not numbered, kept in the history or relayed to linked
+# hosts. A user that disconnected less than mailboxTimeout seconds ago
+# gets it when a client with that username joins again.
+
+# mailboxData() : Object
+# Desc: direct messages the host keeps for users who disconnected
+class mailboxData():
+    # __init__()
+    # Desc: class init function
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.left = {} # username -> when its last connection closed, oldest first
+        self.waiting = {} # username -> direct messages kept for it
+
+    # departed()
+    # Params: self, username - username whose last connection closed
+    # Desc: starts keeping direct messages for a username
+    def departed(self, username:str):
+        with self.lock:
+            self.left.pop(username,None) # goes to the end, the order stays oldest first
+            self.left[username] = time.monotonic()
+            self.expire()
+
+    # expire()
+    # Params: self
+    # Desc: forgets the usernames that left more than mailboxTimeout
+    # seconds ago and their messages. Called with the lock held.
+    def expire(self):
+        limit = time.monotonic() - mailboxTimeout
+        for username in list(self.left):
+            if self.left[username] > limit: # the rest left later
+                break
+            del self.left[username]
+            self.waiting.pop(username,None)
+
+    # hold()
+    # Params: self, username - username the message is for, text - the message
+    # Desc: keeps a message for a user who left. Returns 'held', 'full'
+    # if mailboxLimit messages are already waiting, or 'unknown' if no
+    # user with that username left recently.
+    def hold(self, username:str, text:str) -> str:
+        with self.lock:
+            self.expire()
+            if username not in self.left:
+                return 'unknown'
+            texts = self.waiting.setdefault(username,[])
+            if len(texts) >= mailboxLimit:
+                return 'full'
+            texts.append(text)
+            return 'held'
+
+    # knows()
+    # Params: self, username - username to look for
+    # Desc: returns whether messages are kept for a username
+    def knows(self, username:str) -> bool:
+        with self.lock:
+            self.expire()
+            return username in self.left
+
+    # collect()
+    # Params: self, username - username of a client that joined
+    # Desc: returns the messages kept for a username and stops keeping them
+    def collect(self, username:str) -> list:
+        with self.lock:
+            self.left.pop(username,None)
+            return self.waiting.pop(username,[])
+
+# knownUser()
+# Params: username - username to look for
+# Desc: returns whether a direct message to a username would be
+# delivered or kept for it
+def knownUser(state:ConData, username:str) -> bool:
+    return username == state.username or len(state.serverclients.named(username)) > 0 or state.mailbox.knows(username)
+
+# directMessage()
+# Params: sender - username of the sender, username - username it is
+# for, text - the message
+# Desc: delivers a direct message to every connection of a user, or
+# keeps it if the user left recently. Returns None when it was
+# delivered, else a line telling the sender what happened to it.
+def directMessage(state:ConData, sender:str, username:str, text:str) -> str:
+    line = '['+sender+' -> '+username+']: '+text+'\n'
+    delivered = False
+    for tc in state.serverclients.named(username):
+        if tc.peer == None and tc.lobby != None and not tc.term: # a client in a lobby, not a linked host
+            tc.queueFrame(encodeFrame('1',line))
+            delivered = True
+    if username == state.username: # the host itself
+        state.sink.history(line)
+        delivered = True
+    if delivered:
+        state.metrics.count('direct_messages')
+        return None
+    result = state.mailbox.hold(username,line)
+    if result == 'held':
+        state.metrics.count('direct_messages')
+        return '[Msg]: '+username+' is offline, they get your message when they are back.\n'
+    if result == 'full':
+        return '[Msg]: Too many messages are waiting for '+username+', yours was not kept.\n'
+    return '[Msg]: There is no user named '+username+'.\n'
+
+# =========
+# Functions
+# =========
+
+# Debug output function. A message below debugLevel costs a lookup and
+# a comparison; args are only formatted into msg (with %) when it is shown.
+def dbg(state:ConData, msg:str, type:str = 'Status', *args):
+    if debugMode and debugLevels.get(type,1) >= debugLevels.get(debugLevel,1):
+        if len(args) > 0:
+            msg = msg % args
+        print('*['+type+']: '+msg)
+        if printToHistory:
+            state.sink.history('*['+type+']: '+msg+'\n')
+
+# sendToAll()
+# Params: msg - send message, notclients - usernames not to send it to,
+# lobby - only send it to the members of this lobby (None sends it to
+# every client of the host)
+# Desc: facilitates sending a message to all clients. The frame is
+# encoded once and the same bytes object is queued on every client
+# connection, so a slow client does not hold up the others. Messages
+# to a lobby get its next sequence number.
+def sendToAll(state:ConData, msg:str, notclients:list = [], lobby:lobbyData = None):
+    if state.isHost:
+        msg = str(msg)
+        dbg(state, 'sending to all clients: %s', 'trace', msg)
+        if lobby == None:
+            queueToAll(state.serverclients.snapshot(),encodeFrame(msg[:1], msg[1:]),notclients)
+            return
+        castToLobby(state,lobby,msg,None,notclients)
+
+# castCommand()
+# Params: lobby - lobby to send it to, name - command name, fields - its
+# fields, notclients - usernames not to send it to
+# Desc: broadcasts a command to the members of a lobby, as text to the
+# ones that speak protocol version 1 and binary to the others
+def castCommand(state:ConData, lobby:lobbyData, name:str, fields:list, notclients:list = []):
+    dbg(state, 'sending command to all clients: %s %s', 'trace', name, fields)
+    spec = commandNames[name]
+    castToLobby(state,lobby,'0'+spec.text(fields),spec.binary(fields),notclients)
+
+# castToLobby()
+# Params: lobby - lobby to send it to, msg - message with its type
+# character in front, command - binary payload of msg if it is a
+# command (else None), notclients - usernames not to send it to
+# Desc: gives a broadcast the lobby's next sequence number and queues it
+# on every member, also the ones served by worker processes
+def castToLobby(state:ConData, lobby:lobbyData, msg:str, command:bytes, notclients:list):
+    start = time.perf_counter()
+    with lobby.seqlock: # numbered and queued in the same order
+        (frame,bframe) = lobby.sequence(msg,command) # encode once for every client
+        queueToAll(lobby.clients.snapshot(),frame,notclients,bframe)
+        for link in list(lobby.remote): # one message per worker process, it sends to its members
+            link.cast(lobby.name,frame,notclients,bframe)
+    state.metrics.observe('fanout_seconds', time.perf_counter() - start)
+
+# queueToAll()
+# Params: handlers - client handlers, frame - encoded frame, notclients -
+# usernames not to send it to, bframe - frame for the clients that
+# speak protocol version 2 (None sends them frame too)
+# Desc: queues the same frame on every live client connection. A
+# handler thread that was not started yet gets it too, it writes the
+# frame out once it runs.
+def queueToAll(handlers:list, frame:bytes, notclients:list = [], bframe:bytes = None):
+    for tc in handlers:
+        if tc.username in notclients:
+            continue
+        if not tc.term:
+            tc.queueFrame(bframe if bframe != None and tc.proto > 1 else frame)
+
+# sendCommand()
+# Params: handler - handler of the connection, name - command name,
+# fields - its fields
+# Desc: queues a command to the other side of a connection, binary if
+# it speaks protocol version 2 and as text otherwise
+def sendCommand(state:ConData, handler, name:str, *fields):
+    dbg(state, 'sending command: %s %s', 'trace', name, fields)
+    handler.queueFrame(commandFrame(name,fields,handler.proto,not state.isHost))
+
+# sendChatToAll()
+# Params: lobby - lobby the message was sent in, text - chat message,
+# notclients - usernames not to send it to
+# Desc: stores a chat message in the lobby's history log and sends it
+# to the lobby members. Both happen under the log lock so a client that
+# joins gets every message either in its replay or live, never twice.
+def sendChatToAll(state:ConData, lobby:lobbyData, text:str, notclients:list = []):
+    if lobby.history == None: # not keeping history
+        sendToAll(state,'1'+text,notclients,lobby)
+        return
+    with lobby.history.lock:
+        lobby.history.append(text)
+        sendToAll(state,'1'+text,notclients,lobby)
+
+# updateUsersList()
+# Params: none
+# Desc: shows the roster in the users list
+def updateUsersList(state:ConData):
+    dbg(state, 'updating user list')
+    state.sink.userlist(state.roster)
+
+# sendRosterDelta()
+# Params: lobby - lobby whose roster changed, op - roster command,
+# fields - its fields after the version
+# Desc: broadcasts a roster change with the current roster version to
+# the lobby and shows it if it is the host's lobby. Called with the
+# roster lock held so the deltas go out in version order.
+def sendRosterDelta(state:ConData, lobby:lobbyData, op:str, *fields):
+    castCommand(state,lobby,op,[lobby.roster.version]+list(fields))
+    if lobby is state.lobby:
+        updateUsersList(state)
+
+# interpretFrame()
+# Params: handler - the client handler that received the frame,
+# mtype - message type, data - message payload
+# Desc: interprets a single frame received from a peer and times it
+# under its command name. Shared by the thread and asyncio engines.
+# Returns False when the handler should end without the disconnect routine.
+def interpretFrame(state:ConData, handler, mtype:str, data:str):
+    start = time.perf_counter()
+    try:
+        return handleFrame(state,handler,mtype,data)
+    finally:
+        state.metrics.observe('command_seconds', time.perf_counter() - start, commandName(mtype,data))
+
+# handleFrame()
+# Params: handler - the client handler that received the frame,
+# mtype - message type, data - message payload
+# Desc: does what a received frame asks for. Commands, text or binary,
+# go to their handler in commandTable.
+def handleFrame(state:ConData, handler, mtype:str, data:str):
+    if (mtype == '0' or mtype == 'c') and len(data) <= 4 and data in heartbeatPayloads: # heartbeat, receiving it was all that mattered
+        if heartbeatPayloads[data] == 'ping':
+            sendCommand(state,handler,'pong')
+        return True
+    if state.bus != None: # worker process, the host interprets it
+        state.bus.received(handler,mtype,data)
+        return True
+    if handler.peer != None: # a linked host
+        return interpretRelay(state,handler,mtype,data)
+    if mtype == 'f': # chunk of a file, relayed by the host and saved by the others
+        if state.isHost:
+            if handler.lobby != None:
+                relayChunk(state,handler,data)
+        else:
+            try:
+                state.downloads.chunk(state,*readChunk(data))
+            except frameError as err:
+                dbg(state, 'invalid file chunk: '+str(err),'warn') # debug
+        return True
+    dbg(state, 'received data from client: %s%s', 'trace', mtype, data) # debug
+    # interpret received message
+    # 0 - text command, c - binary command, 1 - regular message
+    # 2 - numbered broadcast, 3 - numbered broadcast in binary
+    if mtype == '0' or mtype == 'c': # command message
+        try:
+            (spec,fields) = decodeCommand(mtype,data,state.isHost)
+        except frameError as err: # command does not exist or its fields are wrong
+            dbg(state, 'invalid command: '+str(err),'warn') # debug
+            return True
+        return commandTable[spec.opcode](state,handler,spec.name,fields) != False
+    elif mtype == '1': # regular message
+        dbg(state, 'regular message', 'trace') # debug
+        if not state.isHost: # message from the host
+            state.sink.history(data) # show msg to chat history
+        elif handler.lobby != None and allowMessage(state,handler): # over the limit is dropped before the fan-out
+            if handler.lobby is state.lobby: # the host is in this lobby
+                state.sink.history(data) # show msg to chat history
+            sendChatToAll(state,handler.lobby,data,[handler.username]) # echo to other lobby members
+            relaySend(state,'fed_msg '+relayLobbyName(state,handler.lobby)+' '+data) # and to the linked hosts
+    elif mtype == '2': # numbered broadcast from the host
+        (seq,sep,msg) = data.partition(' ')
+        if not state.isHost and seq.isdigit() and msg != '':
+            if state.resume != None:
+                state.resume.seq = int(seq) # resume from here if the connection is lost
+            return handleFrame(state,handler,msg[:1],msg[1:])
+    elif mtype == '3': # numbered broadcast from the host, binary
+        if not state.isHost and len(data) > sequenceHeader.size:
+            (seq,inner) = sequenceHeader.unpack_from(data)
+            if chr(inner) not in ('1','c'): # only messages and commands are broadcast
+                dbg(state, 'unknown broadcast','warn') # debug
+                return True
+            if state.resume != None:
+                state.resume.seq = seq # resume from here if the connection is lost
+            msg = data[sequenceHeader.size:]
+            return handleFrame(state,handler,chr(inner),msg.decode('utf-8', errors='replace') if inner == ord('1') else msg)
+    else: # invalid message type
+        dbg(state, 'unknown message','warn') # debug
+    return True
+
+# The command handlers below get the fields of a command, whichever
+# form it came in, from handleFrame. Returning False ends the connection.
+
+# cmdUsername()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: usern_update, a client changed its username
+def cmdUsername(state:ConData, handler, name:str, fields:list):
+    dbg(state, 'username update') # debug
+    if state.isHost and not allowMessage(state,handler): # every rename goes out to the lobby
+        return
+    state.serverclients.rename(handler,fields[0]) # change username
+    if state.isHost and handler.lobby != None:
+        if isinstance(handler, remoteClient): # let its worker process know
+            handler.link.post(('rename',handler.key,handler.username))
+        roster = handler.lobby.roster
+        with roster.lock:
+            if roster.rename(handler.memberid,handler.username): # update the roster
+                sendRosterDelta(state,handler.lobby,'ulist_rename',handler.memberid,handler.username)
+                relayMember(state,'fed_rename',handler.lobby,handler.memberid,handler.username)
+
+# cmdRoster()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: ulist_join, ulist_leave, ulist_rename and ulist_snapshot, a
+# change of the roster or the whole roster
+def cmdRoster(state:ConData, handler, name:str, fields:list):
+    if state.isHost: # only the host changes the roster
+        return
+    dbg(state, 'users list update') # debug
+    try:
+        result = state.roster.apply(name,fields) # update our copy
+    except (ValueError, IndexError) as err:
+        dbg(state, 'invalid roster update: '+str(err),'warn') # debug
+        result = None
+    if result == 'ok':
+        updateUsersList(state) # show the users list
+    elif result == 'stale': # missed a change
+        sendCommand(state,handler,'ulist_asknew',state.roster.version) # ask for the whole roster
+
+# cmdAskRoster()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: ulist_asknew, a client asks for the whole roster
+def cmdAskRoster(state:ConData, handler, name:str, fields:list):
+    if state.isHost and handler.lobby != None:
+        dbg(state, 'asking for a user list update') # debug
+        roster = handler.lobby.roster
+        with roster.lock:
+            if len(fields) == 0 or fields[0] != roster.version: # client is stale
+                sendCommand(state,handler,'ulist_snapshot',*roster.snapshot()) # send the whole roster
+
+# cmdSeqStart()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: seq_start, epoch and sequence number of the lobby's broadcasts,
+# a roster snapshot follows
+def cmdSeqStart(state:ConData, handler, name:str, fields:list):
+    if not state.isHost and state.resume != None:
+        state.resume.epoch = fields[0]
+        state.resume.seq = fields[1]
+        state.roster.asked = True # take the snapshot that follows whatever its version
+
+# cmdCompOn()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: comp_on, the host agreed to compress, compress what we send too
+def cmdCompOn(state:ConData, handler, name:str, fields:list):
+    if not state.isHost and fields[0] == 'zlib':
+        with handler.outlock: # frames queued from now on are compressed
+            handler.compressor = frameCompressor()
+
+# cmdProtoOn()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: proto_on, the host agreed to a protocol version, send commands
+# in it from now on
+def cmdProtoOn(state:ConData, handler, name:str, fields:list):
+    if not state.isHost and fields[0] >= 2:
+        handler.proto = min(fields[0],commandProtocol)
+
+# cmdHistory()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: hist_ask, a client asks for chat history, 'last [count]' or
+# 'since [timestamp]'
+def cmdHistory(state:ConData, handler, name:str, fields:list):
+    if state.isHost and handler.lobby != None and handler.lobby.history != None:
+        dbg(state, 'chat history request') # debug
+        try:
+            if fields[0] == 'since':
+                texts = handler.lobby.history.replay(since=fields[1])
+            else:
+                texts = handler.lobby.history.replay(last=int(fields[1]))
+        except (ValueError, OverflowError) as err:
+            dbg(state, 'invalid history request: '+str(err),'warn') # debug
+            texts = []
+        for frame in historyFrames(texts):
+            handler.queueFrame(frame)
+
+# cmdSearch()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: srch_ask, a client searches the chat history, '[page] [term] [term] ...'
+def cmdSearch(state:ConData, handler, name:str, fields:list):
+    if state.isHost and handler.lobby != None:
+        dbg(state, 'search request') # debug
+        if state.search == None or handler.lobby.history == None:
+            handler.send('1[Search]: The host does not keep chat history.\n')
+        elif len(fields) < 2 or fields[0] < 1:
+            dbg(state, 'invalid search request','warn') # debug
+        else: # answered by the search index thread
+            state.search.search(handler.lobby.history,fields[1:],fields[0],
+                                lambda text: handler.queueFrame(encodeFrame('1',text)))
+
+# cmdFile()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: file_offer, file_done, file_ack, file_resume and file_at, file transfers
+def cmdFile(state:ConData, handler, name:str, fields:list):
+    if state.isHost:
+        if handler.lobby != None:
+            relayFile(state,handler,name,fields)
+    else:
+        receiveFile(state,name,fields)
+
+# cmdMessage()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: msg_send, a client sends a direct message to a user
+def cmdMessage(state:ConData, handler, name:str, fields:list):
+    if state.isHost and handler.lobby != None and allowMessage(state,handler): # counts against the sender's rate limit like chat
+        dbg(state, 'direct message') # debug
+        username = fields[0] # escaped in the text form, a '_' is a '_'
+        if handler.proto < 2 and not knownUser(state,username): # text commands show spaces in usernames as '_'
+            other = username.replace('_',' ') if '_' in username else username.replace(' ','_')
+            if other != username and knownUser(state,other): # do not guess which one was meant
+                handler.send('1[Msg]: There is no user named '+username+', but there is "'+other+'". Use /msg "'+other+'" [message] to send it to them.\n')
+                return
+        answer = directMessage(state,handler.username,username,fields[1])
+        if answer != None: # not delivered, let the sender know
+            handler.send('1'+answer)
+
+# cmdShutdown()
+# Params: handler - handler of the connection, name - command name, fields - its fields
+# Desc: sock_shutreq, the host closes the chat session
+def cmdShutdown(state:ConData, handler, name:str, fields:list):
+    if not state.isHost: # if we are a client
+        dbg(state, 'server requested to close connection') # debug
+        state.sink.closed() # let the user interface end the session
+        dbg(state, 'client handler thread terminated.') # debug
+        return False # end thread
+
+commandTable:dict = {commandNames[name].opcode:handler for name,handler in [
+    ('usern_update',cmdUsername), ('ulist_join',cmdRoster), ('ulist_leave',cmdRoster), ('ulist_rename',cmdRoster),
+    ('ulist_snapshot',cmdRoster), ('ulist_asknew',cmdAskRoster), ('seq_start',cmdSeqStart), ('comp_on',cmdCompOn),
+    ('proto_on',cmdProtoOn), ('hist_ask',cmdHistory), ('srch_ask',cmdSearch), ('file_offer',cmdFile), ('file_done',cmdFile),
+    ('file_ack',cmdFile), ('file_resume',cmdFile), ('file_at',cmdFile), ('msg_send',cmdMessage),
+    ('sock_shutreq',cmdShutdown)]} # opcode -> handler (ping and pong are answered in handleFrame)
+
+# greetClient()
+# Params: first - first (type, payload) frame received from a new connection
+# Desc: checks the greeting of a new connection. Returns the username,
+# the lobby asked for, the host id of a linking host (None for a
+# client), the (epoch, sequence number) a reconnecting client saw
+# last (None for a new client), whether it asked for compression and
+# the protocol version to speak with it, or None if the connection
+# should be declined.
+def greetClient(state:ConData, first):
+    if first == None: # connection closed or not speaking our protocol
+        dbg(state, 'connection declined! - no greeting','warn') # debug
+        return None
+    if first[0] != '0': # if msg is not a command
+        dbg(state, 'connection declined! - wrong message type','warn') # debug
+        dbg(state, first[0]+first[1], 'warn')
+        return None
+    params = first[1].split(' ') # split text with space as delimiters
+    options = [p for p in params[2:] if p.startswith('+')] # options never look like a lobby name
+    params = params[:2] + [p for p in params[2:] if not p.startswith('+')]
+    compress = compressEnable and '+zlib' in options
+    proto = 2 if commandProtocol >= 2 and '+v2' in options else 1
+    if params[0] == 'peer_hello' and len(params) >= 3: # another host links with us
+        return (params[2], None, params[1], None, False, 1)
+    if params[0] != 'usern_update' or len(params) < 2: # if not a username update command
+        dbg(state, 'connection declined! - wrong operation','warn') # debug
+        return None
+    username = urllib.parse.unquote(params[1]) if proto > 1 else params[1] # may have spaces, see greetingName()
+    resume = None
+    if len(params) > 4 and params[4].isdigit(): # reconnecting, 'usern_update [username] [lobby] [epoch] [sequence number]'
+        resume = (params[3], int(params[4]))
+    if len(params) > 2 and params[2] != '*' and lobbyName(params[2]) != '': # lobby asked for
+        return (username, lobbyName(params[2]), None, resume, compress, proto)
+    return (username, state.lobby.name, None, resume, compress, proto) # the host's own lobby
+
+# welcomeText()
+# Params: nusername - username of the new client, lobby - its lobby
+# Desc: returns the welcome message sent to a client that joined
+def welcomeText(nusername:str, lobby:lobbyData) -> str:
+    return 'Welcome '+str(nusername)+'! You are in lobby '+lobby.name+'.\n'
+
+# clientJoined()
+# Params: handler - the client handler of the new client, its lobby
+# already entered
+# Desc: adds a client to its lobby's roster and members and to
+# serverclients, shows and broadcasts its join status and replays the
+# lobby's recent chat history to it
+def clientJoined(state:ConData, handler):
+    if state.bus != None: # worker process, the host adds it
+        state.serverclients.add(handler) # add client handler to serverclients
+        state.bus.joined(handler)
+        return
+    if handler.peer != None: # another host linked with us
+        peerLinked(state,handler)
+        return
+    nusername = str(handler.username)
+    lobby = handler.lobby
+    if lobby is state.lobby: # the host is in this lobby
+        state.sink.history(''+nusername+' has joined the chat.\n') # print status
+    sendToAll(state,'1'+nusername+' has joined the chat.\n', [nusername], lobby)
+    with lobby.roster.lock:
+        handler.memberid = lobby.roster.add(nusername) # add to the roster
+        sendRosterDelta(state,lobby,'ulist_join',handler.memberid,nusername)
+    relayMember(state,'fed_join',lobby,handler.memberid,nusername)
+    missed = None
+    if handler.resume != None: # reconnecting client
+        with lobby.seqlock:
+            missed = lobby.gap(handler.resume[0],handler.resume[1],handler.proto)
+            if missed != None: # send only the broadcasts it missed
+                for frame in missed:
+                    handler.queueFrame(frame)
+                lobby.addMember(handler) # add client handler to the lobby members
+    if missed == None:
+        if lobby.history != None:
+            with lobby.history.lock: # no chat message goes out between the replay and the client being added
+                for frame in historyFrames(lobby.history.replay(last=historyReplay)):
+                    handler.queueFrame(frame)
+                startMember(state,lobby,handler)
+        else:
+            startMember(state,lobby,handler)
+    state.serverclients.add(handler) # add client handler to serverclients
+    for text in state.mailbox.collect(nusername): # direct messages sent while it was away
+        handler.queueFrame(encodeFrame('1',text))
+    dbg(state, 'connection accepted!') # debug
+
+# startMember()
+# Params: lobby - lobby of the client, handler - client handler of the new client
+# Desc: sends a new client the lobby's sequence number and roster and
+# adds it to the lobby members, with no broadcast in between
+def startMember(state:ConData, lobby:lobbyData, handler):
+    with lobby.roster.lock:
+        with lobby.seqlock:
+            sendCommand(state,handler,'seq_start',lobby.epoch,lobby.seq)
+            sendCommand(state,handler,'ulist_snapshot',*lobby.roster.snapshot())
+            lobby.addMember(handler) # add client handler to the lobby members
+
+# clientLeft()
+# Params: handler - the client handler of the connection that closed
+# Desc: shows and broadcasts the disconnect status of a client
+def clientLeft(state:ConData, handler):
+    if state.isHost:
+        state.serverclients.remove(handler) # only live clients are kept
+    if handler.peer != None: # link to another host
+        if state.bus != None: # worker process, the host removes it
+            state.bus.left(handler)
+        else:
+            peerUnlinked(state,handler)
+        return
+    if state.isHost:
+        lobby = handler.lobby
+        if lobby == None: # never made it into a lobby
+            return
+        handler.lobby = None
+        lobby.removeMember(handler) # no longer a lobby member
+        if state.bus != None: # worker process, the host does the rest
+            leaveLobby(state,lobby)
+            state.bus.left(handler)
+            return
+        if lobby is state.lobby: # the host is in this lobby
+            state.sink.history(''+str(handler.username)+' disconnected!\n') # show disconnect status
+        sendToAll(state,'1'+str(handler.username)+' disconnected!\n', [handler.username], lobby) # send status to other members
+        if len(state.serverclients.named(handler.username)) == 0: # its last connection, keep direct messages for it
+            state.mailbox.departed(handler.username)
+        relayMember(state,'fed_leave',lobby,handler.memberid)
+        with lobby.roster.lock:
+            if lobby.roster.remove(handler.memberid): # remove from the roster
+                sendRosterDelta(state,lobby,'ulist_leave',handler.memberid)
+        leaveLobby(state,lobby)
+    elif state.resume != None and not state.resume.stopped and reconnectTries > 0: # connection lost
+        state.sink.history('Connection to the host lost, reconnecting...\n')
+        reconnectThread(state,state.resume).start()
+    else: # the host is gone
+        state.sink.history(''+str(handler.username)+' disconnected!\n') # show disconnect status
+        state.roster = rosterData() # clear the roster
+        updateUsersList(state)
+
+# slowClient()
+# Params: handler - client handler that can not keep up
+# Desc: disconnects a client whose outbound queue stayed over the limit
+def slowClient(state:ConData, handler):
+    if handler.term: # already being disconnected
+        return
+    dbg(state, 'disconnecting slow client '+str(handler.username),'warn') # debug
+    state.sink.history(''+str(handler.username)+' is not keeping up and was disconnected.\n')
+    handler.stop()
+
+# queueStats()
+# Params: none
+# Desc: returns a text report of every client's outbound queue
+def queueStats(state:ConData) -> str:
+    report = 'Outbound queues (frames/bytes waiting, peak bytes, sent, dropped):\n'
+    for tc in state.serverclients.snapshot():
+        c = tc.counters
+        report += ('#'+str(tc.username)+': '+str(c.frames)+'/'+str(c.depth)+', '+str(c.peak)+', '
+                   +str(c.sent)+', '+str(c.dropped)+(' (slow)' if c.slowSince != None else '')
+                   +(' (worker '+str(tc.link.index)+')' if isinstance(tc, remoteClient) else '')+'\n')
+    return report
+
+# serverSSLContext()
+# Params: none
+# Desc: returns the shared ssl context used to wrap accepted connections
+def serverSSLContext(state:ConData):
+    return state.tls.context(state,'server')
+
+# serverSocket()
+# Params: port - Port number, cnum - Number of clients to listen,
+# iph - ip address to use (or None), reuseport - let worker processes listen on the same port
+# Desc: creates a server socket object with the supplied port
+# and listener number
+def serverSocket(state:ConData, port:int, cnum:int, iph:str, reuseport:bool = False):
+    servsock = socket.socket(socket.AF_INET,socket.SOCK_STREAM) # create socket object
+    servsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # set some options
+    if reuseport:
+        servsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # share the port with the worker processes
+    # get ip address
+    hostaddr = ''
+    ifaces = socket.getaddrinfo(socket.gethostname(), int(port)) # get all possible ip addresses
+    for ifc in ifaces:
+        if ifc[0] == 2: # we will use ipv4 only to make life easier
+            if ifc[4][0] in ['127.0.0.1','127.0.1.1']: # ignore localhost
+                continue
+            hostaddr = ifc[4]
+    if iph != None: # override ip address with supplied ip
+        hostaddr = (str(iph),int(port))
+    dbg(state, 'using '+str(hostaddr)) # debug
+    try:
+        dbg(state, 'binding to socket')
+        servsock.bind(hostaddr) # bind to socket
+        dbg(state, 'listening for connections')
+        servsock.listen(cnum) # listen for connections
+        
+        dbg(state, 'server socket created and now listening. cnum: '+str(cnum)) # debug
+        return (servsock,hostaddr) # return socket object
+    except socket.error as err:
+        dbg(state, 'server socket could not be created! :'+str(err),'error') # debug
+        state.sink.history('Server socket could not be created on '+str(hostaddr)+':'+str(port)+'!\n'+str(err)+'\n')
+        return (None,None)
+    except Exception as err:
+        dbg(state, 'error encountered trying to create a server socket! :'+str(err), 'error') # debug
+        state.sink.history('Server Socket encountered an error!')
+        return (None,None)
+
+# clientSocket()
+# Params: port - Port number, hostip - The host to connect to,
+# Desc: creates a client socket object using the supplied parameters
+def clientSocket(state:ConData, port:int, hostip:str):
+    clisock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # create socket object
+    
+    try:
+        if sslEnable:
+            # SSL ##########
+            sslctx = state.tls.context(state,'client') # shared client context
+            dbg(state, 'wrap socket','SSL')
+            clisock = sslctx.wrap_socket(clisock, session=state.tls.sessions.get((hostip,port))) # resume last session to this host
+            dbg(state, 'ssl socket created!','SSL')
+            # SSL ##########
+        
+        dbg(state, 'connecting to host')
+        clisock.connect((hostip,port)) # connect to host
+        if sslEnable:
+            dbg(state, 'session reused: '+str(clisock.session_reused),'SSL')
+        dbg(state, 'enabling keepalive')
+        if clisock.getsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0:
+            clisock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1) # enable keepalive
+        dbg(state, 'client connected') # debug
+        return clisock #return socket object
+    except ssl.SSLError as err:
+        dbg(state, 'client ssl error! :'+str(err), 'error') # debug
+        state.sink.history('Client SSL error!\n')
+        return None
+    except socket.error as err:
+        dbg(state, 'could not connect to server! :'+str(err),'error') # debug
+        state.sink.history('Could not connect to server!\n'+str(err)+'\n') # print to history textctrl
+        return None
+    except Exception as err:
+        dbg(state, 'error encountered trying to create a client socket! :'+str(err), 'error') # debug
+        state.sink.history('Client Socket encountered an error!')
+        return None
+
+# closeSocket()
+# Params: sock - teh socket object, noshut - whether we should
+# call shutdown or not (default FALSE)
+# Desc: closes and shuts down a socket connection
+def closeSocket(state:ConData, sock, noshut:bool = False):
+    if sock == None: # we only attempt to close socket if it exist
+        return
+    if not noshut:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error as err:
+            dbg(state, 'socket shutdown error: '+str(err))
+    sock.close()
+
+# ==============
+# Thread Classes
+# ==============
+
+# clientHandlerThread() : THREAD
+# threading.Thread
+# Desc: thread that handles the connection to a client
+class clientHandlerThread(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state,ip,port,sock,decoder = None):
+        threading.Thread.__init__(self) # initialize thread class
+        self.state = state # store connection data
+        self.ip = ip # store ip 
+        self.port = port # store port
+        self.sock = sock # store socket
+        self.decoder = decoder if decoder != None else frameDecoder() # frame decoder for this connection
+        self.outbox = collections.deque() # encoded frames waiting to be written to the socket
+        self.outlock = threading.Lock() # guards the outbound queue counters
+        self.counters = outboxCounters() # outbound queue counters
+        self.wakeup = socket.socketpair() # used to wake the thread up when a frame is queued
+        self.wakeup[0].setblocking(0)
+        self.wakeup[1].setblocking(0)
+        self.selector = waitSelector() # waits on the socket and the wakeup socket
+        self.selector.register(self.wakeup[0],selectors.EVENT_READ)
+        self.writing = False # whether the selector also waits for the socket to be writable
+        self.username = '?' # store client username
+        self.connid = None # connection id, given by clientRegistry
+        self.memberid = None # roster member id (host only)
+        self.lobby = None # lobby of the client (host only)
+        self.peer = None # host id if the connection is a link to another host
+        self.resume = None # (epoch, sequence number) a reconnecting client saw last (host only)
+        self.proto = 1 # protocol version the other side speaks (see Commands)
+        self.compressor = None # frameCompressor once compression was agreed on
+        self.lastseen = time.monotonic() # when the other side last sent something
+        self.bucket = tokenBucket(userRate,userBurst) # messages the client may send (host only)
+        self.daemon = True # make thread daemon
+        self.term = False # terminate status
+        dbg(self.state, 'client handler thread created!') # debug
+    
+    # stop()
+    # Params: self
+    # Desc: terminated the thread
+    def stop(self):
+        dbg(self.state, 'thread terminate requested') # debug
+        self.term = True # terminate thread
+        self.wake() # make sure the thread notices
+    
+    # wake()
+    # Params: self
+    # Desc: wakes the thread up if it is waiting on the socket
+    def wake(self):
+        try:
+            self.wakeup[1].send(b'\0')
+        except socket.error as err: # wakeup already pending or thread gone
+            pass
+    
+    # flush()
+    # Params: self
+    # Desc: writes queued frames until the queue is empty or the socket
+    # would block. Only called from the handler thread itself.
+    def flush(self):
+        while len(self.outbox) > 0:
+            frame = self.outbox[0]
+            try:
+                sent = self.sock.send(frame) # write as much as the socket takes
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                return # try again once the socket is writable
+            with self.outlock:
+                self.counters.depth -= sent
+                if sent < len(frame): # partial write, keep the rest
+                    self.outbox[0] = memoryview(frame)[sent:]
+                    return
+                self.outbox.popleft()
+                self.counters.frames -= 1
+                self.counters.sent += 1
+    
+    # wait()
+    # Params: self
+    # Desc: waits until the socket has data, a frame is queued or the
+    # socket takes more of the queued frames. Returns the readable
+    # sockets. (A method of its own so the profiler sees the thread is idle.)
+    def wait(self) -> list:
+        writing = len(self.outbox) > 0
+        if writing != self.writing: # only ask for writable while frames are waiting
+            self.selector.modify(self.sock,selectors.EVENT_READ|selectors.EVENT_WRITE if writing else selectors.EVENT_READ)
+            self.writing = writing
+        return [key.fileobj for key,events in self.selector.select() if events & selectors.EVENT_READ]
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        dbg(self.state, 'client handler thread started!') # debug
+        state = self.state
+
+        # handle frames that arrived together with the connection greeting
+        frames = self.decoder.backlog
+        self.decoder.backlog = []
+        try:
+            self.sock.setblocking(0) # socket is only used through the selector from here on
+            self.selector.register(self.sock,selectors.EVENT_READ)
+        except (socket.error, ValueError) as err: # closed before the thread started (e.g. /end while reconnecting)
+            self.term = True
+        keptSession = False # whether the ssl session was stored for resumption
+        if state.heartbeat != None: # close the connection if the other side goes quiet
+            state.heartbeat.watch(self)
+        
+        # main thread loop
+        while not self.term:
+            try:
+                for mtype,data in frames:
+                    if interpretFrame(state,self,mtype,data) == False: # connection is being closed
+                        return # end thread
+                frames = []
+                self.flush() # write queued frames
+                if getattr(self.sock,'pending',None) != None and self.sock.pending() > 0:
+                    readable = [self.sock] # ssl already has decrypted bytes waiting
+                else: # wait for data, a queued frame or a writable socket
+                    readable = self.wait()
+                if self.wakeup[0] in readable:
+                    self.wakeup[0].recv(4096) # clear wakeup signals
+                if self.sock in readable:
+                    received = self.decoder.received
+                    frames = self.decoder.recvFrom(self.sock) # retrieve all complete frames sent by client
+                    if frames is None: # socket closed
+                        break # break out of loop
+                    state.metrics.received(len(frames), self.decoder.received - received)
+                    self.lastseen = time.monotonic()
+                    if not keptSession and not state.isHost and sslEnable: # session tickets arrive before the first message
+                        state.tls.keepSession((self.ip,self.port),self.sock)
+                        keptSession = True
+            except frameError as err: # peer is not speaking our protocol
+                dbg(state, 'invalid frame from client: '+str(err),'warn') # debug
+                break # break out of loop
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError) as err:
+                frames = [] # nothing complete to read yet
+            except (socket.error, ValueError) as err: # socket closed or broken
+                frames = []
+                break # break out of loop
+        try: # give frames queued before termination (e.g. sock_shutreq) a chance to go out
+            self.sock.settimeout(1.0)
+            while len(self.outbox) > 0:
+                self.sock.sendall(self.outbox.popleft())
+        except (socket.error, ValueError) as err:
+            dbg(state, 'could not flush outbound frames: '+str(err)) # debug
+        self.selector.close()
+        self.wakeup[0].close()
+        self.wakeup[1].close()
+        closeSocket(state,self.sock,state.isHost) # close client socket
+        self.sock = None # clear socket
+        self.term = True # set termination to True
+        dbg(state, 'client handler thread terminated.') # debug
+        clientLeft(state,self) # show disconnect status
+        return # terminate thread
+
+    # send()
+    # Params: self
+    # Desc: send message to client
+    def send(self,data):
+        data = str(data)
+        dbg(self.state, 'sending to client: %s', 'trace', data) # debug
+        self.queueFrame(encodeFrame(data[:1], data[1:])) # queue message to client
+    
+    # queueFrame()
+    # Params: self, frame - encoded frame
+    # Desc: queues an already encoded frame to the client. Never blocks;
+    # the handler thread writes it out. Safe to call from any thread.
+    def queueFrame(self,frame):
+        if self.sock == None or self.term: # socket is gone
+            return
+        with self.outlock:
+            action = self.counters.admit(self.counters.depth)
+            if action == 'queue':
+                if self.compressor != None: # in the order the frames are queued
+                    frame = self.compressor.pack(frame)
+                self.outbox.append(frame)
+                self.counters.frames += 1
+                self.counters.depth += len(frame)
+        if action == 'disconnect':
+            slowClient(self.state,self)
+        elif action == 'drop':
+            self.state.metrics.count('frames_dropped')
+        else:
+            self.state.metrics.sent(len(frame))
+            self.wake()
+
+# connectionHandlerThread() : THREAD
+# threading.Thread
+# Desc: thread handles accepting connections. Accepted connections are
+# handed to a pool of admission workers that do the ssl handshake and
+# wait for the username greeting, so the thread keeps accepting while
+# slow clients are still being admitted.
+class connectionHandlerThread(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state,sock):
+        threading.Thread.__init__(self) # initialize thread
+        self.state = state # store connection data
+        self.sock = sock # store sock param
+        self.sock.setblocking(0) # set socket to nonblocking
+        self.counters = acceptCounters() # accept pipeline counters
+        self.daemon = True # make this thread daemon
+        self.term = False # termination status
+        dbg(self.state, 'connection handler thread created!') # debug
+    
+    # stop()
+    # Params: self
+    # Desc: terminates thread
+    def stop(self):
+        self.term = True
+    
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        state = self.state
+        dbg(state, 'connection handler thread started!') # debug
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=acceptWorkers) # admission workers
+        
+        # accept connection loop
+        while not self.term: # while not terminating
+            try:
+                (readable,w,x) = select.select([self.sock],[],[],0.5) # wait for a connection
+                if len(readable) == 0:
+                    continue
+                (clsock,(ip,port)) = self.sock.accept() # accept connections
+            except (BlockingIOError, InterruptedError) as err: # connection went away before accept
+                continue
+            except (socket.error, ValueError) as err: # handle socket error
+                if self.term or self.sock.fileno() == -1: # if terminating or socket closed
+                    break
+                dbg(state, 'error on accept :'+str(err), 'error')
+                time.sleep(0.1) # e.g. out of file descriptors, give it a moment
+                continue
+            dbg(state, 'accepted a connection') # debug
+            self.counters.count('accepted')
+            self.counters.move(None,'queued')
+            pool.submit(self.admit,clsock,ip,port).add_done_callback(self.admitted) # handshake and greeting happen on a worker
+        pool.shutdown(wait=False) # connections still being admitted are dropped by their worker
+        dbg(state, 'connection handler thread terminated.') # debug
+        return # terminate thread 
+    
+    # admitted()
+    # Params: self, future - future of an admit() call
+    # Desc: shows what went wrong if admitting a connection failed with
+    # an error admit() did not expect, instead of leaving it in the future
+    def admitted(self,future):
+        if not future.cancelled() and future.exception() != None:
+            dbg(self.state, 'error admitting a connection: '+repr(future.exception()), 'error')
+
+    # admit()
+    # Params: self, clsock - accepted socket, ip, port - address of the client
+    # Desc: runs on an admission worker. Does the ssl handshake, reads the
+    # greeting and starts the client handler thread.
+    def admit(self,clsock,ip,port):
+        state = self.state
+        stage = 'queued'
+        try:
+            if self.term: # server closed while the connection was queued
+                raise ConnectionAbortedError('server is closing')
+            if sslEnable:
+                # SSL ##########
+                self.counters.move(stage,'handshake')
+                stage = 'handshake'
+                sslctx = serverSSLContext(state)
+                dbg(state, 'wrap socket','SSL')
+                clsock.settimeout(handshakeTimeout) # limit the time a client may take to handshake
+                start = time.perf_counter()
+                clsock = sslctx.wrap_socket(clsock, server_side=True)
+                state.metrics.observe('handshake_seconds', time.perf_counter() - start)
+                dbg(state, 'ssl socket created!','SSL')
+                # SSL ##########
+            self.counters.move(stage,'greeting')
+            stage = 'greeting'
+            decoder = frameDecoder() # frame decoder for the new connection
+            start = time.perf_counter()
+            user = recvFirstFrame(clsock,decoder,greetingTimeout) # receive initial command from client
+            state.metrics.observe('greeting_seconds', time.perf_counter() - start)
+        except socket.timeout as err:
+            dbg(state, 'client timed out during '+stage,'warn') # debug
+            self.counters.move(stage,None)
+            self.counters.count('timedout')
+            closeSocket(state,clsock) # close connection
+            return
+        except ssl.SSLError as err:
+            dbg(state, 'ssl error on connection accept :'+str(err), 'error')
+            state.sink.history('SSL error on client connect!\n')
+            self.counters.move(stage,None)
+            self.counters.count('failed')
+            closeSocket(state,clsock) # close connection
+            return
+        except (frameError,socket.error) as err:
+            dbg(state, 'could not admit connection: '+str(err),'warn') # debug
+            self.counters.move(stage,None)
+            self.counters.count('failed')
+            closeSocket(state,clsock) # close connection
+            return
+        self.counters.move(stage,None)
+        greeting = greetClient(state,user) # check the greeting
+        lobby = enterLobby(state,greeting[1]) if greeting != None and greeting[2] == None and not self.term else None
+        if (lobby == None and (greeting == None or greeting[2] == None)) or self.term: # declined, no room for another lobby or server closed
+            if lobby != None:
+                leaveLobby(state,lobby)
+            self.counters.count('declined')
+            closeSocket(state,clsock) # close connection
+            return
+        nusername = greeting[0]
+        try:
+            if lobby != None:
+                sendFrame(clsock,'1',welcomeText(nusername,lobby)) # send a welcome message to client
+                if greeting[5] > 1: # binary commands from here on
+                    sendFrame(clsock,'0','proto_on '+str(greeting[5]))
+                if greeting[4]: # compress from here on
+                    sendFrame(clsock,'0','comp_on zlib')
+            else:
+                sendFrame(clsock,'0',peerHello(state)) # answer the linking host
+            if clsock.getsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0:
+                clsock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1) # enable keepalive
+        except socket.error as err:
+            self.counters.count('failed')
+            if lobby != None: # a linking host has no lobby
+                leaveLobby(state,lobby)
+            closeSocket(state,clsock) # close connection
+            return
+        self.counters.count('joined')
+        cthread = clientHandlerThread(state,ip,port,clsock,decoder) # create new handler thread
+        cthread.username = nusername # set username for client
+        cthread.lobby = lobby
+        cthread.peer = greeting[2]
+        cthread.resume = greeting[3]
+        cthread.proto = greeting[5]
+        if greeting[4] and lobby != None:
+            cthread.compressor = frameCompressor()
+            decoder.inflate()
+        clientJoined(state,cthread) # print status
+        cthread.start() # start client handler thread
+
+# =====================
+# Asyncio Server Engine
+# =====================
+
+# asyncClientHandler() : Object
+# Desc: handles the connection to a client on the asyncio engine. Has
+# the same username/term/send/stop interface as clientHandlerThread so
+# the rest of the application does not care which engine is used.
+class asyncClientHandler():
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state,engine,reader,writer,decoder):
+        self.state = state # store connection data
+        self.engine = engine # store the engine that owns the connection
+        self.reader = reader # store stream reader
+        self.writer = writer # store stream writer
+        self.decoder = decoder # frame decoder for this connection
+        (self.ip,self.port) = writer.get_extra_info('peername')[:2] # store ip and port
+        self.counters = outboxCounters() # outbound queue counters, depth counts the frames on their way to the loop too
+        self.outlock = threading.Lock() # guards queued and buffered, frames are queued from several threads
+        self.queued = 0 # bytes of frames queued but not yet handed to the transport
+        self.buffered = 0 # bytes the transport held when the event loop last looked
+        self.username = '?' # store client username
+        self.connid = None # connection id, given by clientRegistry
+        self.memberid = None # roster member id (host only)
+        self.lobby = None # lobby of the client (host only)
+        self.peer = None # host id if the connection is a link to another host
+        self.resume = None # (epoch, sequence number) a reconnecting client saw last (host only)
+        self.proto = 1 # protocol version the other side speaks (see Commands)
+        self.compressor = None # frameCompressor once compression was agreed on
+        self.lastseen = time.monotonic() # when the other side last sent something
+        self.bucket = tokenBucket(userRate,userBurst) # messages the client may send (host only)
+        self.term = False # terminate status
+
+    # is_alive()
+    # Params: self
+    # Desc: returns whether the connection is still being served
+    def is_alive(self):
+        return not self.term
+
+    # stop()
+    # Params: self
+    # Desc: closes the connection. Safe to call from any thread.
+    def stop(self):
+        dbg(self.state, 'connection terminate requested') # debug
+        self.engine.callInLoop(self.close) # after the writes already queued
+
+    # close()
+    # Params: self
+    # Desc: marks the connection terminated and closes the transport,
+    # which still flushes what it buffered. Runs on the event loop.
+    def close(self):
+        self.term = True # terminate connection
+        self.writer.close()
+
+    # send()
+    # Params: self, data - message with its type character in front
+    # Desc: queue a message to the client. Safe to call from any thread,
+    # the write itself always happens on the event loop.
+    def send(self,data):
+        data = str(data)
+        dbg(self.state, 'sending to client: %s', 'trace', data) # debug
+        self.queueFrame(encodeFrame(data[:1], data[1:]))
+
+    # queueFrame()
+    # Params: self, frame - encoded frame
+    # Desc: queues an already encoded frame to the client. Safe to call
+    # from any thread.
+    def queueFrame(self,frame):
+        if self.term: # connection is closed
+            return
+        with self.outlock:
+            self.queued += len(frame)
+            self.counters.depth = self.buffered + self.queued
+        self.engine.callInLoop(self.writeFrame, frame)
+
+    # writeFrame()
+    # Params: self, frame - encoded frame
+    # Desc: hands a frame to the transport, which is the outbound queue
+    # of the connection. Runs on the event loop.
+    def writeFrame(self,frame):
+        with self.outlock:
+            self.queued -= len(frame)
+        if self.term or self.writer.is_closing(): # connection is closed
+            return
+        transport = self.writer.transport
+        action = self.counters.admit(transport.get_write_buffer_size())
+        if action == 'queue':
+            if self.compressor != None: # in the order the frames are written
+                frame = self.compressor.pack(frame)
+            self.writer.write(frame)
+            self.counters.sent += 1
+            self.state.metrics.sent(len(frame))
+        elif action == 'disconnect':
+            slowClient(self.state,self)
+        else:
+            self.state.metrics.count('frames_dropped')
+        self.readDepth()
+
+    # pollDepth()
+    # Params: self
+    # Desc: has counters.depth read again from the transport, for a
+    # thread waiting for the connection to drain while nothing is
+    # written to it. Safe to call from any thread.
+    def pollDepth(self):
+        if not self.term:
+            self.engine.callInLoop(self.readDepth)
+
+    # readDepth()
+    # Params: self
+    # Desc: updates counters.depth from the transport. Runs on the event loop.
+    def readDepth(self):
+        if self.writer.is_closing():
+            return
+        with self.outlock:
+            self.buffered = self.writer.transport.get_write_buffer_size() # the transport only tracks bytes
+            self.counters.depth = self.buffered + self.queued
+
+    # serve()
+    # Params: self
+    # Desc: main connection routine
+    async def serve(self):
+        state = self.state
+        frames = self.decoder.backlog # frames that arrived together with the greeting
+        self.decoder.backlog = []
+        if state.heartbeat != None: # close the connection if the other side goes quiet
+            state.heartbeat.watch(self)
+        try:
+            while not self.term:
+                for mtype,data in frames:
+                    if interpretFrame(state,self,mtype,data) == False: # connection is being closed
+                        return
+                data = await self.reader.read(recvBufferSize) # retrieve what the client sent
+                if len(data) == 0: # socket closed
+                    break
+                self.lastseen = time.monotonic()
+                frames = self.decoder.feed(data) # decode all complete frames
+                state.metrics.received(len(frames), len(data))
+        except frameError as err: # peer is not speaking our protocol
+            dbg(state, 'invalid frame from client: '+str(err),'warn') # debug
+        except (socket.error, asyncio.IncompleteReadError) as err:
+            dbg(state, 'client connection error: '+str(err),'warn') # debug
+        except asyncio.CancelledError: # engine is shutting down
+            pass
+        self.term = True # set termination to True
+        self.writer.close() # close client socket
+        dbg(state, 'client connection terminated.') # debug
+        clientLeft(state,self) # show disconnect status
+
+# asyncServerThread() : THREAD
+# threading.Thread
+# Desc: thread that runs the asyncio event loop serving every client of
+# the chat session. Replaces connectionHandlerThread and the per client
+# handler threads when serverEngine is 'asyncio'.
+class asyncServerThread(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state,sock,cnum):
+        threading.Thread.__init__(self) # initialize thread
+        self.state = state # store connection data
+        self.sock = sock # store listening socket
+        self.cnum = cnum # store listen backlog
+        self.loop = asyncio.new_event_loop() # event loop of the engine
+        self.server = None # asyncio server object
+        self.counters = acceptCounters() # accept pipeline counters
+        self.handlers = set() # client handlers of open connections
+        self.daemon = True # make this thread daemon
+        self.term = False # termination status
+        dbg(self.state, 'asyncio server thread created!') # debug
+
+    # callInLoop()
+    # Params: self, func - function to call, args - function arguments
+    # Desc: runs func on the event loop. Called directly when already on
+    # the loop's thread, otherwise handed over thread safely.
+    def callInLoop(self,func,*args):
+        if self.loop.is_closed():
+            return
+        if threading.get_ident() == self.ident:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func,*args)
+
+    # stop()
+    # Params: self
+    # Desc: terminates the engine
+    def stop(self):
+        self.term = True
+        self.callInLoop(lambda: self.loop.create_task(self.shutdown()))
+
+    # shutdown()
+    # Params: self
+    # Desc: closes the server and every client connection, giving queued
+    # frames (e.g. sock_shutreq) a moment to go out, then stops the loop
+    async def shutdown(self):
+        if self.server != None:
+            self.server.close()
+        for handler in self.handlers:
+            handler.writer.close()
+        closing = [asyncio.ensure_future(handler.writer.wait_closed()) for handler in self.handlers]
+        if len(closing) > 0:
+            done,_ = await asyncio.wait(closing, timeout=1.0)
+            for task in done:
+                task.exception() # a client that already went away is fine
+        self.loop.stop()
+
+    # refreshTLS()
+    # Params: self
+    # Desc: periodically reloads changed certificates into the shared context
+    def refreshTLS(self):
+        serverSSLContext(self.state)
+        self.loop.call_later(tlsReloadCheck, self.refreshTLS)
+
+    # onConnect()
+    # Params: self, reader, writer - streams of the new connection
+    # Desc: greets a new connection and serves it until it closes. The ssl
+    # handshake already happened on the event loop (see ssl_handshake_timeout).
+    async def onConnect(self,reader,writer):
+        state = self.state
+        dbg(state, 'accepted a connection') # debug
+        self.counters.count('accepted')
+        self.counters.move(None,'greeting')
+        decoder = frameDecoder() # frame decoder for the new connection
+        first,outcome = None,'declined'
+        try:
+            start = time.perf_counter()
+            first = await asyncio.wait_for(self.readGreeting(reader,decoder), greetingTimeout)
+            state.metrics.observe('greeting_seconds', time.perf_counter() - start)
+        except asyncio.TimeoutError as err:
+            dbg(state, 'client timed out during greeting','warn') # debug
+            outcome = 'timedout'
+        except (frameError, socket.error) as err:
+            dbg(state, 'could not read greeting: '+str(err),'warn') # debug
+            outcome = 'failed'
+        except asyncio.CancelledError: # engine is shutting down
+            outcome = 'failed'
+        finally:
+            self.counters.move('greeting',None)
+        greeting = greetClient(state,first) # check the greeting
+        lobby = enterLobby(state,greeting[1]) if greeting != None and greeting[2] == None else None
+        if lobby == None and (greeting == None or greeting[2] == None): # declined or no room for another lobby
+            self.counters.count(outcome)
+            writer.close() # close connection
+            return
+        nusername = greeting[0]
+        self.counters.count('joined')
+        if lobby != None:
+            writer.write(encodeFrame('1',welcomeText(nusername,lobby))) # send a welcome message to client
+            if greeting[5] > 1: # binary commands from here on
+                writer.write(encodeFrame('0','proto_on '+str(greeting[5])))
+            if greeting[4]: # compress from here on
+                writer.write(encodeFrame('0','comp_on zlib'))
+        else:
+            writer.write(encodeFrame('0',peerHello(state))) # answer the linking host
+        sock = writer.get_extra_info('socket')
+        if sock.getsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0:
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1) # enable keepalive
+        handler = asyncClientHandler(state,self,reader,writer,decoder) # create new handler
+        handler.username = nusername # set username for client
+        handler.lobby = lobby
+        handler.peer = greeting[2]
+        handler.resume = greeting[3]
+        handler.proto = greeting[5]
+        if greeting[4] and lobby != None:
+            handler.compressor = frameCompressor()
+            decoder.inflate()
+        clientJoined(state,handler) # print status
+        self.handlers.add(handler)
+        try:
+            await handler.serve()
+        finally:
+            self.handlers.discard(handler)
+
+    # readGreeting()
+    # Params: self, reader - stream of the new connection, decoder - its frame decoder
+    # Desc: reads until the first frame is complete and returns it, or
+    # None when the connection closed first
+    async def readGreeting(self,reader,decoder):
+        while True:
+            data = await reader.read(recvBufferSize)
+            if len(data) == 0: # socket closed before a full frame arrived
+                return None
+            frames = decoder.feed(data)
+            if len(frames) > 0:
+                decoder.backlog = frames[1:] # keep the rest for the client handler
+                return frames[0]
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        state = self.state
+        dbg(state, 'asyncio server thread started!') # debug
+        asyncio.set_event_loop(self.loop)
+        try:
+            sslctx = serverSSLContext(state) if sslEnable else None # one context for every connection
+            self.server = self.loop.run_until_complete(asyncio.start_server(
+                self.onConnect, sock=self.sock, backlog=self.cnum, ssl=sslctx,
+                ssl_handshake_timeout=(handshakeTimeout if sslctx != None else None)))
+            if sslctx != None:
+                self.loop.call_later(tlsReloadCheck, self.refreshTLS) # pick up changed certificates
+            if not self.term:
+                self.loop.run_forever() # serve until stop() is called
+        except ssl.SSLError as err:
+            dbg(state, 'server ssl error! :'+str(err), 'error')
+            state.sink.history('Server SSL error!\n')
+        except Exception as err:
+            dbg(state, 'asyncio server error :'+str(err), 'error')
+            state.sink.history('Chat server encountered an error!\n')
+        # close the server and every connection still open
+        if self.server != None:
+            self.server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+        dbg(state, 'asyncio server thread terminated.') # debug
+
+# startServerEngine()
+# Params: sock - listening socket, cnum - number of clients to listen
+# Desc: starts the server engine selected by serverEngine and returns
+# its thread
+def startServerEngine(state:ConData, sock, cnum:int):
+    if serverEngine == 'asyncio':
+        conhandler = asyncServerThread(state,sock,cnum) # create asyncio server thread
+    else:
+        conhandler = connectionHandlerThread(state,sock) # create connection handler thread
+    conhandler.start() # start conhandler thread
+    return conhandler
+
+# ================
+# Worker Processes
+# ================
+# Worker processes accept and serve clients on the same port as the
+# host, the kernel spreads new connections over all of them. They are
+# connected to the host by a bus (a unix socket pair) and pass it every
+# client that joins or leaves and every frame a client sends. The host
+# handles them as usual through a remoteClient and sends back:
+#   ('admit', key) - client is now a member of its lobby
+#   ('cast', lobby, frame, notclients) - frame for the worker's members of a lobby
+#   ('send', key, frame) - frame for one client
+#   ('rename', key, username) - client changed its username
+#   ('stop', key) - disconnect a client
+#   ('shutdown',) - end the worker
+# and the worker sends ('ready',) once it listens. Every workerReport
+# seconds it also sends ('queues', [(key, frames, bytes, peak, sent,
+# dropped, slow), ...]) for the clients whose outbound queue changed,
+# which the host keeps in their remoteClient's counters.
+# A broadcast costs the host one message per worker process, not one
+# per client.
+
+# settings copied into the worker processes
+workerSettings = ['debugMode','debugLevel','sslEnable','serverEngine','handshakeTimeout','greetingTimeout','acceptWorkers',
+                  'outboxHighWater','outboxLowWater','slowClientPolicy','slowClientGrace','maxLobbies',
+                  'serverCertFile','serverKeyFile','clientCertFile','clientKeyFile','tlsReloadCheck',
+                  'heartbeatInterval','heartbeatTimeout','compressEnable','compressThreshold','compressLevel','commandProtocol','workerReport']
+
+# remoteClient() : Object
+# Desc: stands in on the host for a client served by a worker process.
+# Has the username/term/send/stop interface of the client handlers.
+class remoteClient():
+    # __init__()
+    # Params: link - workerLink of the worker, key - client key in the worker, username - client username
+    # Desc: class init function
+    def __init__(self,link,key,username):
+        self.link = link # worker process serving the client
+        self.key = key # client key in the worker process
+        self.username = username # store client username
+        self.connid = None # connection id, given by clientRegistry
+        self.memberid = None # roster member id
+        self.lobby = None # lobby of the client
+        self.peer = None # host id if the client is another host
+        self.resume = None # (epoch, sequence number) a reconnecting client saw last
+        self.proto = 1 # protocol version the client speaks (see Commands)
+        self.counters = outboxCounters() # as the worker process last reported them
+        self.bucket = tokenBucket(userRate,userBurst) # messages the client may send
+        self.term = False # terminate status
+
+    # is_alive()
+    # Params: self
+    # Desc: returns whether the client is still connected
+    def is_alive(self):
+        return not self.term
+
+    # stop()
+    # Params: self
+    # Desc: asks the worker to disconnect the client
+    def stop(self):
+        if not self.term:
+            self.link.post(('stop',self.key))
+
+    # send()
+    # Params: self, data - message with its type character in front
+    # Desc: queue a message to the client
+    def send(self,data):
+        data = str(data)
+        self.queueFrame(encodeFrame(data[:1], data[1:]))
+
+    # queueFrame()
+    # Params: self, frame - encoded frame
+    # Desc: queues an already encoded frame to the client
+    def queueFrame(self,frame):
+        if not self.term:
+            self.link.post(('send',self.key,frame))
+
+# workerLink() : Object
+# Desc: the host's end of the bus to a worker process
+class workerLink():
+    # __init__()
+    # Params: index - worker number, conn - bus connection, proc - worker process
+    # Desc: class init function
+    def __init__(self,index,conn,proc):
+        self.index = index # worker number
+        self.conn = conn # bus connection
+        self.proc = proc # worker process
+        self.lock = threading.Lock() # messages are posted from several threads
+        self.clients = {} # key -> remoteClient of every client the worker serves
+
+    # post()
+    # Params: self, msg - message tuple
+    # Desc: sends a message to the worker. Safe to call from any thread.
+    def post(self,msg):
+        with self.lock:
+            try:
+                self.conn.send(msg)
+            except (OSError, ValueError): # worker is gone, the bus thread cleans up
+                pass
+
+    # cast()
+    # Params: self, lobby - lobby name, frame - encoded frame, notclients - usernames not to send it to,
+    # bframe - frame for the members that speak protocol version 2 (None sends them frame too)
+    # Desc: sends a frame to the worker's members of a lobby
+    def cast(self,lobby,frame,notclients,bframe = None):
+        self.post(('cast',lobby,frame,notclients,bframe))
+
+# busHubThread() : THREAD
+# threading.Thread
+# Desc: starts the worker processes and handles what they send to the host
+class busHubThread(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # store connection data
+        self.links = [] # workerLink of every worker process
+        self.term = False # terminate status
+
+    # spawn()
+    # Params: self, count - number of worker processes, address - address of the server socket, cnum - Number of clients to listen
+    # Desc: starts the worker processes
+    def spawn(self,count,address,cnum):
+        state = self.state
+        settings = {'servername':state.servername, 'lobby':state.lobby.name, 'hostid':state.relay.hostid, 'address':list(address), 'cnum':cnum,
+                    'globals':{name:globals()[name] for name in workerSettings}}
+        here = os.path.dirname(os.path.abspath(__file__))
+        for index in range(1,count+1):
+            (ours,theirs) = socket.socketpair()
+            settings['index'] = index
+            proc = subprocess.Popen([sys.executable, '-c',
+                                     'import sys; sys.path.insert(0,sys.argv[1]); import chatcore; sys.exit(chatcore.workerMain(sys.argv[2:]))',
+                                     here, str(theirs.fileno()), json.dumps(settings)], pass_fds=[theirs.fileno()])
+            theirs.close()
+            self.links.append(workerLink(index,multiprocessing.connection.Connection(ours.detach()),proc))
+            dbg(state, 'worker process '+str(index)+' started, pid '+str(proc.pid)) # debug
+        for link in list(self.links): # wait until every worker listens
+            try:
+                if link.conn.poll(10.0) and link.conn.recv() == ('ready',):
+                    continue
+            except (EOFError, OSError):
+                pass
+            state.sink.history('[Warning]: Worker process '+str(link.index)+' did not start.\n')
+            link.proc.kill()
+            link.conn.close()
+            self.links.remove(link)
+
+    # stop()
+    # Params: self
+    # Desc: ends the worker processes
+    def stop(self):
+        self.term = True
+        for link in self.links:
+            link.post(('shutdown',))
+        for link in self.links:
+            try:
+                link.proc.wait(3.0)
+            except subprocess.TimeoutExpired:
+                link.proc.kill()
+            link.conn.close()
+
+    # dispatch()
+    # Params: self, link - workerLink the message came from, msg - message tuple
+    # Desc: handles a message from a worker process
+    def dispatch(self,link,msg):
+        state = self.state
+        if msg[0] == 'recv': # frame from a client
+            handler = link.clients.get(msg[1])
+            if handler != None:
+                interpretFrame(state,handler,msg[2],msg[3])
+        elif msg[0] == 'join': # client joined
+            handler = remoteClient(link,msg[1],msg[2])
+            if msg[4] != None: # another host linked with us
+                handler.peer = msg[4]
+                link.clients[msg[1]] = handler
+                clientJoined(state,handler)
+                return
+            handler.resume = msg[5]
+            handler.proto = msg[6]
+            handler.lobby = enterLobby(state,msg[3])
+            if handler.lobby == None: # no room for another lobby
+                link.post(('stop',msg[1]))
+                return
+            link.clients[msg[1]] = handler
+            clientJoined(state,handler)
+        elif msg[0] == 'left': # client disconnected
+            handler = link.clients.pop(msg[1],None)
+            if handler != None:
+                handler.term = True
+                clientLeft(state,handler)
+        elif msg[0] == 'queues': # outbound queues of the worker's clients
+            for (key,frames,depth,peak,sent,dropped,slow) in msg[1]:
+                handler = link.clients.get(key)
+                if handler != None:
+                    c = handler.counters
+                    (c.frames,c.depth,c.peak,c.sent,c.dropped) = (frames,depth,peak,sent,dropped)
+                    if not slow:
+                        c.slowSince = None
+                    elif c.slowSince == None:
+                        c.slowSince = time.monotonic()
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        state = self.state
+        dbg(state, 'bus hub thread started!') # debug
+        while not self.term and len(self.links) > 0:
+            ready = multiprocessing.connection.wait([link.conn for link in self.links], 0.5)
+            for link in [link for link in self.links if link.conn in ready]:
+                try:
+                    msg = link.conn.recv()
+                except (EOFError, OSError): # worker process ended
+                    if not self.term:
+                        dbg(state, 'worker process '+str(link.index)+' ended','warn') # debug
+                    self.links.remove(link)
+                    for key in list(link.clients): # its clients are gone too
+                        self.dispatch(link,('left',key))
+                    continue
+                self.dispatch(link,msg)
+        dbg(state, 'bus hub thread terminated.') # debug
+
+# startWorkers()
+# Params: count - number of worker processes, address - address of the
+# server socket, cnum - Number of clients to listen
+# Desc: starts the worker processes and returns the bus hub thread
+def startWorkers(state:ConData, count:int, address, cnum:int):
+    hub = busHubThread(state)
+    hub.spawn(count,address,cnum)
+    hub.start()
+    return hub
+
+# hubLink() : Object
+# Desc: a worker process's end of the bus to the host
+class hubLink():
+    # __init__()
+    # Params: conn - bus connection
+    # Desc: class init function
+    def __init__(self,conn):
+        self.conn = conn # bus connection
+        self.lock = threading.Lock() # messages are posted from several threads
+        self.clients = {} # key -> client handler
+        self.reported = {} # key -> outbound queue counters last reported to the host
+        self.nextkey = 0 # key of the next client
+
+    # post()
+    # Params: self, msg - message tuple
+    # Desc: sends a message to the host. Safe to call from any thread.
+    def post(self,msg):
+        with self.lock:
+            try:
+                self.conn.send(msg)
+            except (OSError, ValueError): # host is gone
+                pass
+
+    # joined()
+    # Params: self, handler - client handler of the new client
+    # Desc: tells the host about a client that joined
+    def joined(self,handler):
+        with self.lock:
+            handler.buskey = self.nextkey
+            self.nextkey += 1
+            self.clients[handler.buskey] = handler
+        self.post(('join',handler.buskey,handler.username,handler.lobby.name if handler.lobby != None else None,handler.peer,handler.resume,handler.proto))
+
+    # received()
+    # Params: self, handler - client handler, mtype - message type, data - message payload
+    # Desc: passes a frame from a client to the host
+    def received(self,handler,mtype,data):
+        self.post(('recv',handler.buskey,mtype,data))
+
+    # left()
+    # Params: self, handler - client handler
+    # Desc: tells the host about a client that disconnected
+    def left(self,handler):
+        with self.lock:
+            self.clients.pop(handler.buskey,None)
+            self.reported.pop(handler.buskey,None)
+        self.post(('left',handler.buskey))
+
+    # report()
+    # Params: self
+    # Desc: tells the host about the outbound queues that changed since
+    # the last report
+    def report(self):
+        changed = []
+        with self.lock:
+            for key,handler in self.clients.items():
+                c = handler.counters
+                if c.depth > 0 and isinstance(handler, asyncClientHandler): # only updated when it writes, read it again for the next report
+                    handler.pollDepth()
+                values = (c.frames,c.depth,c.peak,c.sent,c.dropped,c.slowSince != None)
+                if self.reported.get(key) != values:
+                    self.reported[key] = values
+                    changed.append((key,)+values)
+        if len(changed) > 0:
+            self.post(('queues',changed))
+
+    # dispatch()
+    # Params: self, msg - message tuple
+    # Desc: handles a message from the host
+    def dispatch(self,state,msg):
+        if msg[0] == 'cast': # frame for the members of a lobby
+            lobby = state.lobbies.get(msg[1])
+            if lobby != None:
+                queueToAll(lobby.clients.snapshot(),msg[2],msg[3],msg[4])
+            return
+        handler = self.clients.get(msg[1])
+        if handler == None: # already gone
+            return
+        if msg[0] == 'send':
+            handler.queueFrame(msg[2])
+        elif msg[0] == 'admit':
+            if handler.lobby != None:
+                handler.lobby.addMember(handler)
+        elif msg[0] == 'rename':
+            state.serverclients.rename(handler,msg[2])
+        elif msg[0] == 'stop':
+            handler.stop()
+
+# workerMain()
+# Params: argv - bus file descriptor and json settings
+# Desc: main routine of a worker process. Returns the process exit code.
+def workerMain(argv:list) -> int:
+    conn = multiprocessing.connection.Connection(int(argv[0]))
+    settings = json.loads(argv[1])
+    globals().update(settings['globals']) # same settings as the host
+    global historyEnable
+    historyEnable = False # the host keeps the chat history
+
+    state = ConData() # connection data
+    state.servername = settings['servername']
+    state.relay = relayData(settings['hostid']) # linking hosts are answered with the host's id
+    state.bus = hubLink(conn)
+    dbg(state, 'worker process '+str(settings['index'])+' starting') # debug
+    (host,port) = settings['address']
+    state.socket,sockaddr = serverSocket(state,port,settings['cnum'],host,True) # listen on the host's port
+    if state.socket == None:
+        return 1
+    with state.lobbylock: # the host's own lobby, the rest open as clients enter them
+        state.lobby = openLobby(state,settings['lobby'])
+        state.lobby.members = 1
+    state.isHost = True # we serve clients
+    startHeartbeat(state)
+    state.conhandler = startServerEngine(state,state.socket,settings['cnum']) # start the server engine
+    state.bus.post(('ready',)) # let the host know we are listening
+    nextreport = time.monotonic() + workerReport
+    while True: # handle what the host sends until it lets us go
+        try:
+            msg = conn.recv() if conn.poll(max(0.0, nextreport - time.monotonic())) else None
+        except (EOFError, OSError): # host is gone
+            break
+        if msg != None and msg[0] == 'shutdown':
+            break
+        if msg != None:
+            state.bus.dispatch(state,msg)
+        if time.monotonic() >= nextreport: # let the host see how full the queues are
+            state.bus.report()
+            nextreport = time.monotonic() + workerReport
+    endSession(state)
+    conn.close()
+    dbg(state, 'worker process '+str(settings['index'])+' ended') # debug
+    return 0
+
+# =============
+# Chat Sessions
+# =============
+
+# hostSession()
+# Params: servername - name of the chat session, port - Port number,
+# cnum - Number of clients to listen, iph - ip address to use (or None)
+# Desc: starts hosting a chat session. Returns True on success.
+def hostSession(state:ConData, servername:str, port:int, cnum:int, iph:str) -> bool:
+    dbg(state, 'hosting a chat session...') # debug
+    state.servername = servername # set servername
+    dbg(state, 'starting '+state.servername+' with port '+str(port)+' and max members of '+ str(cnum)) # debug
+    workers = hostWorkers if hasattr(socket,'SO_REUSEPORT') else 0 # worker processes need a shared port
+    if hostWorkers > 0 and workers == 0:
+        state.sink.history('[Warning]: Worker processes are not supported on this platform.\n')
+    state.socket,sockaddr = serverSocket(state,port,cnum,iph,workers > 0) # create server socket object
+    if state.socket == None: # if socket creation failed
+        return False
+    state.relay = relayData(os.urandom(6).hex()) # id of this host for linked hosts
+    state.metrics = metricsData() # count from zero for every session
+    if historyEnable: # index the lobbies' chat history for /search
+        state.search = searchIndexThread(state)
+        state.search.start()
+    with state.lobbylock: # open our own lobby
+        state.lobbies = {}
+        state.lobby = openLobby(state,lobbyName(servername) or 'Lobby')
+        state.lobby.members = 1 # the host never leaves it
+    state.roster = state.lobby.roster # the host is member 0 of its lobby
+    state.roster.nextid = 0
+    state.roster.add(state.username)
+    updateUsersList(state)
+    startHeartbeat(state)
+    state.conhandler = startServerEngine(state,state.socket,cnum) # start the server engine
+    if workers > 0: # start the worker processes
+        state.workers = startWorkers(state,workers,state.socket.getsockname(),cnum)
+    # print status
+    state.sink.history('Chat session "'+state.servername+'" started on '+str(sockaddr[0])+' port '+str(sockaddr[1])+'.\n')
+    state.isHost = True # we are host
+    return True
+
+# resumeData() : Object
+# Desc: what a client needs to reconnect to the host
+class resumeData():
+    # __init__()
+    # Params: hostip - The host to connect to, port - Port number, lobby - lobby joined (None for the host's own)
+    # Desc: class init function
+    def __init__(self, hostip:str, port:int, lobby:str):
+        self.hostip = hostip # store host ip
+        self.port = port # store port
+        self.lobby = lobby # store lobby
+        self.epoch = None # epoch of the lobby's sequence numbers
+        self.seq = 0 # sequence number of the last broadcast received
+        self.pending = [] # messages typed while reconnecting, with their type character in front
+        self.reconnecting = False # whether a reconnect is in progress
+        self.stopped = False # set when the session ends
+
+# reconnectThread() : THREAD
+# threading.Thread
+# Desc: reconnects a client to the host after the connection was lost,
+# waiting longer after every failed attempt
+class reconnectThread(threading.Thread):
+    # __init__()
+    # Desc: class init function
+    def __init__(self,state,resume):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = state # store connection data
+        self.resume = resume # where to reconnect to
+        resume.reconnecting = True
+
+    # run()
+    # Params: self
+    # Desc: main thread routine
+    def run(self):
+        state = self.state
+        resume = self.resume
+        delay = reconnectDelay
+        for attempt in range(reconnectTries):
+            time.sleep(delay)
+            if resume.stopped: # session ended meanwhile
+                return
+            dbg(state, 'reconnect attempt '+str(attempt+1)) # debug
+            sock = clientSocket(state,resume.port,resume.hostip) # create a client socket object
+            if resume.stopped:
+                closeSocket(state,sock)
+                return
+            if sock != None:
+                connectHost(state,sock)
+                state.sink.history('Reconnected to the host.\n')
+                return
+            delay = min(delay * 2, reconnectMaxDelay)
+        resume.reconnecting = False
+        state.sink.history('Could not reconnect to the host.\n')
+        state.roster = rosterData() # clear the roster
+        updateUsersList(state)
+        state.sink.closed() # let the user interface end the session
+
+# connectHost()
+# Params: sock - socket connected to the host
+# Desc: greets the host and starts the client handler thread. A client
+# that was connected before asks for the broadcasts it missed.
+def connectHost(state:ConData, sock):
+    resume = state.resume
+    state.socket = sock
+    dbg(state, 'asking to update username')
+    greeting = 'usern_update '+greetingName(state.username)
+    if resume.epoch != None: # reconnecting
+        greeting += ' '+(resume.lobby if resume.lobby != None else '*')+' '+resume.epoch+' '+str(resume.seq)
+    elif resume.lobby != None:
+        greeting += ' '+resume.lobby
+    if compressEnable: # the host may compress what it sends
+        greeting += ' +zlib'
+    if commandProtocol >= 2: # binary commands, if the host speaks them
+        greeting += ' +v2'
+    sendFrame(sock,'0',greeting) # send a username update command
+
+    clihandler = clientHandlerThread(state,resume.hostip,resume.port,sock) # create a client handler thread to listen to server
+    if compressEnable:
+        clihandler.decoder.inflate()
+    clihandler.username = 'Host'
+    clients = clientRegistry()
+    clients.add(clihandler)
+    state.serverclients = clients # this will be the only handler in it, swapped in at once
+    resume.reconnecting = False
+    for out in resume.pending: # typed while reconnecting
+        clihandler.send(out)
+    resume.pending = []
+    clihandler.start() # start thread
+
+# joinSession()
+# Params: hostip - The host to connect to, port - Port number,
+# lobby - lobby to join (None joins the host's own lobby)
+# Desc: joins a chat session. Returns True on success.
+def joinSession(state:ConData, hostip:str, port:int, lobby:str = None) -> bool:
+    dbg(state, 'joining server...') # debug
+    sock = clientSocket(state,port,hostip) # create a client socket object
+    if sock == None: # if socket creation failed
+        dbg(state, 'Socket creation failed!','Error')
+        return False
+    state.isHost = False # we are not host
+    startHeartbeat(state)
+    state.roster = rosterData() # filled in by the host's snapshot
+    state.roster.asked = True
+    state.resume = resumeData(hostip,port,lobby)
+    connectHost(state,sock)
+    return True
+
+# linkSession()
+# Params: hostip - The host to link with, port - Port number
+# Desc: links our chat session with another host's. Returns True on success.
+def linkSession(state:ConData, hostip:str, port:int) -> bool:
+    dbg(state, 'linking with host...') # debug
+    sock = clientSocket(state,port,hostip) # create a client socket object
+    if sock == None: # if socket creation failed
+        dbg(state, 'Socket creation failed!','Error')
+        return False
+    sendFrame(sock,'0',peerHello(state)) # greet as a host
+    link = clientHandlerThread(state,hostip,port,sock) # linked once the host answers
+    link.username = hostip
+    link.peer = '' # host id comes with the answer
+    link.start() # start thread
+    return True
+
+# endSession()
+# Params: linger - seconds to wait for the connections to close
+# Desc: ends the chat session, closing the server or leaving the host
+def endSession(state:ConData, linger:float = 0.5):
+    stopProfile(state) # write the report of a running profile
+    if state.resume != None: # do not reconnect
+        state.resume.stopped = True
+        state.resume = None
+    for upload in list(state.uploads.values()): # stop sending files
+        upload.stop()
+    # terminate client threads
+    for tc in state.serverclients.snapshot():
+        if state.isHost:
+            sendCommand(state,tc,'sock_shutreq') # send connection shutdown comand
+        tc.stop() # close socket
+    # close the links to other hosts
+    for peer in list(state.peers):
+        peer.stop()
+    state.peers = []
+    # end the worker processes
+    if state.workers != None:
+        state.workers.stop()
+        state.workers = None
+    # terminate connection handler
+    if state.conhandler != None: # if conhandler thread exist
+        state.conhandler.stop() # terminate connection handler thread
+        if state.conhandler.is_alive() and state.conhandler != threading.current_thread():
+            state.conhandler.join(2.0) # let the engine let go of the server socket
+    # close sockets
+    closeSocket(state,state.socket,state.isHost) # close socket
+
+    # connection close routine done
+    time.sleep(linger) # making sure that timeouts have passed
+    state.socket = None # remove socket object
+    state.serverclients.clear() # clear all client handler threads
+    state.roster = rosterData() # clear the roster
+    updateUsersList(state)
+    with state.lobbylock: # close every lobby
+        for lobby in list(state.lobbies.values()):
+            closeLobby(state,lobby)
+        state.lobby = None
+    if state.search != None: # stop the search index
+        state.search.stop()
+        state.search = None
+    if state.heartbeat != None: # stop the heartbeats
+        state.heartbeat.stop()
+        state.heartbeat = None
+    if state.metricsServer != None: # stop serving the metrics
+        state.metricsServer.stop()
+        state.metricsServer = None
+    state.transfers = transferTable() # forget the relayed transfers
+    state.mailbox = mailboxData() # and the direct messages nobody picked up
+    state.downloads.cancel() # and the files being received
+    state.conhandler = None # remove conhandler object
+
+# hostConnection()
+# Params: none
+# Desc: returns the client handler of a client's connection to the host,
+# or None if it has none
+def hostConnection(state:ConData):
+    return next(iter(state.serverclients), None)
+
+# connectedHost()
+# Params: none
+# Desc: returns the client handler of a client's connection to the host,
+# or None after telling the user that it is not connected
+def connectedHost(state:ConData):
+    handler = hostConnection(state)
+    if handler == None:
+        state.sink.history('[Info]: Not connected to the host.\n')
+    return handler
+
+# liveHostConnection()
+# Params: none
+# Desc: returns the client handler of a client's connection to the host,
+# or None while the connection is lost and being reconnected
+def liveHostConnection(state:ConData):
+    resume = state.resume
+    if resume == None or resume.reconnecting:
+        return None
+    handler = next(iter(state.serverclients), None)
+    return handler if handler != None and not handler.term else None
+
+# sendChat()
+# Params: out - chat line to send
+# Desc: sends a chat line to everyone in the chat session
+def sendChat(state:ConData, out:str):
+    dbg(state, 'sending %s', 'trace', out) # debug
+    if state.isHost: # if host
+        sendChatToAll(state,state.lobby,str(out)) # send to our lobby
+        relaySend(state,'fed_msg * '+str(out)) # and to the linked hosts
+    elif state.resume != None and state.resume.reconnecting: # sent once we are back
+        state.resume.pending.append('1'+str(out))
+    else: # we are client
+        handler = connectedHost(state)
+        if handler != None:
+            handler.send('1'+str(out)) # send to server
+
+# sendDirect()
+# Params: username - username of the user it is for, text - the message
+# Desc: sends a direct message to one user of the chat session. The
+# host delivers it, a client asks the host to.
+def sendDirect(state:ConData, username:str, text:str):
+    dbg(state, 'sending to %s: %s', 'trace', username, text) # debug
+    if state.isHost: # if host
+        answer = directMessage(state,state.username,username,text)
+        if answer != None: # not delivered
+            state.sink.history(answer)
+    elif state.resume != None and state.resume.reconnecting: # sent as text once we are back, whatever the host speaks
+        state.resume.pending.append('0'+commandNames['msg_send'].text([username,text],True))
+    else: # we are client
+        handler = connectedHost(state)
+        if handler != None:
+            sendCommand(state,handler,'msg_send',username,text) # the host finds the user
+
+# sendFile()
+# Params: path - file to send
+# Desc: sends a file to everyone in the lobby. Returns False if there
+# is no such file.
+def sendFile(state:ConData, path:str) -> bool:
+    if not os.path.isfile(path):
+        state.sink.history('[Error]: '+path+' is not a file.\n')
+        return False
+    sender = fileSenderThread(state,path)
+    state.uploads[sender.tid] = sender # the host's answers find it by id
+    state.sink.history('Sending '+sender.filename+'...\n')
+    sender.start()
+    return True
+
+# askHistory()
+# Params: count - number of newest chat messages to show
+# Desc: shows the last messages of the chat session's history. A client
+# asks the host, which sends them like regular messages.
+def askHistory(state:ConData, count:int):
+    if state.isHost:
+        if state.lobby.history == None:
+            state.sink.history('[Info]: Chat history is not kept.\n')
+            return
+        state.sink.history(''.join(state.lobby.history.replay(last=count)))
+    else:
+        handler = connectedHost(state)
+        if handler != None:
+            sendCommand(state,handler,'hist_ask','last',count) # ask the host
+
+# searchHistory()
+# Params: terms - words to search for, page - page of results
+# Desc: searches the chat session's history. The host searches its own
+# index, a client asks the host.
+def searchHistory(state:ConData, terms:list, page:int = 1):
+    if state.isHost:
+        if state.search == None or state.lobby.history == None:
+            state.sink.history('[Info]: Chat history is not kept.\n')
+            return
+        state.search.search(state.lobby.history,terms,page,state.sink.history)
+    else:
+        handler = connectedHost(state)
+        if handler != None:
+            sendCommand(state,handler,'srch_ask',page,*terms) # ask the host
+
+# changeUsername()
+# Params: username - the new username
+# Desc: changes the username and lets the chat session know
+def changeUsername(state:ConData, username:str):
+    state.username = username # store new username
+    if state.socket != None: # if socket exist
+        if state.isHost: # if this is host
+            dbg(state, 'sending updated userlist to clients') # debug
+            with state.roster.lock:
+                if state.roster.rename(0,state.username): # the host is member 0 of its lobby
+                    sendRosterDelta(state,state.lobby,'ulist_rename',0,state.username)
+                    relayMember(state,'fed_rename',state.lobby,0,state.username)
+        else: # we are not host
+            dbg(state, 'sending new username to server') # debug
+            handler = connectedHost(state)
+            if handler != None:
+                sendCommand(state,handler,'usern_update',state.username) # send new username to server
@@ -0,0 +1,237 @@
+# ====================
+# Python chat program
+# ====================
+#
+# Author: Edren Dacaymat
+#
+# Description:
+# Headless chat server. Hosts a chat session the same way /behost
+# does, but without the wxPython window, so a host can run on a
+# machine without a display or as a background service.
+#
+# -----------------------------------
+# usage: python main.py --headless [server name] [port] [options]
+#    or: python headless.py [server name] [port] [options]
+#
+# options:
+# --clients [number of clients] - number of clients to listen (default 30)
+# --ip [ip address to use] - ip address to bind to
+# --engine [asyncio|thread] - server engine (default asyncio)
+# --workers [number] - worker processes that serve clients (default 0)
+# --username [username] - the host's username in the users list
+# --userrate [number] - chat messages per second a client may send (0 is no limit)
+# --lobbyrate [number] - chat messages per second a lobby may get (0 is no limit)
+# --nossl - do not use ssl
+# --nohistory - do not keep a chat history log
+# --nocompress - do not compress traffic for clients that ask for it
+# --link [host:port] - link with another host (can be given more than once)
+# --metrics [port] - serve the metrics on http://127.0.0.1:[port]/metrics
+# --profile [seconds] - profile the server for the first seconds (0 until it stops) and write a report
+# --config [file] - read the settings from a config file
+# --quiet - do not print the chat history
+# --debug - print debugging messages
+# --debuglevel [trace|Status|warn|error] - least important debugging messages printed (default Status)
+#
+# Settings given on the command line override the config file.
+# Config file example:
+#
+# [server]
+# name = chatserver
+# port = 9200
+# clients = 30
+# ip = 0.0.0.0
+# engine = asyncio
+# workers = 4
+# username = Host
+# userrate = 5
+# lobbyrate = 50
+# ssl = yes
+# history = yes
+# compress = yes
+# link = 10.0.0.2:9200 10.0.0.3:9200
+# metrics = 9300
+# profile = 60
+# -----------------------------------
+#
+# The server runs until it gets SIGINT (ctrl+c) or SIGTERM, then
+# closes the chat session like /end.
+
+# =======
+# Imports
+# =======
+import sys
+import argparse
+import configparser
+import signal
+import threading
+
+import chatcore
+from chatcore import ConData, eventSink, hostSession, linkSession, startMetrics, startProfile, endSession
+
+# ============
+# Console Sink
+# ============
+
+# consoleSink() : eventSink
+# chatcore.eventSink
+# Desc: prints the chat history to the console
+class consoleSink(eventSink):
+    # __init__()
+    # Desc: class init function
+    def __init__(self, quiet:bool = False):
+        self.quiet = quiet # do not print the chat history
+        self.lock = threading.Lock() # keep lines from different threads apart
+
+    # history()
+    # Params: self, text - text to add to the chat history
+    # Desc: prints text to stdout
+    def history(self, text:str):
+        if self.quiet:
+            return
+        with self.lock:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+# =========
+# Functions
+# =========
+
+# readSettings()
+# Params: argv - command line arguments
+# Desc: reads the server settings from the command line and the
+# optional config file. Returns a dict of settings.
+def readSettings(argv:list) -> dict:
+    parser = argparse.ArgumentParser(prog='headless', description='Headless chat server.')
+    parser.add_argument('--headless', action='store_true', help=argparse.SUPPRESS) # passed on by main.py
+    parser.add_argument('name', nargs='?', help='server name')
+    parser.add_argument('port', nargs='?', type=int, help='port number')
+    parser.add_argument('--clients', type=int, help='number of clients to listen')
+    parser.add_argument('--ip', help='ip address to use')
+    parser.add_argument('--engine', choices=['asyncio','thread'], help='server engine')
+    parser.add_argument('--workers', type=int, help='worker processes that serve clients')
+    parser.add_argument('--username', help="the host's username")
+    parser.add_argument('--userrate', type=float, help='chat messages per second a client may send')
+    parser.add_argument('--lobbyrate', type=float, help='chat messages per second a lobby may get')
+    parser.add_argument('--nossl', action='store_true', help='do not use ssl')
+    parser.add_argument('--nohistory', action='store_true', help='do not keep a chat history log')
+    parser.add_argument('--nocompress', action='store_true', help='do not compress traffic for clients that ask for it')
+    parser.add_argument('--link', action='append', help='another host to link with, as host:port')
+    parser.add_argument('--metrics', type=int, help='port to serve the metrics on')
+    parser.add_argument('--profile', type=float, help='seconds to profile the server for (0 until it stops)')
+    parser.add_argument('--config', help='config file to read the settings from')
+    parser.add_argument('--quiet', action='store_true', help='do not print the chat history')
+    parser.add_argument('--debug', action='store_true', help='print debugging messages')
+    parser.add_argument('--debuglevel', choices=['trace','Status','warn','error'], help='least important debugging messages printed')
+    args = parser.parse_args(argv)
+
+    # defaults, then the config file, then the command line
+    settings = {'name':'Server', 'port':None, 'clients':30, 'ip':None, 'engine':chatcore.serverEngine, 'workers':chatcore.hostWorkers,
+                'username':'Host', 'userrate':chatcore.userRate, 'lobbyrate':chatcore.lobbyRate, 'ssl':chatcore.sslEnable, 'history':chatcore.historyEnable, 'compress':chatcore.compressEnable, 'link':[], 'metrics':None, 'profile':None, 'quiet':False, 'debug':False, 'debuglevel':chatcore.debugLevel}
+    if args.config != None:
+        config = configparser.ConfigParser()
+        if len(config.read(args.config)) == 0:
+            parser.error('could not read config file '+args.config)
+        if config.has_section('server'):
+            server = config['server']
+            settings['name'] = server.get('name', settings['name'])
+            settings['port'] = server.getint('port', settings['port'])
+            settings['clients'] = server.getint('clients', settings['clients'])
+            settings['ip'] = server.get('ip', settings['ip'])
+            settings['engine'] = server.get('engine', settings['engine'])
+            settings['workers'] = server.getint('workers', settings['workers'])
+            settings['username'] = server.get('username', settings['username'])
+            settings['userrate'] = server.getfloat('userrate', settings['userrate'])
+            settings['lobbyrate'] = server.getfloat('lobbyrate', settings['lobbyrate'])
+            settings['ssl'] = server.getboolean('ssl', settings['ssl'])
+            settings['history'] = server.getboolean('history', settings['history'])
+            settings['compress'] = server.getboolean('compress', settings['compress'])
+            settings['link'] = server.get('link', '').split()
+            settings['metrics'] = server.getint('metrics', settings['metrics'])
+            settings['profile'] = server.getfloat('profile', settings['profile'])
+            settings['quiet'] = server.getboolean('quiet', settings['quiet'])
+            settings['debug'] = server.getboolean('debug', settings['debug'])
+            settings['debuglevel'] = server.get('debuglevel', settings['debuglevel'])
+    for key in ['name','port','clients','ip','engine','workers','username','userrate','lobbyrate','metrics','profile','debuglevel']:
+        if getattr(args, key) != None:
+            settings[key] = getattr(args, key)
+    if args.nossl:
+        settings['ssl'] = False
+    if args.nohistory:
+        settings['history'] = False
+    if args.nocompress:
+        settings['compress'] = False
+    if args.link != None:
+        settings['link'] = args.link
+    if args.quiet:
+        settings['quiet'] = True
+    if args.debug:
+        settings['debug'] = True
+
+    if settings['port'] == None:
+        parser.error('a port is required, on the command line or in the config file')
+    if settings['engine'] not in ['asyncio','thread']:
+        parser.error('unknown engine '+str(settings['engine']))
+    if settings['workers'] < 0:
+        parser.error('the number of worker processes can not be negative')
+    if settings['debuglevel'] not in chatcore.debugLevels:
+        parser.error('unknown debug level '+str(settings['debuglevel']))
+    if settings['userrate'] < 0 or settings['lobbyrate'] < 0:
+        parser.error('rate limits can not be negative')
+    if settings['profile'] != None and settings['profile'] < 0:
+        parser.error('the profiling time can not be negative')
+    for link in settings['link']:
+        (host,sep,port) = link.rpartition(':')
+        if sep == '' or not port.isdigit():
+            parser.error('link '+link+' is not host:port')
+    return settings
+
+# main()
+# Params: argv - command line arguments
+# Desc: hosts a chat session until the process is told to stop.
+# Returns the process exit code.
+def main(argv:list) -> int:
+    settings = readSettings(argv)
+
+    # apply the settings to the networking core
+    chatcore.debugMode = settings['debug']
+    chatcore.debugLevel = settings['debuglevel']
+    chatcore.printToHistory = False # debugging messages already go to stdout
+    chatcore.sslEnable = settings['ssl']
+    chatcore.historyEnable = settings['history']
+    chatcore.compressEnable = settings['compress']
+    chatcore.serverEngine = settings['engine']
+    chatcore.hostWorkers = settings['workers']
+    chatcore.userRate = settings['userrate']
+    chatcore.userBurst = max(int(2 * settings['userrate']), 1) # let a short burst through
+    chatcore.lobbyRate = settings['lobbyrate']
+    chatcore.lobbyBurst = max(int(2 * settings['lobbyrate']), 1)
+
+    state = ConData() # connection data
+    state.sink = consoleSink(settings['quiet']) # print the chat history
+    state.username = settings['username']
+
+    # stop on ctrl+c and on service stop
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    if not hostSession(state, settings['name'], settings['port'], settings['clients'], settings['ip']):
+        return 1 # could not create the server socket
+    if settings['metrics'] != None and not startMetrics(state, settings['metrics']):
+        endSession(state)
+        return 1 # could not serve the metrics
+    if settings['profile'] != None: # the report is written when the time is up or the server stops
+        startProfile(state, settings['profile'] or None)
+    for link in settings['link']: # link with the other hosts
+        (host,sep,port) = link.rpartition(':')
+        if not linkSession(state, host, int(port)):
+            state.sink.history('Could not link with '+link+'.\n')
+    while not stopped.wait(1.0): # wake up now and then so signals get handled everywhere
+        pass
+    state.sink.history('Terminating connection...\n')
+    endSession(state)
+    state.sink.history('Connection closed.\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
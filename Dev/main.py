@@ -16,6 +16,8 @@
 # 
 # /join - joins a chat server
 # usage: /join [server ip] [port]
+# to join a lobby other than the host's own:
+# /join [server ip] [port] [lobby name]
 # 
 # /end - ends connection
 # usage: /end
@@ -25,7 +27,57 @@
 # 
 # /username - change your username
 # usage /username [new username]
-# **note that your username should not have any spaces**
+# **note that older clients and hosts see spaces in your username as '_'**
+# 
+# /engine - select the server engine used by /behost
+# usage: /engine [asyncio|thread]
+# 
+# /workers - set the worker processes used by /behost
+# usage: /workers [number of processes]
+# 
+# /ratelimit - set the messages per second a client and a lobby may send,
+# used by /behost (0 is no limit). Without parameters shows the limits
+# and the messages they dropped.
+# usage: /ratelimit [per client] [per lobby]
+# 
+# /queues - show the outbound queue of every client (host only)
+# usage: /queues
+# 
+# /accepts - show the connections being admitted (host only)
+# usage: /accepts
+# 
+# /stats - show the traffic and timing counters of the chat session
+# usage: /stats
+# 
+# /profile - profile where the program spends its time and write a
+# report under the profiles directory
+# usage: /profile start [seconds]
+#        /profile stop
+# 
+# /history - show the last messages of the chat session
+# usage: /history [number of messages]
+# 
+# /search - search the chat session's history
+# usage: /search [words to search for]
+# 
+# /more - show the next page of search results
+# usage: /more
+# 
+# /lobbies - show the open lobbies (host only)
+# usage: /lobbies
+# 
+# /link - link your chat session with another host's (host only)
+# usage: /link [host ip] [port]
+# 
+# /send - send a file to everyone in your lobby
+# usage: /send [file path]
+# received files are saved in the downloads folder
+# 
+# /msg - send a message only one user sees, in any lobby of the host
+# usage: /msg [username] [message]
+# put a username with spaces in quotes: /msg "mary jane" [message]
+# **note that a user who disconnected gets it when they are back, if
+# they return within 10 minutes**
 # 
 # /exit - terminates application
 # usage: /terminate
@@ -40,7 +92,8 @@
 # Application does not automatically perform any port
 # forwarding so trying to make two clients run in a
 # nested network will not work. Both clients should be
-# present in the same network to avoid connection problems.
+# present in the same network to avoid connection problems,
+# or reach two hosts that are linked with "/link".
 # 
 # Designed and tested using Python 2.7.8 release version.
 # GUI created using wxPython 3.0-msw. Socket and threading 
@@ -57,9 +110,12 @@
 # PATH environment variable. That should make it easy to
 # run python programs in the command prompt.
 # 
-# Set variable debugMode to True to see debugging messages.
+# Set variable debugMode to True to see debugging messages,
+# and debugLevel to 'trace' to also see every message.
 # Set printToHistory to True to see debugging messages
 # printed in the chat history text box.
+# Set historyLines to change how many lines of chat history
+# the history text box keeps.
 
 
 # ==================================================
@@ -79,7 +135,6 @@
 # *SSL: system to auto generate certificates
 #
 # *implement a state system to remove dependence on global vars
-# *state system would allow for multiple chat lobbies
 # *update functions to use state system (functions should not modify any vars outside function)
 # *update classes to use state system (classes should not modify any vars outside of it scope)
 
@@ -98,24 +153,18 @@
 # =======
 # import all the dependencies
 import sys
+import collections
+import threading
 
 # before continuing we should check if application is compatible
 # with the current python version.
 if (sys.version_info < (3,6,6)):
     print('This application requires Python 3.6.6 or greater')
 
-# Import the rest of the dependencies
-import socket
-import threading
-import time
-import random
-import string
-
-# Try import SSL
-try: import ssl
-except ImportError: # import failed, show error.
-    print('This application requires the SSL module to run.')
-    sys.exit(11)
+# Headless server mode runs without the GUI toolkit
+if __name__ == '__main__' and '--headless' in sys.argv:
+    import headless
+    sys.exit(headless.main(sys.argv[1:]))
 
 # Import wxPython Module
 try: import wx # import the wxPython module.
@@ -123,404 +172,81 @@ except ImportError: # import failed, show error.
     print('This application requires the wxPython module to run.')
     sys.exit(10)
 
-# ================
-# Global Variables
-# ================
+# Import the networking core
+import chatcore
+from chatcore import *
 
-# ==================== To be replaced ====================
-# Holds the pointer to the history textctrl
-#historyData = ''
-# Holds the pointer to the users textctrl
-#userlistData = ''
-# Stores user's username
-#username = 'User_'+''.join(random.choice(string.digits) for i in range(5)) # generate a default username
-# Status variable that determines whether it is host or not
-#isHost = False
-# Array that stores all the client handler threads
-# Only the host make use of this
-#serverclients = []
-# ==================== To be replaced ====================
-
-# Debugging
-debugMode:bool = True
-sslEnable:bool = True
-printToHistory:bool = True
-
-# ===============
-# Connection Data
-# ===============
+# ======================
+# Main Application Frame
+# ======================
 
-# state() : Object
-# Desc: Connection data
-class ConData():
+# ================
+# Display Settings
+# ================
+historyLines:int = 5000 # lines of chat history kept in the history textctrl
+historyRefresh:int = 50 # milliseconds between history textctrl updates
+
+# wxSink() : eventSink
+# chatcore.eventSink
+# Desc: shows the networking core's events in the application frame.
+# Events can come from any thread, so they are only queued here and
+# the frame's refresh timer shows them on the GUI thread.
+class wxSink(eventSink):
     # __init__()
     # Desc: class init function
-    def __init__(self):
-        # Holds the pointer to the history textctrl
-        self.historyData:str = ''
-        # Holds the pointer to the users textctrl
-        self.userlistData:str = ''
-        # Stores user's username (default username is generated)
-        self.username:str = 'User_'+''.join(random.choice(string.digits) for i in range(5))
-        # Status variable that determines whether it is host or not
-        self.isHost:bool = False
-        # Array that stores all the client handler threads (Only the host make use of this)
-        self.serverclients:list[clientHandlerThread] = []
-
-# =========
-# Functions
-# =========
-
-# Debug output function.
-def dbg(state:ConData, msg:str, type:str = 'Status'):
-    if debugMode:
-        print('*['+type+']: '+msg)
-        if printToHistory:
-            state.historyData.AppendText('*['+type+']: '+msg+'\n')
-
-# sendToAll()
-# Params: msg - send message
-# Desc: facilitates sending a message to all clients
-def sendToAll(state:ConData, msg:string, notclients:str = []):
-    if isHost:
-        dbg('sending to all clients: '+str(msg))
-        for tc in state.serverclients:
-            if tc.username in notclients:
-                continue
-            if tc.is_alive() and (not tc.term):
-                try:
-                    tc.send(str(msg))
-                except socket.error as err:
-                    tc.stop()
-                    tc = None
-                    continue
-
-# updateUSersList()
-# Params: none
-# Desc: updates the users list textctrl
-def updateUsersList(state:ConData, sendupdate:bool = False):
-    dbg('updating user list')
-    if state.userlistData != '':
-        state.userlistData.Clear()
-        state.userlistData.AppendText('#['+str(state.username)+']\n')
-        for tc in state.serverclients:
-            if tc.is_alive() and (not tc.term):
-                state.userlistData.AppendText('#'+tc.username+'\n')
-    if sendupdate and state.isHost:
-        for tc in state.serverclients:
-            if tc.is_alive() and (not tc.term):
-                try:
-                    tc.send('0ulist_update '+state.userlistData.GetValue())
-                except socket.error as err:
-                    continue
-
-# serverSocket()
-# Params: port - Port number, cnum - Number of clients to listen
-# Desc: creates a server socket object with the supplied port
-# and listener number
-def serverSocket(state:ConData, port:int, cnum:int, iph:str):
-    servsock = socket.socket(socket.AF_INET,socket.SOCK_STREAM) # create socket object
-    servsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # set some options
-    # get ip address
-    hostaddr = ''
-    ifaces = socket.getaddrinfo(socket.gethostname(), int(port)) # get all possible ip addresses
-    for ifc in ifaces:
-        if ifc[0] == 2: # we will use ipv4 only to make life easier
-            if ifc[4][0] in ['127.0.0.1','127.0.1.1']: # ignore localhost
-                continue
-            hostaddr = ifc[4]
-    if iph != None: # override ip address with supplied ip
-        hostaddr = (str(iph),int(port))
-    dbg('using '+str(hostaddr)) # debug
-    try:
-        dbg('binding to socket')
-        servsock.bind(hostaddr) # bind to socket
-        dbg('listening for connections')
-        servsock.listen(cnum) # listen for connections
-        
-        dbg('server socket created and now listening. cnum: '+str(cnum)) # debug
-        return (servsock,hostaddr) # return socket object
-    except socket.error as err:
-        dbg('server socket could not be created! :'+str(err),'error') # debug
-        state.historyData.AppendText('Server socket could not be created on '+str(hostaddr)+':'+str(port)+'!\n'+str(err)+'\n')
-        return None
-    except Exception as err:
-        dbg('error encountered trying to create a server socket! :'+str(err), 'error') # debug
-        state.historyData.AppendText('Server Socket encountered an error!')
-        return None
-
-# clientSocket()
-# Params: port - Port number, hostip - The host to connect to,
-# Desc: creates a client socket object using the supplied parameters
-def clientSocket(state:ConData, port:int, hostip:str):
-    clisock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # create socket object
+    def __init__(self,frame):
+        self.frame = frame # store application frame
+        self.lock = threading.Lock() # guards the pending events
+        self.pending = [] # text waiting to be shown
+        self.users = None # roster waiting to be shown
+        self.scrollback = collections.deque() # lines shown in the history textctrl
     
-    try:
-        if sslEnable:
-            # SSL ##########
-            dbg('ssl setup...','SSL')
-            sslctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            sslctx.check_hostname = False
-            sslctx.verify_mode = ssl.CERT_REQUIRED
-            dbg('load default cert','SSL')
-            sslctx.load_default_certs()
-            sslctx.load_verify_locations('./srv/certificate.pem')
-            dbg('load cert chain', 'SSL')
-            sslctx.load_cert_chain(certfile='./cli/certificate.pem', keyfile='./cli/key.pem')
-            dbg('wrap socket','SSL')
-            clisock = sslctx.wrap_socket(clisock)
-            dbg('ssl socket created!','SSL')
-            # SSL ##########
-        
-        dbg('connecting to host')
-        clisock.connect((hostip,port)) # connect to host
-        dbg('enabling keepalive')
-        if clisock.getsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0:
-            clisock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1) # enable keepalive
-        dbg('client connected') # debug
-        return clisock #return socket object
-    except socket.error as err:
-        dbg('could not connect to server! :'+str(err),'error') # debug
-        state.historyData.AppendText('Could not connect to server!\n'+str(err)+'\n') # print to history textctrl
-        return None
-    except ssl.SSLError as err:
-        dbg('client ssl error! :'+str(err), 'error') # debug
-        state.historyData.AppendText('Client SSL error!\n')
-        return None
-    except Exception as err:
-        dbg('error encountered trying to create a client socket! :'+str(err), 'error') # debug
-        state.historyData.AppendText('Client Socket encountered an error!')
-        return None
-
-# closeSocket()
-# Params: sock - teh socket object, noshut - whether we should
-# call shutdown or not (default FALSE)
-# Desc: closes and shuts down a socket connection
-def closeSocket(state:ConData, sock, noshut:bool = False):
-    if sock == None: # we only attempt to close socket if it exist
-        return
-    if not noshut:
-        try:
-            sock.shutdown(socket.SHUT_RDWR)
-        except socket.error as err:
-            dbg(state, 'socket shutdown error: '+str(err))
-    sock.close()
-
-# ==============
-# Thread Classes
-# ==============
-
-# clientHandlerThread() : THREAD
-# threading.Thread
-# Desc: thread that handles the connection to a client
-class clientHandlerThread(threading.Thread):
-    # __init__()
-    # Desc: class init function
-    def __init__(self,ip,port,sock):
-        threading.Thread.__init__(self) # initialize thread class
-        self.ip = ip # store ip 
-        self.port = port # store port
-        self.sock = sock # store socket
-        self.username = '?' # store client username
-        self.daemon = True # make thread daemon
-        self.term = False # terminate status
-        dbg('client handler thread created!') # debug
+    # history()
+    # Params: self, text - text to add to the chat history
+    # Desc: queues text for the history textctrl. Safe to call from any thread.
+    def history(self,text):
+        with self.lock:
+            self.pending.append(text)
     
-    # stop()
-    # Params: self
-    # Desc: terminated the thread
-    def stop(self):
-        dbg('thread terminate requested') # debug
-        self.term = True # terminate thread
+    # userlist()
+    # Params: self, roster - rosterData of the chat session
+    # Desc: marks the users list for an update. It is rendered once on
+    # the next refresh however many changes came in. Safe to call from
+    # any thread.
+    def userlist(self,roster):
+        with self.lock:
+            self.users = roster
     
-    # run()
+    # closed()
     # Params: self
-    # Desc: main thread routine
-    def run(self):
-        dbg('client handler thread started!') # debug
-        
-        # main thread loop
-        while not self.term:
-            global historyData # access global variable historyData
-            global userlistData # access global variable userlistData
-            global isHost # access global variable isHost
-            try:
-                self.buffer = str(self.sock.recv(512).decode('utf-8')) # retrieve message sent by client
-                if len(self.buffer) > 0: # check if len is not 0
-                    dbg('received data from client: '+self.buffer) # debug
-                    lock = threading.RLock() # create thread lock
-                    lock.acquire(True) # get lock
-                    try:
-                        # interpret received message
-                        # 0 - command message, 1 - regular message
-                        # usern_update - update client username
-                        # ulist_update - update user names list
-                        # ulist_asknew - ask for user list update
-                        dbg('interpreting data from client: '+self.buffer) # debug
-                        if self.buffer[:1] =='0': # command message
-                            dbg('command message') # debug
-                            params = self.buffer[1:].split(' ') # split message into keywords
-                            if params[0] == 'usern_update': # a username update command
-                                dbg('username update') # debug
-                                self.username = str(params[1]) # change username
-                                updateUsersList(True) # update users list
-                            elif params[0] == 'ulist_update': # users list update command
-                                dbg('users list update') # debug
-                                userlistData.SetValue(str(params[1])) # change users list value
-                            elif params[0] == 'ulist_asknew': # ask for a user list update
-                                dbg('asking for a user list update') # debug
-                                updateUsersList(True) # send users list
-                            elif params[0] == 'sock_shutreq': # socket shutdown request
-                                if not isHost: # if we are a client
-                                    dbg('server requested to close connection') # debug
-                                    global frame # access global variable frame
-                                    frame.cmdExecute(['/end']) # send a '/end' command to console
-                                    dbg('client handler thread terminated.') # debug
-                                    return # end thread
-                            else: # command does not exist
-                                dbg('unknown command','warn') # debug
-                        elif self.buffer[:1] == '1': # regular message
-                            dbg('regular message') # debug
-                            if historyData != '': # if historyData pointer is not empty
-                                historyData.AppendText(self.buffer[1:]) # show msg to chat history
-                            sendToAll(self.buffer,[self.username]) # echo to other clients
-                        else: # invalid message type
-                            dbg('unknown message','warn') # debug
-                    finally: # release lock
-                        lock.release() # release lock
-                else: # socket closed
-                    break # break out of loop
-            except socket.error as err:
-                if self.term: # check if we are not asked to terminate
-                    break # if yes then break out of loop
-        closeSocket(self.sock,isHost) # close client socket
-        self.sock = None # clear socket
-        self.term = True # set termination to True
-        dbg('client handler thread terminated.') # debug
-        historyData.AppendText(''+str(self.username)+' disconnected!\n') # show disconnect status
-        sendToAll('1'+str(self.username)+' disconnected!\n', [self.username]) # send status to other clients
-        updateUsersList(True) # update users list
-        return # terminate thread
+    # Desc: the host asked us to close the connection
+    def closed(self):
+        wx.CallAfter(self.frame.cmdExecute,['/end']) # send a '/end' command to console
     
-    # send()
+    # flush()
     # Params: self
-    # Desc: send message to client
-    def send(self,data):
-        if self.sock != None: # is socket variable is not empty
-            dbg('sending to client: '+str(data)) # debug
-            try:
-                self.sock.send(bytes(str(data), encoding='utf-8')) # send message to client
-            except socket.error as err: # could not send message to client
-                dbg('could not send message!\n'+str(err),'error') # debug
-                # show send error message to chat history
-                historyData.AppendText('Cannot send message to '+str(self.username)+'!\n'+str(err)+'\n')
-                # client is assumed to be dead so we close connections and terminate thread
-                self.stop()
-
-# connectionHandlerThread() : THREAD
-# threading.Thread
-# Desc: thread handles accepting connections
-class connectionHandlerThread(threading.Thread):
-    # __init__()
-    # Desc: class init function
-    def __init__(self,sock):
-        threading.Thread.__init__(self) # initialize thread
-        self.sock = sock # store sock param
-        self.sock.setblocking(0) # set socket to nonblocking
-        self.daemon = True # make this thread daemon
-        self.term = False # termination status
-        dbg('connection handler thread created!') # debug
-    
-    # stop()
-    # Params: self
-    # Desc: terminates thread
-    def stop(self):
-        self.term = True
-    
-    # run()
-    # Params: self
-    # Desc: main thread routine
-    def run(self):
-        dbg('connection handler thread started!') # debug
-        clsock,ip,port,user = None,None,None,None # init variables
-        global serverclients # access global variable serverclients
-        
-        # routine loop
-        while not self.term: # while not terminating
-            # accept connection loop
-            while not self.term: # while not terminating
-                try:
-                    (clsock,(ip,port)) = self.sock.accept() # accept connections
-                    dbg('accepted a connection') # debug
-        
-                    if sslEnable:
-                        # SSL ##########
-                        dbg('ssl setup...','SSL')
-                        sslctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-                        sslctx.check_hostname = False
-                        sslctx.verify_mode = ssl.CERT_REQUIRED
-                        dbg('load default certs', 'SSL')
-                        sslctx.load_default_certs()
-                        sslctx.load_verify_locations('./cli/certificate.pem')
-                        dbg('load cert chain','SSL')
-                        sslctx.load_cert_chain(certfile='./srv/certificate.pem', keyfile='./srv/key.pem')
-                        dbg('wrap socket','SSL')
-                        clsock = sslctx.wrap_socket(clsock, server_side=True)
-                        dbg('ssl socket created!','SSL')
-                        # SSL ##########
-                    
-                    break # break loop
-                except socket.error as err: # handle socket error
-                    if self.term: # if terminating
-                        closeSocket(clsock) # close socket
-                        dbg('connection handler thread terminated.') # debug
-                        return # terminate thread
-                except ssl.SSLError as err:
-                    dbg('ssl error on connection accept :'+str(err), 'error')
-                    historyData.AppendText('SSL error on client connect!\n')
-                    return
-                except Exception as err:
-                    dbg('error on accept :'+str(err), 'error')
-                    historyData.AppendText('Error on connection attempt!\n')
-                    return # terminate thread
-            clsock.setblocking(1) # temporarily set client socket to be blocking
-            user = str(clsock.recv(512).decode('utf-8')) # receive initial command from client
-            if user[:1] == '0': # if msg is command
-                params = user[1:].split(' ') # split text with space as delimiters
-                if params[0] == 'usern_update': # if username update command
-                    nusername = params[1] # store username
-                    clsock.send(bytes('1Welcome '+str(nusername)+'!\n', encoding='utf-8')) # send a welcome message to client
-                    if historyData != '': # if historyData pointer is not empty
-                        # print status
-                        historyData.AppendText(''+str(nusername)+' has joined the chat.\n')
-                        sendToAll('1'+str(nusername)+' has joined the chat.\n', [str(nusername)])
-                    dbg('connection accepted!') # debug
-                    clsock.setblocking(0) # make socket nonblocking
-                    if clsock.getsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0:
-                        clsock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1) # enable keepalive
-                    cthread = clientHandlerThread(ip,port,clsock) # create new handler thread
-                    cthread.username = nusername # set username for client
-                    cthread.start() # start client handler thread
-                    lock = threading.RLock() # create lock
-                    lock.acquire(True) # get a lock
-                    try:
-                        serverclients.append(cthread) # add client thread to serverclients array
-                    finally:
-                        lock.release() # release lock
-                else:
-                    closeSocket(clsock) # close connection
-                    dbg('connection declined! - wrong operation','warn') # debug
-            else:
-                closeSocket(clsock) # close connection
-                dbg('connection declined! - wrong message type','warn') # debug
-                dbg(user, 'warn')
-        closeSocket(clsock) # close client connection
-        dbg('connection handler thread terminated.') # debug
-        return # terminate thread 
-
-# ======================
-# Main Application Frame
-# ======================
+    # Desc: shows the queued events with one update per textctrl.
+    # Runs on the GUI thread.
+    def flush(self):
+        with self.lock: # take the queued events
+            (pending,self.pending) = (self.pending,[])
+            (users,self.users) = (self.users,None)
+        if users != None:
+            self.frame.users.SetValue(users.text())
+        if len(pending) == 0:
+            return
+        text = ''.join(pending) # coalesce into a single append
+        self.scrollback.extend(text.splitlines(True))
+        if len(self.scrollback) <= historyLines + historyLines//4: # room left
+            self.frame.history.AppendText(text)
+            return
+        # over the cap, drop the oldest lines in one go so the
+        # textctrl is rewritten once every historyLines/4 lines at most
+        while len(self.scrollback) > historyLines:
+            self.scrollback.popleft()
+        self.frame.history.ChangeValue(''.join(self.scrollback))
+        self.frame.history.SetInsertionPointEnd() # keep the view at the newest line
+        self.frame.history.ShowPosition(self.frame.history.GetLastPosition())
 
 # appFrame() : wxFRAME
 # wx.Frame
@@ -530,10 +256,9 @@ class appFrame(wx.Frame):
         wx.Frame.__init__(self,parent,title=title,size=(500,450)) # create app frame
         
         # application variables
-        self.conhandler = None # connections handler thread
-        self.servername = 'Debug' # chat server name (only if this is host)
+        self.state = ConData() # connection data
         self.userslist = [] # list of users
-        self.socket = None # socket object
+        self.lastsearch = None # words of the last search and the page shown
         
         # create text boxes
         self.history = wx.TextCtrl(self,style=(wx.TE_MULTILINE|wx.TE_READONLY|wx.TE_WORDWRAP)) # history textctrl
@@ -541,11 +266,11 @@ class appFrame(wx.Frame):
         self.input = wx.TextCtrl(self,style=(wx.TE_PROCESS_ENTER|wx.TE_PROCESS_TAB|wx.TE_WORDWRAP)) # input textctrl
         self.input.SetFocus() # set initial focus to input box
         
-        # assign pointers to textboxes
-        global historyData # access global variable historyData
-        global userlistData # access global variable userlistData
-        historyData = self.history # set pointer
-        userlistData = self.users # set pointer
+        # show network events in the textboxes
+        self.state.sink = wxSink(self) # set sink
+        self.refresher = wx.Timer(self) # shows the queued events
+        self.Bind(wx.EVT_TIMER, self.OnRefresh, self.refresher) # bind OnRefresh function to the timer
+        self.refresher.Start(historyRefresh)
         
         # create the sizer for the top half of frame
         self.topsizer = wx.BoxSizer(wx.HORIZONTAL) # create sizer
@@ -568,10 +293,10 @@ class appFrame(wx.Frame):
                           'Change your username by typing "/username [new username]"\n\n'
                           'For more info about the commands type "/help"\n\n'
                           )
-        self.history.AppendText(self.starthelp) # display initial help text to history textctrl
+        self.state.sink.history(self.starthelp) # display initial help text to history textctrl
         
         # commands list
-        self.cmdlist = ['/help','/join','/behost','/username','/exit','/end']
+        self.cmdlist = ['/help','/join','/behost','/username','/exit','/end','/engine','/workers','/ratelimit','/queues','/accepts','/stats','/profile','/history','/search','/more','/lobbies','/link','/send','/msg']
         if debugMode:
             self.cmdlist = self.cmdlist + ['/dbghost','/dbgjoin']
         
@@ -579,124 +304,218 @@ class appFrame(wx.Frame):
         self.SetSizer(self.appsizer) # set the app's sizer
         self.SetAutoLayout(True) # enable automatic layout
         self.Show(True) # show app
-        dbg('application started') # debug
-        dbg('version info: '+str(sys.version_info))
+        dbg(self.state, 'application started') # debug
+        dbg(self.state, 'version info: '+str(sys.version_info))
         if (sys.version_info < (3,6,6)):
-            dbg('This application requires Python 3.6.6 or greater', 'warning')
-            self.history.AppendText('This application requires Python 3.6.6 or greater\n\n')
+            dbg(self.state, 'This application requires Python 3.6.6 or greater', 'warning')
+            self.state.sink.history('This application requires Python 3.6.6 or greater\n\n')
     
     # OnTerminate()
     # Params: self, event - provided by event
     # Desc: executes routine for application termination
     def OnTerminate(self,event):
-        global isHost # access global variable isHost
+        state = self.state
         
-        # terminate clientHandlerThread threads
-        for tc in serverclients: # loop through array
-            if isHost:
-                tc.send('0sock_shutreq') # send a connection shutdown command
-            tc.stop() # stop connection
-        
-        # terminate connectionHandlerThread thread
-        if self.conhandler != None: # if conhandler exist
-            self.conhandler.stop() # stop connectionHandlerThread thread
-        
-        # close socket
-        closeSocket(self.socket,isHost) # close the socket
+        # terminate threads and close socket
+        self.refresher.Stop() # stop showing events
+        endSession(state,0) # end the chat session
         
         # termination done.
-        dbg('exiting...') # debug
+        dbg(state, 'exiting...') # debug
         self.Destroy() # destroy application
     
     # cmdExecute()
     # Params: self,keys - array of keywords
     # # Desc: interprets input and executes specified command
     def cmdExecute(self,keys):
-        global username # access global variable username
-        global isHost # access global variable isHost
-        global serverclients # access global variab;e serverclients
+        state = self.state
         
-        dbg(keys[0]) # debug - print keys
+        dbg(state, keys[0]) # debug - print keys
         
         if keys[0] == '/help': # display help
             helptext = ("/help - display this help.\n"
                         "/join [server ip] [port] - joins a server.\n"
+                        "/join [server ip] [port] [lobby name] - joins a lobby of a server.\n"
                         "/behost [server name] [port] - start a chat session.\n"
                         "/behost [server name] [port] [# of clients] [ip to use] - advanced server setup. Useful in case of socket creation errors.\n"
                         "/end - ends a connection or closes the chat session.\n"
                         "/username [username] - change username.\n"
+                        "/engine [asyncio|thread] - select the server engine used by /behost.\n"
+                        "/workers [# of processes] - set the worker processes used by /behost (0 serves every client in this process).\n"
+                        "/ratelimit [per client] [per lobby] - set the messages per second a client and a lobby may send (0 is no limit).\n"
+                        "/queues - show the outbound queue of every client (host only).\n"
+                        "/accepts - show the connections being admitted (host only).\n"
+                        "/stats - show the traffic and timing counters of the chat session.\n"
+                        "/profile start [seconds] - profile where the time goes, until /profile stop or for some seconds.\n"
+                        "/profile stop - stop profiling and write the report.\n"
+                        "/history [# of messages] - show the last messages of the chat session.\n"
+                        "/search [words] - search the chat session's history.\n"
+                        "/more - show the next page of search results.\n"
+                        "/lobbies - show the open lobbies (host only).\n"
+                        "/link [host ip] [port] - link your chat session with another host's (host only).\n"
+                        "/send [file path] - send a file to everyone in your lobby.\n"
+                        "/msg [username] [message] - send a message only that user sees (quote a username with spaces).\n"
                         "/exit - terminate application.\n"
                         )
-            self.history.AppendText(helptext) # write help text to history textctrl
+            self.state.sink.history(helptext) # write help text to history textctrl
             
         elif keys[0] == '/exit': # exit application
             self.Close() # terminate application
             
         elif keys[0] == '/end': # end chat
-            self.history.AppendText('Terminating connection...\n')
-            
-            # terminate client threads
-            for tc in serverclients:
-                if isHost:
-                    tc.send('0sock_shutreq') # send connection shutdown comand
-                tc.stop() # close socket
-            # terminate connection handler
-            if self.conhandler != None: # if conhandler thread exist
-                self.conhandler.stop() # terminate connection handler thread
-            # close sockets
-            closeSocket(self.socket,isHost) # close socket
-            
-            # connection close routine done
-            time.sleep(0.5) # making sure that timeouts have passed
-            self.socket = None # remove socket object
-            self.history.AppendText('Connection closed.\n') # print status to history textctrl
-            serverclients = [] # clear all client handler threads
-            self.conhandler = None # remove conhandler object
+            self.state.sink.history('Terminating connection...\n')
+            endSession(state) # terminate threads and close sockets
+            self.state.sink.history('Connection closed.\n') # print status to history textctrl
             
+        elif keys[0] == '/engine': # select server engine
+            if len(keys) == 2 and keys[1] in ['asyncio','thread']: # check if parameter is valid
+                chatcore.serverEngine = keys[1] # store parameter 1 to variable serverEngine
+                self.state.sink.history('Server engine is now "'+chatcore.serverEngine+'"\n') # print status
+            else:
+                # print an error message
+                self.state.sink.history('[Info]: Server engine is "'+chatcore.serverEngine+'". Use "/engine [asyncio|thread]" to change it.\n')
+
+        elif keys[0] == '/workers': # set worker processes
+            if len(keys) == 2 and keys[1].isdigit(): # check if parameter is valid
+                chatcore.hostWorkers = int(keys[1]) # store parameter 1 to variable hostWorkers
+                self.state.sink.history('Worker processes are now '+str(chatcore.hostWorkers)+'\n') # print status
+            else:
+                # print an error message
+                self.state.sink.history('[Info]: Worker processes are '+str(chatcore.hostWorkers)+'. Use "/workers [number of processes]" to change it.\n')
+
+        elif keys[0] == '/ratelimit': # set rate limits
+            try: # rates may have a fraction, e.g. 0.5 is a message every 2 seconds
+                rates = [float(key) for key in keys[1:]]
+            except ValueError as err:
+                rates = []
+            if len(rates) == 2 and all(0 <= rate < float('inf') for rate in rates): # check if parameters are valid
+                chatcore.userRate = rates[0] # messages per second per client
+                chatcore.userBurst = max(int(2 * rates[0]), 1) # let a short burst through
+                chatcore.lobbyRate = rates[1] # messages per second per lobby
+                chatcore.lobbyBurst = max(int(2 * rates[1]), 1)
+                self.state.sink.history('Rate limits are now '+str(rates[0])+' per client and '+str(rates[1])+' per lobby\n') # print status
+            else:
+                # print the limits and what they dropped
+                self.state.sink.history(rateStats(state)+'[Info]: Use "/ratelimit [per client] [per lobby]" to change them.\n')
+
+        elif keys[0] == '/queues': # show outbound queues
+            if state.isHost and state.socket != None: # only the host has client queues
+                self.state.sink.history(queueStats(state)) # print queue report
+            else:
+                self.state.sink.history('[Info]: Not hosting a chat session.\n')
+
+        elif keys[0] == '/accepts': # show accept pipeline
+            if state.isHost and state.conhandler != None: # only the host accepts connections
+                self.state.sink.history(state.conhandler.counters.report()) # print accept report
+            else:
+                self.state.sink.history('[Info]: Not hosting a chat session.\n')
+
+        elif keys[0] == '/stats': # show metrics
+            if state.socket != None: # counted while in a chat session
+                self.state.sink.history(metricsText(state)) # print metrics
+            else:
+                self.state.sink.history('Not in a session and not hosting session.\n')
+
+        elif keys[0] == '/profile': # profile the pipeline
+            if len(keys) in [2,3] and keys[1] == 'start' and (len(keys) == 2 or keys[2].isdigit()): # check if parameters are valid
+                if not startProfile(state,int(keys[2]) if len(keys) == 3 else None): # samples until stopped
+                    self.state.sink.history('[Info]: Already profiling. Use "/profile stop" to write the report.\n')
+            elif len(keys) == 2 and keys[1] == 'stop':
+                if stopProfile(state) == None: # writes the report
+                    self.state.sink.history('[Info]: Not profiling.\n')
+            else:
+                # print an error message
+                self.state.sink.history('[Info]: Use "/profile start [seconds]" or "/profile stop".\n')
+
+        elif keys[0] == '/lobbies': # show open lobbies
+            if state.isHost and state.socket != None: # only the host has lobbies
+                self.state.sink.history(lobbyStats(state)) # print lobby report
+            else:
+                self.state.sink.history('[Info]: Not hosting a chat session.\n')
+        
+        elif keys[0] == '/link': # link with another host
+            if not (state.isHost and state.socket != None): # only a host links
+                self.state.sink.history('[Info]: Not hosting a chat session.\n')
+            elif len(keys) == 3 and keys[2].isdigit(): # check if parameters are sufficient
+                linkSession(state,str(keys[1]),int(keys[2])) # connect to the other host
+            else:
+                # print error message
+                self.state.sink.history('[Error]: Command requires 2 parameters: [host ip] [port]\n')
+        
+        elif keys[0] == '/send': # send a file
+            path = ' '.join(keys[1:]).strip() # paths may have spaces
+            if state.socket == None: # not in a chat session
+                self.state.sink.history('Not in a session and not hosting session.\n')
+            elif path != '':
+                sendFile(state,path) # stream it to the lobby
+            else:
+                # print error message
+                self.state.sink.history('[Error]: Command requires 1 parameter: [file path]\n')
+        
+        elif keys[0] == '/msg': # send a direct message
+            rest = ' '.join(keys[1:]).strip()
+            if rest[:1] == '"' and '"' in rest[1:]: # quoted username, may have spaces
+                (username,sep,text) = rest[1:].partition('"')
+            else:
+                (username,sep,text) = rest.partition(' ')
+            text = text.strip()
+            if state.socket == None: # not in a chat session
+                self.state.sink.history('Not in a session and not hosting session.\n')
+            elif username != '' and text != '':
+                if username != state.username: # a message to ourselves is shown once it arrives
+                    self.state.sink.history('['+state.username+' -> '+username+']: '+text+'\n') # print output to history textctrl
+                sendDirect(state,username,text) # the host finds the user
+            else:
+                # print error message
+                self.state.sink.history('[Error]: Command requires 2 parameters: [username] [message]\n')
+        
+        elif keys[0] == '/history': # show chat history
+            if state.socket == None: # not in a chat session
+                self.state.sink.history('Not in a session and not hosting session.\n')
+            elif len(keys) == 2 and keys[1].isdigit():
+                askHistory(state,int(keys[1])) # show the last messages
+            else:
+                askHistory(state,historyReplay) # show as many as a client gets on join
+        
+        elif keys[0] == '/search' or keys[0] == '/more': # search chat history
+            terms = [key for key in keys[1:] if key != '']
+            if state.socket == None: # not in a chat session
+                self.state.sink.history('Not in a session and not hosting session.\n')
+            elif keys[0] == '/search' and len(terms) > 0:
+                self.lastsearch = (terms,1)
+                searchHistory(state,terms,1) # show the first page
+            elif keys[0] == '/more' and self.lastsearch != None:
+                self.lastsearch = (self.lastsearch[0],self.lastsearch[1]+1)
+                searchHistory(state,self.lastsearch[0],self.lastsearch[1]) # show the next page
+            elif keys[0] == '/search':
+                self.state.sink.history('[Info]: Nothing to search for. Use "/search [words]".\n')
+            else:
+                self.state.sink.history('[Info]: No search to continue.\n')
+        
         elif keys[0] == '/username': # change you username
-            if len(keys) == 2: # check if amount of parameters are sufficient
-                username = str(keys[1]) # store parameter 1 to variable username
-                self.history.AppendText('Your username is now "'+username+'"\n') # print status
-                if self.socket != None: # if socket exist
-                    if isHost: # if this is host
-                        dbg('sending updated userlist to clients') # debug
-                        updateUsersList(True) # update the users list
-                    else: # we are not host
-                        dbg('sending new username to server') # debug
-                        self.socket.send(bytes('0usern_update '+username, encoding='utf-8')) # send new username to server
+            if ' '.join(keys[1:]).strip() != '': # check if amount of parameters are sufficient
+                changeUsername(state,' '.join(keys[1:]).strip()) # the rest of the line is the new username
+                self.state.sink.history('Your username is now "'+state.username+'"\n') # print status
             else:
                 # print an error message
-                self.history.AppendText('[Info]: New username not provided. Username not changed.\n')
+                self.state.sink.history('[Info]: New username not provided. Username not changed.\n')
             
-        elif keys[0] == '/join' and (self.socket == None): # join a chat session
-            if len(keys) == 3: # check if parameters are sufficient
-                dbg('joining server...') # debug
+        elif keys[0] == '/join' and (state.socket == None): # join a chat session
+            if len(keys) in [3,4]: # check if parameters are sufficient
                 hostip = str(keys[1]) # store parameter 1 to hostname
                 port = int(keys[2]) # store parameter 2 to port
-
-                self.socket = clientSocket(port, hostip,username) # create a client socket object
-                if self.socket == None: # if socket creation failed
-                    dbg('Socket creation failed!','Error')
-                    return # return function
-                isHost = False # we are not host
-                
-                dbg('asking to update username')
-                self.socket.send(bytes('0usern_update '+str(username), encoding='utf8')) # send a username update command
-                
-                clihandler = clientHandlerThread(None,None,self.socket) # create a client handler thread to listen to server
-                clihandler.username = 'Host'
-                clihandler.start() # start thread
-
-                serverclients.append(clihandler) # place in serverclients array - this will be the only thread in the array
-                self.socket.send(bytes('0ulist_asknew', encoding='utf-8')) # ask for an updated users list
+                if len(keys) == 4:
+                    lobby = str(keys[3]) # store parameter 3 to lobby
+                else:
+                    lobby = None # the host's own lobby
+                joinSession(state,hostip,port,lobby) # connect to the host
             else:
                 # print error message
-                self.history.AppendText('[Error]: Command requires 2 parameters: [host ip] [port]\n')
+                self.state.sink.history('[Error]: Command requires 2 parameters: [host ip] [port] and an optional [lobby name]\n')
             
-        elif keys[0] == '/behost' and (self.socket == None): # start a chat session
+        elif keys[0] == '/behost' and (state.socket == None): # start a chat session
             if len(keys) in [3,4,5]: # check if parameters are sufficient
-                dbg('hosting a chat session...') # debug
-                self.servername = str(keys[1]) # set servername to parameter 1
+                servername = str(keys[1]) # set servername to parameter 1
                 port = int(keys[2]) # store param 2 to port 
                 if len(keys) >= 4: # if number of parameters are 3 or more
                     cnum = int(keys[3]) # set param 3 as cnum
@@ -706,67 +525,41 @@ class appFrame(wx.Frame):
                     hostip = str(keys[4])
                 else:
                     hostip = None
-                dbg('starting '+self.servername+' with port '+str(port)+' and max members of '+ str(cnum)) # debug
-                self.socket,sockaddr = serverSocket(port,cnum,hostip) # create server socket object
-                if self.socket == None: # if socket creation failed
-                    return # return function
-                self.conhandler = connectionHandlerThread(self.socket) # create connection handler thread
-                self.conhandler.start() # start conhandler thread
-                # print status
-                self.history.AppendText('Chat session "'+self.servername+'" started on '+str(sockaddr[0])+' port '+str(sockaddr[1])+'.\n')
-                isHost = True # we are host
+                hostSession(state,servername,port,cnum,hostip) # start the chat session
             else:
                 # print error message
-                self.history.AppendText(('[Error]: Command requires at least 2 parameters: "/behost [servername] [port]"\n'
+                self.state.sink.history(('[Error]: Command requires at least 2 parameters: "/behost [servername] [port]"\n'
                                          'Advanced setup: "/behost [servername] [port] [number of clients] [host ip]"\n'
                                          ))
         
-        elif keys[0] == '/dbghost' and (self.socket == None): # debug host
-            dbg('hosting a chat session...')
-            dbg('starting debugserver with port 24000 and max members of 30') # debug
-            self.socket,sockaddr = serverSocket(24000,30,"localhost") # create server socket object
-            if self.socket == None: # if socket creation failed
-                    return # return function
-            self.conhandler = connectionHandlerThread(self.socket) # create connection handler thread
-            self.conhandler.start() # start conhandler thread
-            # print status
-            self.history.AppendText('Chat session "'+self.servername+'" started on '+str(sockaddr[0])+' port '+str(sockaddr[1])+'.\n')
-            isHost = True # we are host
-
-        elif keys[0] == '/dbgjoin' and (self.socket == None): # debug join
-            dbg('joining server...') # debug
-            self.socket = clientSocket(24000, "localhost",username) # create a client socket object
-            if self.socket == None: # if socket creation failed
-                dbg('Socket creation failed!','Error')
-                return # return function
-            isHost = False # we are not host
-
-            dbg('asking to update username')
-            self.socket.send(bytes('0usern_update '+str(username), encoding='utf8')) # send a username update command
+        elif keys[0] == '/dbghost' and (state.socket == None): # debug host
+            hostSession(state,state.servername,24000,30,"localhost") # start the debug chat session
 
-            clihandler = clientHandlerThread(None,None,self.socket) # create a client handler thread to listen to server
-            clihandler.username = 'Host'
-            clihandler.start() # start thread
-
-            serverclients.append(clihandler) # place in serverclients array - this will be the only thread in the array
-            self.socket.send(bytes('0ulist_asknew', encoding='utf-8')) # ask for an updated users list
+        elif keys[0] == '/dbgjoin' and (state.socket == None): # debug join
+            joinSession(state,"localhost",24000,keys[1] if len(keys) > 1 else None) # connect to the debug host
 
         else:
             # print error message
-            self.history.AppendText('[Error]: Unknown command\n')
+            self.state.sink.history('[Error]: Unknown command\n')
                     
-        dbg('op done.') # debug
+        dbg(state, 'op done.') # debug
         return # return function
     
+    # OnRefresh()
+    # Params: self, event - provided by event
+    # Desc: shows the events queued since the last refresh
+    def OnRefresh(self,event):
+        self.state.sink.flush()
+    
     # OnEnter()
     # Params: self,event - provided by event
     # Desc: handles event when enter is pressed
     def OnEnter(self,event):
-        global isHost # access global variable isHost
+        state = self.state
         
         # enter has been pressed
         inp = self.input.GetValue().lstrip() # strip trailing whitespace from input
-        out = '[' + username + ']: ' + inp + '\n' # prepare output
+        out = '[' + state.username + ']: ' + inp + '\n' # prepare output
         self.input.Clear() # clear input box
         
         # check if input is command
@@ -777,25 +570,16 @@ class appFrame(wx.Frame):
                 self.cmdExecute(keys) # executes command
             else: # command is invalid
                 #print error message
-                self.history.AppendText('[ERROR]: Unknown command.\n')
-                dbg('Unknown command.','error') # debug
+                self.state.sink.history('[ERROR]: Unknown command.\n')
+                dbg(state, 'Unknown command.','error') # debug
         else:
             # treat as regular text
-            if self.socket == None: # if socket does not exist
+            if state.socket == None: # if socket does not exist
                 # print error message
-                self.history.AppendText('Not in a session and not hosting session.\n')
+                self.state.sink.history('Not in a session and not hosting session.\n')
             else: # if socket exist
-                self.history.AppendText(out) # print output to history textctrl
-                dbg('sending '+str(out)) # debug
-                if isHost: # if host
-                    # send to all clients
-                    for tc in serverclients:
-                        if tc.is_alive(): # if thread is not dead
-                            tc.send('1'+str(out)) # send to client
-                        else: # do some cleanup
-                            tc = None # remove thread
-                else: # we are client
-                    self.socket.send(bytes('1'+str(out), encoding='utf-8')) # send to server
+                self.state.sink.history(out) # print output to history textctrl
+                sendChat(state,out) # send to the chat session
 
 # ==========================
 # Application init and start
@@ -0,0 +1,267 @@
+# ====================
+# Python chat program
+# ====================
+#
+# Author: Edren Dacaymat
+#
+# Description:
+# Tests of the parts of the networking core that need no sockets:
+# frame decoding, command encoding, the roster, the chat history log
+# and the rate limits.
+#
+# -----------------------------------
+# usage: python -m pytest test_chatcore.py
+# -----------------------------------
+
+# =======
+# Imports
+# =======
+import os
+import time
+
+import pytest
+
+import chatcore
+from chatcore import (frameDecoder, frameCompressor, frameError, encodeFrame, fileChunk, commandNames,
+                      commandFrame, decodeCommand, rosterData, historyLog, tokenBucket)
+
+# =============
+# Wire Protocol
+# =============
+
+# frames of every kind, text and binary
+sampleFrames = [('1','[alice]: hello\n'), ('0','ulist_asknew 3'), ('2','7 1[bob]: hi\n'),
+                ('c',commandNames['ulist_leave'].binary([4,2])), ('3',b'\x00'*8+b'1hey'),
+                ('f',fileChunk('0123456789abcdef',0,bytes(range(256))*4)), ('1','été '*2000)]
+
+# feedInPieces()
+# Params: data - bytes to feed, size - bytes fed at a time
+# Desc: feeds data to a new decoder a piece at a time and returns the
+# decoder and the frames it returned
+def feedInPieces(data:bytes, size:int) -> tuple:
+    decoder = frameDecoder()
+    frames = []
+    for i in range(0, len(data), size):
+        frames += decoder.feed(memoryview(data)[i:i+size])
+    return (decoder, frames)
+
+def test_feed_coalesced_frames():
+    wire = b''.join(encodeFrame(mtype,data) for mtype,data in sampleFrames)
+    (decoder, frames) = feedInPieces(wire, len(wire))
+    assert frames == sampleFrames
+    assert len(decoder.pending) == 0
+
+@pytest.mark.parametrize('size', [1, 2, 5, 6, 13, 100, 4096])
+def test_feed_split_frames(size):
+    wire = b''.join(encodeFrame(mtype,data) for mtype,data in sampleFrames)
+    (decoder, frames) = feedInPieces(wire, size)
+    assert frames == sampleFrames
+    assert len(decoder.pending) == 0
+
+def test_feed_keeps_only_the_partial_frame():
+    first = encodeFrame('1','done\n')
+    second = encodeFrame('1','not yet\n')
+    decoder = frameDecoder()
+    assert decoder.feed(first + second[:7]) == [('1','done\n')]
+    assert bytes(decoder.pending) == second[:7]
+    assert decoder.feed(second[7:]) == [('1','not yet\n')]
+    assert len(decoder.pending) == 0
+
+def test_feed_compressed_frames():
+    compressor = frameCompressor()
+    texts = ['[alice]: '+'hello there '*20+str(i)+'\n' for i in range(5)]
+    wire = b''.join(compressor.pack(encodeFrame('1',text)) for text in texts)
+    assert wire[4] == ord('z')
+    decoder = frameDecoder()
+    decoder.inflate()
+    assert decoder.feed(wire) == [('1',text) for text in texts]
+
+def test_feed_rejects_bad_frames():
+    with pytest.raises(frameError):
+        frameDecoder().feed(chatcore.frameHeader.pack(chatcore.maxFrameSize+1, ord('1')))
+    with pytest.raises(frameError):
+        frameDecoder().feed(chatcore.frameHeader.pack(1, ord('Q'))+b'x')
+    with pytest.raises(frameError): # compression was not agreed on
+        frameDecoder().feed(frameCompressor().pack(encodeFrame('1','x'*500)))
+
+def test_feed_after_an_error():
+    decoder = frameDecoder()
+    with pytest.raises(frameError):
+        decoder.feed(encodeFrame('1','x') + chatcore.frameHeader.pack(1, ord('Q')))
+    assert decoder.feed(encodeFrame('1','again')) == [('1','again')]
+
+# ========
+# Commands
+# ========
+
+# a value of every field type, by type
+sampleValues = {'I':4000000000, 'Q':2**64-1, 'q':-5, 'd':1712345678.25, 'x':'0123456789abcdef',
+                'n':'mary jane', 'u':'50% a_b', 's':'last line, with spaces'}
+
+# sampleFields()
+# Params: spec - commandSpec, repeats - times the repeated fields are sent
+# Desc: returns field values for a command
+def sampleFields(spec, repeats:int = 2) -> list:
+    fields = [sampleValues[f] for f in spec.head.fields]
+    if spec.repeat != None:
+        fields += [sampleValues[f] for f in spec.repeat.fields] * repeats
+    for i,value in enumerate(fields):
+        if spec.fieldType(i) == 's' and not (spec.rest and i == len(fields)-1): # only the last string may have spaces
+            fields[i] = 'word'
+    return fields
+
+@pytest.mark.parametrize('name', sorted(commandNames))
+def test_binary_round_trip(name):
+    spec = commandNames[name]
+    for repeats in ([0, 1, 3] if spec.repeat != None else [0]):
+        fields = sampleFields(spec, repeats)
+        assert decodeCommand('c', spec.binary(fields)) == (spec, fields)
+
+@pytest.mark.parametrize('name', sorted(commandNames))
+def test_text_round_trip(name):
+    spec = commandNames[name]
+    fields = sampleFields(spec)
+    expected = [value.replace(' ','_') if spec.fieldType(i) == 'n' else value for i,value in enumerate(fields)]
+    assert decodeCommand('0', spec.text(fields)) == (spec, expected)
+    if len(spec.omitted) > 0: # the host reads the client's form with the omitted fields empty
+        for i in spec.omitted:
+            expected[i] = ''
+        assert decodeCommand('0', spec.text(fields, True), True) == (spec, expected)
+
+@pytest.mark.parametrize('name', sorted(commandNames))
+def test_command_frames(name):
+    spec = commandNames[name]
+    fields = sampleFields(spec)
+    for proto,mtype in [(1,'0'),(2,'c')]:
+        [(got,payload)] = frameDecoder().feed(commandFrame(name, fields, proto))
+        assert got == mtype
+        assert decodeCommand(got, payload)[0] is spec
+
+def test_binary_rejects_wrong_lengths():
+    for name in ['ulist_leave', 'ulist_join', 'hist_ask', 'file_offer', 'ping']:
+        data = commandNames[name].binary(sampleFields(commandNames[name]))
+        for cut in range(1, len(data)):
+            with pytest.raises(frameError):
+                decodeCommand('c', data[:cut])
+        with pytest.raises(frameError):
+            decodeCommand('c', data+b'\x00')
+    with pytest.raises(frameError):
+        decodeCommand('c', b'\xff')
+    with pytest.raises(frameError):
+        decodeCommand('c', b'')
+
+def test_text_rejects_bad_commands():
+    for text in ['no_such_command 1', 'ulist_leave 1', 'ulist_leave 1 2 3', 'ulist_leave one 2',
+                 'file_done 123', 'srch_ask', 'ulist_snapshot 1 2']:
+        with pytest.raises(frameError):
+            decodeCommand('0', text)
+
+def test_text_string_takes_the_rest_of_the_line():
+    assert decodeCommand('0', 'msg_send mary%20jane hello  there')[1] == ['mary jane', 'hello  there']
+    assert decodeCommand('0', 'usern_update mary_jane')[1] == ['mary_jane']
+
+# ======
+# Roster
+# ======
+
+def test_roster_versions():
+    roster = rosterData()
+    host = roster.add('host')
+    alice = roster.add('alice')
+    assert (host, alice, roster.version) == (0, 1, 2)
+    assert roster.rename(alice, 'al ice')
+    assert not roster.rename(7, 'nobody')
+    assert roster.remove(host)
+    assert not roster.remove(host)
+    assert roster.version == 4
+    assert roster.snapshot() == [4, 1, 'al ice']
+
+def test_roster_deltas_in_order():
+    copy = rosterData()
+    assert copy.apply('ulist_snapshot', [2, 0, 'host', 1, 'alice']) == 'ok'
+    assert copy.apply('ulist_join', [3, 2, 'bob']) == 'ok'
+    assert copy.apply('ulist_join', [3, 2, 'bob']) == 'old' # seen already
+    assert copy.apply('ulist_rename', [4, 1, 'al ice']) == 'ok'
+    assert copy.apply('ulist_leave', [5, 0]) == 'ok'
+    assert copy.members == {1:'al ice', 2:'bob'}
+    assert copy.version == 5
+
+def test_roster_gap_waits_for_a_snapshot():
+    copy = rosterData()
+    copy.apply('ulist_snapshot', [2, 0, 'host', 1, 'alice'])
+    assert copy.apply('ulist_leave', [4, 1]) == 'stale' # version 3 was missed
+    assert copy.apply('ulist_join', [5, 2, 'bob']) == 'old' # nothing more until the snapshot
+    assert copy.apply('ulist_snapshot', [2, 0, 'host', 1, 'alice']) == 'ok' # taken even if not newer
+    assert copy.apply('ulist_snapshot', [2, 0, 'host']) == 'old'
+    assert copy.apply('ulist_join', [3, 2, 'bob']) == 'ok'
+    assert copy.text() == '#[host]\n#alice\n#bob\n'
+
+# =======
+# History
+# =======
+
+@pytest.fixture
+def smallHistory(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatcore, 'historyCache', 5) # only the newest 5 in memory
+    monkeypatch.setattr(chatcore, 'historySegmentSize', 100) # a new segment every few messages
+    return str(tmp_path)
+
+def test_replay_last(smallHistory):
+    log = historyLog(smallHistory)
+    assert log.replay(last=3) == []
+    texts = ['message %d\n' % i for i in range(20)]
+    for text in texts:
+        log.append(text)
+    assert len(log.segments) > 1
+    assert log.replay(last=0) == []
+    assert log.replay(last=5) == texts[-5:] # from memory
+    assert log.replay(last=6) == texts[-6:] # from the segments
+    assert log.replay(last=20) == texts
+    assert log.replay(last=100) == texts
+    log.close()
+
+def test_replay_since(smallHistory):
+    log = historyLog(smallHistory)
+    texts = ['message %d\n' % i for i in range(12)]
+    for text in texts:
+        log.append(text)
+    stamps = [stamp for stamp,_ in log.cache]
+    assert log.replay(since=stamps[0]) == texts[-5:]
+    assert log.replay(since=0) == texts
+    assert log.replay(since=time.time()+60) == []
+    log.close()
+
+def test_history_reopens_after_the_last_message(smallHistory):
+    log = historyLog(smallHistory)
+    texts = ['message %d\n' % i for i in range(12)]
+    for text in texts[:9]:
+        log.append(text)
+    log.close()
+    with open(log.segments[-1][2], 'ab') as f: # a record cut short by a crash
+        f.write(chatcore.historyRecord.pack(time.time(), 50)+b'cut')
+    log = historyLog(smallHistory)
+    assert log.count == 9
+    for text in texts[9:]:
+        log.append(text)
+    assert log.replay(last=12) == texts
+    log.close()
+    assert sorted(os.listdir(smallHistory)) == sorted(os.path.basename(seg[2]) for seg in log.segments)
+
+# ===========
+# Rate Limits
+# ===========
+
+def test_token_bucket_burst_and_refill():
+    bucket = tokenBucket(2.0, 3)
+    assert [bucket.take() for i in range(4)] == [True, True, True, False]
+    assert bucket.limited == 1
+    bucket.stamp -= 0.5 # half a second later, one token at 2 per second
+    assert [bucket.take() for i in range(2)] == [True, False]
+    bucket.stamp -= 60 # refills up to the burst, not beyond it
+    assert [bucket.take() for i in range(4)] == [True, True, True, False]
+    assert bucket.limited == 3
+
+def test_token_bucket_without_limit():
+    bucket = tokenBucket(0, 1)
+    assert all(bucket.take() for i in range(1000))
+    assert bucket.limited == 0